@@ -0,0 +1,73 @@
+#!/usr/bin/env python2
+
+'''
+Measure alerts/sec against a running salt-alert daemon with a new
+AlertClient per alert (the old behavior), with the cached client, and
+with the cached client batching alerts 50 at a time.  Alerts are sent
+by the client's outbox thread, so each run waits for the outbox to
+drain.  The batched run needs an alert daemon that accepts
+'_alert_batch'.
+
+Use:
+    python2 bench/bench_alert.py [-c /etc/salt/monitor] [-n 200]
+'''
+
+import optparse
+import time
+
+import salt.ext.monitor.batch
+import salt.ext.monitor.client
+import salt.ext.monitor.config
+
+def drain(aclient):
+    while True:
+        stats = aclient.stats()
+        if stats['sent'] + stats['failed'] + stats['dropped'] >= stats['queued']:
+            return
+        time.sleep(0.001)
+
+def send(get_client, opts, count):
+    start = time.time()
+    for num in range(count):
+        aclient = get_client(opts)
+        aclient.alert(opts.get('id', 'bench'), 'NOTICE', 'bench.alert',
+                      'benchmark alert {}'.format(num))
+        if get_client is uncached:
+            aclient.close()
+    drain(aclient)
+    return count / (time.time() - start)
+
+def send_batched(opts, count, size=50):
+    start = time.time()
+    aclient = salt.ext.monitor.client.get_client(opts)
+    for first in range(0, count, size):
+        salt.ext.monitor.batch.begin()
+        for num in range(first, min(count, first + size)):
+            aclient.alert(opts.get('id', 'bench'), 'NOTICE', 'bench.alert',
+                          'benchmark alert {}'.format(num))
+        salt.ext.monitor.batch.end()
+    drain(aclient)
+    return count / (time.time() - start)
+
+def uncached(opts):
+    client_opts = dict(opts)
+    client_opts['master_uri'] = 'tcp://{}:{}'.format(opts['alert_master'],
+                                                     opts['alert.port'])
+    return salt.ext.monitor.client.AlertClient(client_opts)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-c', '--config', dest='config',
+                      default='/etc/salt/monitor')
+    parser.add_option('-n', '--count', dest='count', type='int', default=200)
+    options, args = parser.parse_args()
+    opts = salt.ext.monitor.config.monitor_config(options.config)
+    for name, get_client in [('new client per alert', uncached),
+                             ('cached client', salt.ext.monitor.client.get_client)]:
+        rate = send(get_client, opts, options.count)
+        print '{:<22} {:>10.1f} alerts/sec'.format(name, rate)
+    rate = send_batched(opts, options.count)
+    print '{:<22} {:>10.1f} alerts/sec'.format('batched client', rate)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python2
+
+'''
+Time CronScheduler.next_fire() and CronScheduler.delay() for dense and
+sparse schedules.
+
+Use:
+    python2 bench/bench_cron.py [iterations]
+'''
+
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import salt.ext.monitor.cron
+
+SCHEDULES = [
+    ('every 15 minutes',   {'minute': '*/15'}),
+    ('daily 03:27',        {'hour': '3', 'minute': '27'}),
+    ('sundays 03:27',      {'weekday': 'sun', 'hour': '3', 'minute': '27'}),
+    ('1st or monday',      {'day': '1', 'weekday': 'mon'}),
+    ('feb 29 03:27',       {'month': 'feb', 'day': '29',
+                            'hour': '3', 'minute': '27'}),
+]
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    parser = salt.ext.monitor.cron.CronParser()
+    after = datetime.datetime(2013, 3, 1, 12, 34, 56)
+    print '{:<18} {:>14} {:>10}'.format('schedule', 'next_fire-us', 'delay-us')
+    for name, cron_dict in SCHEDULES:
+        scheduler = parser.create_scheduler('cron', cron_dict)
+        fire = timeit.Timer(lambda: scheduler.next_fire(after))
+        sleep = timeit.Timer(lambda: scheduler.delay())
+        print '{:<18} {:>14.2f} {:>10.2f}'.format(
+                name,
+                min(fire.repeat(3, iterations)) / iterations * 1e6,
+                min(sleep.repeat(3, iterations)) / iterations * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python2
+
+'''
+Compare the old thread-per-task loop with the dispatcher.
+
+Every configuration runs in a fresh interpreter with no-op tasks on a one
+second interval and reports resident memory growth, the number of
+threads, and the context switches (wakeups) the process incurred.
+
+Use:
+    python2 bench/bench_dispatcher.py [seconds]
+'''
+
+import imp
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# Create mock salt.log module when salt is not installed
+try:
+    import salt.log
+except ImportError:
+    import salt
+    salt.log = imp.new_module('log')
+    exec '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+''' in salt.log.__dict__
+    sys.modules['salt.log'] = salt.log
+
+import salt.ext.monitor.cron
+import salt.ext.monitor.dispatcher
+
+SIZES = (10, 1000, 10000)
+INTERVAL = 1
+
+class NoopTask(object):
+    def __init__(self, num):
+        self.taskid = 'noop-{}'.format(num)
+        self.scheduler = salt.ext.monitor.cron.IntervalScheduler(INTERVAL)
+        self.runs = 0
+
+    def run(self, lag=None):
+        self.runs += 1
+
+def rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+def switches():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw + usage.ru_nivcsw
+
+def run_threads(tasks, running):
+    def loop(task):
+        while running:
+            task.run()
+            time.sleep(task.scheduler.interval)
+    for task in tasks:
+        thread = threading.Thread(target=loop, args=(task,))
+        thread.daemon = True
+        thread.start()
+
+def run_dispatcher(tasks, running):
+    dispatcher = salt.ext.monitor.dispatcher.Dispatcher(tasks)
+    thread = threading.Thread(target=dispatcher.start)
+    thread.daemon = True
+    thread.start()
+    return dispatcher
+
+def measure(mode, size, seconds):
+    tasks = [NoopTask(num) for num in range(size)]
+    running = [True]
+    rss_before = rss_kb()
+    switches_before = switches()
+    if mode == 'threads':
+        run_threads(tasks, running)
+    else:
+        run_dispatcher(tasks, running)
+    time.sleep(seconds)
+    print '{:<10} {:>6} {:>10} {:>8} {:>12} {:>8}'.format(
+            mode, size, rss_kb() - rss_before, threading.active_count(),
+            switches() - switches_before, sum(task.runs for task in tasks))
+    sys.stdout.flush()
+    os._exit(0)
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print '{:<10} {:>6} {:>10} {:>8} {:>12} {:>8}'.format(
+            'mode', 'tasks', 'rss-kb', 'threads', 'ctx-switch', 'runs')
+    sys.stdout.flush()
+    for size in SIZES:
+        for mode in ('threads', 'dispatcher'):
+            subprocess.call([sys.executable, __file__, '--measure',
+                             mode, str(size), str(seconds)])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], int(sys.argv[3]), float(sys.argv[4]))
+    else:
+        main()
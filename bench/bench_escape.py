@@ -0,0 +1,118 @@
+#!/usr/bin/env python2
+
+'''
+Measure the mongo collector's escaping of dotted dict keys on a
+ps.top sized result (no dotted keys) and a pkg.list_pkgs sized result
+(a few dotted package names), comparing the old escaper, which copied
+every dict and list, with the copy-on-write one.  'copied' counts the
+dicts and lists each escaper allocated per sample.
+
+Use:
+    python2 bench/bench_escape.py [iterations]
+'''
+
+import imp
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# Create mock salt.log module when salt is not installed
+try:
+    import salt.log
+except ImportError:
+    import salt
+    salt.log = imp.new_module('log')
+    exec '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+''' in salt.log.__dict__
+    sys.modules['salt.log'] = salt.log
+
+# Create mock pymongo and pymongo.errors modules when pymongo is not
+# installed; only the escaper is measured, nothing is written
+try:
+    import pymongo.errors
+except ImportError:
+    errors = imp.new_module('errors')
+    exec '''
+class ConnectionFailure(Exception):
+    pass
+class AutoReconnect(ConnectionFailure):
+    pass
+''' in errors.__dict__
+    pymongo = imp.new_module('pymongo')
+    pymongo.errors = errors
+    sys.modules['pymongo'] = pymongo
+    sys.modules['pymongo.errors'] = errors
+
+import salt.ext.monitor.collectors.mongo
+
+def old_escape_dot(in_value):
+    '''
+    The escaper before it became copy-on-write.
+    '''
+    if isinstance(in_value, dict):
+        result = {}
+        for key, value in in_value.iteritems():
+            result[key.replace('.', '-')] = old_escape_dot(value)
+    elif isinstance(in_value, list):
+        result = [old_escape_dot(x) for x in in_value]
+    else:
+        result = in_value
+    return result
+
+def ps_top(count=300):
+    '''
+    A result shaped like ps.top for 'count' processes.
+    '''
+    return [{'pid': pid,
+             'cmd': ['/usr/bin/python', '-m', 'worker', str(pid)],
+             'create_time': 1350000000.0 + pid,
+             'user': 'root',
+             'status': 'sleeping',
+             'cpu': {'user': 1.5, 'system': 0.25},
+             'mem': {'rss': 1024 * pid, 'vms': 4096 * pid},
+             'threads': 4}
+            for pid in range(count)]
+
+def list_pkgs(count=2000):
+    '''
+    A result shaped like pkg.list_pkgs; one package in 50 has a dot.
+    '''
+    return dict(('lib{}{}'.format('python2.' if num % 50 == 0 else 'pkg', num),
+                 '1.{}-1'.format(num))
+                for num in range(count))
+
+def containers(value, result=None):
+    '''
+    Return the ids of the dicts and lists in value.
+    '''
+    if result is None:
+        result = set()
+    if isinstance(value, (dict, list)):
+        result.add(id(value))
+        for item in value.itervalues() if isinstance(value, dict) else value:
+            containers(item, result)
+    return result
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    new_escape_dot = salt.ext.monitor.collectors.mongo._escape_dot
+    for payload, sample in [('ps.top', ps_top()),
+                            ('pkg.list_pkgs', list_pkgs())]:
+        before = containers(sample)
+        for name, escape in [('old', old_escape_dot),
+                             ('copy-on-write', new_escape_dot)]:
+            copied = len(containers(escape(sample)) - before)
+            best = min(timeit.Timer(lambda: escape(sample)).repeat(
+                            3, iterations))
+            print '{:<14} {:<14} {:>9.1f} us/sample {:>6} copied'.format(
+                    payload, name, best / iterations * 1e6, copied)
+
+if __name__ == '__main__':
+    main()
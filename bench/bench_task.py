@@ -0,0 +1,76 @@
+#!/usr/bin/env python2
+
+'''
+Measure the per-run overhead of a monitor task whose command is a no-op
+'test.echo', comparing the old exec-the-module-every-run approach with
+the compiled _command()/_react() functions.
+
+Use:
+    python2 bench/bench_task.py [iterations]
+'''
+
+import imp
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# Create mock salt.log module when salt is not installed
+try:
+    import salt.log
+except ImportError:
+    import salt
+    salt.log = imp.new_module('log')
+    exec '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+''' in salt.log.__dict__
+    sys.modules['salt.log'] = salt.log
+
+import salt.ext.monitor.parsers
+
+# what Parser._expand_task generated before tasks were compiled into
+# functions; the module was executed on every run
+OLD_SOURCE = '''
+class AttrDict(dict):
+    __getattr__ = dict.__getitem__
+def _run(*args):
+    log.trace("echo: run: %s", ' '.join(args))
+    ret = functions[args[0]](*args[1:])
+    log.trace("echo: result: %s", ret)
+    return ret
+cmd = ['test.echo', 'hello']
+result = _run('test.echo', 'hello')
+'''
+
+def echo(text):
+    return text
+
+class MockMonitor(object):
+    def __init__(self):
+        self.opts = {}
+        self.functions = {'test.echo': echo}
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    parser = salt.ext.monitor.parsers.get_parser(MockMonitor())
+    task = parser._expand_tasks([{'id': 'echo', 'run': 'test.echo hello'}])[0]
+
+    context = dict(parser.context)
+    code = compile(OLD_SOURCE, '<monitor-config>', 'exec')
+    def old_run():
+        exec code in context
+
+    def new_run():
+        task.react(task.command())
+
+    for name, func in [('exec per run', old_run), ('compiled task', new_run)]:
+        best = min(timeit.Timer(func).repeat(3, iterations))
+        print '{:<14} {:>8.2f} us/run'.format(name, best / iterations * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+'''
+Collect the alerts raised on a thread so they can be sent together.
+
+A monitor task run opens a batch with begin() and sends it with end().
+While a batch is open AlertClient.alert() adds alerts to it instead of
+sending each one; end() hands every client its alerts in one call.
+
+Use:
+    import salt.ext.monitor.batch
+    salt.ext.monitor.batch.begin()
+    ...                             # alerts are queued
+    salt.ext.monitor.batch.end()    # and sent here
+'''
+
+# Import python modules
+import threading
+
+_local = threading.local()
+
+def begin():
+    '''
+    Open a batch on the calling thread.
+    '''
+    _local.alerts = []
+
+def add(client, alert):
+    '''
+    Queue 'alert' for client.alert_batch() if a batch is open on the
+    calling thread.  Return False if there is no batch.
+    '''
+    alerts = getattr(_local, 'alerts', None)
+    if alerts is None:
+        return False
+    alerts.append((client, alert))
+    return True
+
+def end():
+    '''
+    Close the calling thread's batch and send its alerts, in order, one
+    call per client.  Return the number of alerts sent.
+    '''
+    alerts = getattr(_local, 'alerts', None)
+    _local.alerts = None
+    if not alerts:
+        return 0
+    clients = []
+    by_client = {}
+    for client, alert in alerts:
+        if client not in by_client:
+            clients.append(client)
+            by_client[client] = []
+        by_client[client].append(alert)
+    for client in clients:
+        client.alert_batch(by_client[client])
+    return len(alerts)
@@ -1,45 +1,328 @@
 '''
 Create Clients to communicate with the salt-alert daemon
 
+Alerts are not sent by the calling thread.  AlertClient puts them on a
+bounded outbox queue that a background thread drains, so a down or slow
+alert master never blocks a monitor task.  The outbox thread waits at
+most 'alert.timeout' seconds for the socket to accept a request and for
+the reply.  After a failure it replaces the REQ socket, which is stuck
+once a reply is lost, and retries with exponential backoff up to
+'alert.max_backoff' seconds.  When the outbox is full new alerts are
+dropped and counted.  With the asyncio monitor engine the outbox is
+drained from the event loop instead of a thread, see use_driver().
+
 Use:
     import salt.ext.monitor.client
-    aclient = salt.ext.monitor.client.AlertClient(opts)
+    aclient = salt.ext.monitor.client.get_client(opts)
     aclient.alert(<alert data>)
+    aclient.alert_batch([<alert data>, ...])
+    aclient.stats()
 '''
+# Import python libs
+import atexit
+import Queue
+import threading
+import time
 # Import salt modules
 import salt.crypt
+import salt.ext.monitor.batch
+import salt.exceptions
+import salt.log
 # Import zeromq libs
 import zmq
 
+log = salt.log.getLogger(__name__)
+
+DEFAULT_OUTBOX_SIZE = 10000
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_MAX_BACKOFF = 30.0
+# The most alerts the outbox sends in one '_alert_batch' load
+MAX_BATCH = 100
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# called with each new client to drain its outbox, see use_driver()
+_driver = None
+
+def use_driver(driver):
+    '''
+    Drain the outboxes of the clients created from now on with the
+    object driver(client) returns instead of an outbox thread.  The
+    object's wake() is called from any thread when alerts are queued,
+    and close(timeout) when the client is closed.  None goes back to
+    outbox threads.
+    '''
+    global _driver
+    _driver = driver
+
+def get_client(opts):
+    '''
+    Return the process wide AlertClient for the alert master in opts.
+    Clients are cached by alert master and port so the AES session and
+    the socket are reused across alerts.
+    '''
+    key = (opts['alert_master'], opts['alert.port'])
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client_opts = dict(opts)
+                client_opts['master_uri'] = 'tcp://{}:{}'.format(*key)
+                client = AlertClient(client_opts)
+                atexit.register(client.close)
+                _clients[key] = client
+    return client
+
+def stats():
+    '''
+    Return the outbox counters of every client by alert master uri.
+    '''
+    with _clients_lock:
+        clients = _clients.values()
+    return dict((client.opts['master_uri'], client.stats())
+                for client in clients)
+
 class AlertClient(object):
     '''
     Connect to the salt-alert daemon
     '''
     def __init__(self, opts):
-        self.opts = opts
-        self.auth = salt.crypt.SAuth(opts)
-        self.socket = self.__get_socket()
+        self.opts        = opts
+        self.auth        = None
+        self.socket      = None
+        self.timeout     = float(opts.get('alert.timeout', DEFAULT_TIMEOUT))
+        self.max_backoff = float(opts.get('alert.max_backoff',
+                                          DEFAULT_MAX_BACKOFF))
+        self.batch       = opts.get('alert.batch', True)
+        self.outbox      = Queue.Queue(int(opts.get('alert.outbox_size',
+                                                    DEFAULT_OUTBOX_SIZE)))
+        self.counters    = {'queued': 0,
+                            'dropped': 0,
+                            'sent': 0,
+                            'failed': 0,
+                            'retries': 0,
+                            'reconnects': 0}
+        self._lock       = threading.Lock()
+        # alerts beyond MAX_BATCH, sent first next time
+        self._carry      = []
+        self._closing    = False
+        self._driver     = None
+        if _driver is not None:
+            self._driver = _driver(self)
+        else:
+            self._thread = threading.Thread(target=self._run,
+                                            name='alert-outbox')
+            self._thread.daemon = True
+            self._thread.start()
 
-    def __get_socket(self):
+    def alert(self, host, severity, category, msg):
         '''
-        Return a zeromq socket
+        Queue an alert message for the alert daemon.  While a batch is
+        open on the calling thread the alert is added to the batch
+        instead, see salt.ext.monitor.batch.  Returns False if the
+        outbox is full and the alert was dropped.
         '''
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ)
-        socket.connect(self.opts['master_uri'])
-        return socket
+        alert = (host, severity, category, msg)
+        if self.batch and salt.ext.monitor.batch.add(self, alert):
+            return True
+        return self.alert_batch([alert])
 
-    def alert(self, host, severity, category, msg):
+    def alert_batch(self, alerts):
+        '''
+        Queue a list of (host, severity, category, msg) alerts to be
+        sent together.  Returns False if the outbox is full and the
+        alerts were dropped.
+        '''
+        try:
+            self.outbox.put_nowait(list(alerts))
+            self._count('queued', len(alerts))
+        except Queue.Full:
+            self._count('dropped', len(alerts))
+            log.debug('alert outbox full, dropped %d alerts', len(alerts))
+            return False
+        if self._driver is not None:
+            self._driver.wake()
+        return True
+
+    def close(self, timeout=10):
+        '''
+        Send whatever is queued and stop the outbox thread or driver.
+        '''
+        try:
+            self.outbox.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        if self._driver is not None:
+            self._driver.wake()
+            self._driver.close(timeout)
+        else:
+            self._thread.join(timeout)
+
+    def stats(self):
+        '''
+        Return a copy of the counters plus the outbox depth.
+        '''
+        with self._lock:
+            result = dict(self.counters)
+        result['depth'] = self.outbox.qsize()
+        return result
+
+    def _count(self, name, num=1):
+        with self._lock:
+            self.counters[name] += num
+
+    def _run(self):
+        '''
+        Outbox thread: send queued alerts until close() is called.
+        '''
+        while True:
+            alerts = self._next_alerts()
+            if alerts is None:
+                break
+            if alerts:
+                self._deliver(alerts)
+
+    def _next_alerts(self, block=True):
         '''
-        Send an alert message to the alert daemon
-        '''
-        load = {'cmd': '_alert',
-                'host': host,
-                'severity': severity.lower(),
-                'SEVERITY': severity.upper(),
-                'category': category,
-                'msg': msg}
-        payload = {'enc': 'aes',
-                   'load': self.auth.crypticle.dumps(load)}
-        self.socket.send_pyobj(payload)
-        return self.auth.crypticle.loads(self.socket.recv_pyobj())
+        Return the alerts left over from the last call, or wait for
+        queued ones, plus whatever else is queued, up to MAX_BATCH
+        alerts when batching.  Without 'block' returns [] rather than
+        wait.  Returns None once close() was called and everything
+        queued before it was returned.
+        '''
+        alerts, self._carry = self._carry, []
+        if not alerts:
+            if self._closing:
+                return None
+            try:
+                alerts = self.outbox.get(block)
+            except Queue.Empty:
+                return []
+            if alerts is None:
+                return None
+        while self.batch and len(alerts) < MAX_BATCH and not self._closing:
+            try:
+                more = self.outbox.get_nowait()
+            except Queue.Empty:
+                break
+            if more is None:
+                self._closing = True
+                break
+            alerts.extend(more)
+        if self.batch and len(alerts) > MAX_BATCH:
+            alerts, self._carry = alerts[:MAX_BATCH], alerts[MAX_BATCH:]
+        return alerts
+
+    def _loads(self, alerts):
+        '''
+        Return the [(load, number of alerts)] that send alerts.
+        '''
+        if len(alerts) == 1 or not self.batch:
+            loads = [_alert_load(*alert) for alert in alerts]
+            for load in loads:
+                load['cmd'] = '_alert'
+            return [(load, 1) for load in loads]
+        return [({'cmd': '_alert_batch',
+                  'alerts': [_alert_load(*alert) for alert in alerts]},
+                 len(alerts))]
+
+    def _deliver(self, alerts):
+        '''
+        Send alerts, retrying with backoff while the alert master is
+        unreachable.  Other errors drop the alerts.
+        '''
+        for load, count in self._loads(alerts):
+            backoff = min(0.5, self.max_backoff)
+            while True:
+                try:
+                    self._request(load)
+                    self._count('sent', count)
+                    break
+                except (zmq.ZMQError, _Timeout), ex:
+                    self._close_socket()
+                    self._count('retries')
+                    log.warning('alert master %s unreachable, retry in '
+                                '%.1fs: %s', self.opts['master_uri'],
+                                backoff, ex)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                except Exception, ex:
+                    self._close_socket()
+                    self._count('failed', count)
+                    log.error("can't send %d alerts to %s: %s", count,
+                              self.opts['master_uri'], ex, exc_info=ex)
+                    break
+
+    def _request(self, load):
+        '''
+        Send a load, logging in again if the alert master rotated its
+        AES key.
+        '''
+        if self.auth is None:
+            self.auth = salt.crypt.SAuth(self.opts)
+        try:
+            return self._send(load)
+        except salt.exceptions.AuthenticationError:
+            self.auth = salt.crypt.SAuth(self.opts)
+            return self._send(load)
+
+    def _get_socket(self):
+        '''
+        Return the zeromq socket, connecting a new one if needed.
+        '''
+        if self.socket is None:
+            context = zmq.Context.instance()
+            self.socket = context.socket(zmq.REQ)
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.connect(self.opts['master_uri'])
+            self._count('reconnects')
+        return self.socket
+
+    def _close_socket(self):
+        '''
+        Drop the socket; a REQ socket that lost a reply can't be reused.
+        '''
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def _send(self, load):
+        '''
+        Encrypt the load, send it and decrypt the reply, waiting at most
+        self.timeout seconds for each step.
+        '''
+        socket = self._get_socket()
+        payload = self._payload(load)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLOUT)
+        if not poller.poll(self.timeout * 1000):
+            raise _Timeout('send timed out')
+        socket.send_pyobj(payload, zmq.NOBLOCK)
+        poller.register(socket, zmq.POLLIN)
+        if not poller.poll(self.timeout * 1000):
+            raise _Timeout('no reply in {} seconds'.format(self.timeout))
+        return self.auth.crypticle.loads(socket.recv_pyobj(zmq.NOBLOCK))
+
+    def _payload(self, load):
+        '''
+        Return the encrypted request for a load.
+        '''
+        return {'enc': 'aes',
+                'load': self.auth.crypticle.dumps(load)}
+
+class _Timeout(Exception):
+    '''
+    The alert master didn't answer in time.
+    '''
+
+def _alert_load(host, severity, category, msg):
+    '''
+    Return the fields of one alert as sent to the alert daemon.
+    '''
+    return {'host': host,
+            'severity': severity.lower(),
+            'SEVERITY': severity.upper(),
+            'category': category,
+            'msg': msg}
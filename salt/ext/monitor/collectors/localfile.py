@@ -0,0 +1,284 @@
+'''
+Collect data in local files.
+
+Needs no database, which suits edge hosts and benchmarks.  Samples are
+encoded into an in-memory buffer that is appended to the current file
+when it reaches 'localfile.buffer_size' bytes, and at least every
+'localfile.flush_interval' seconds by a background thread.  Files live
+in 'localfile.dir' and are rotated when they reach
+'localfile.max_bytes'; only the newest 'localfile.max_files' are kept.
+Files are named after the time they were started and a sequence
+number, which is bumped past the name of any existing file so a
+restart never appends to an old file.
+
+'localfile.fsync' selects how hard the data is pushed to disk:
+    never  = leave it to the operating system
+    rotate = fsync a file when it is rotated or closed (the default)
+    flush  = fsync after every buffer flush
+
+Every file starts with a header naming its codec: msgpack when it is
+installed, marshal otherwise.  Each record is a 4 byte big endian length
+followed by the encoded {'time', 'host', 'cmd', 'result'} dict, where
+'time' is seconds since the epoch.  read() and read_dir() stream the
+records back one at a time.
+
+Use:
+    import salt.ext.monitor.collectors.localfile as localfile
+    for record in localfile.read_dir('/var/cache/salt/monitor-records'):
+        print record['host'], record['result']
+'''
+
+import atexit
+import errno
+import marshal
+import os
+import struct
+import threading
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import salt.log
+
+log = salt.log.getLogger(__name__)
+
+__opts__ = {
+            'localfile.dir': None,
+            'localfile.buffer_size': 65536,
+            'localfile.flush_interval': 1.0,
+            'localfile.max_bytes': 64 * 1024 * 1024,
+            'localfile.max_files': 10,
+            'localfile.fsync': 'rotate',
+           }
+
+FSYNC_POLICIES = ('never', 'rotate', 'flush')
+
+_MAGIC = 'SMREC1'
+_LENGTH = struct.Struct('>I')
+_SUFFIX = '.rec'
+
+# codec name -> (encode, decode)
+_CODECS = {'marshal': (marshal.dumps, marshal.loads)}
+if msgpack is not None:
+    _CODECS['msgpack'] = (msgpack.packb, msgpack.unpackb)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+class RecordWriter(object):
+    '''
+    Buffer encoded records and append them to rotating files.
+    '''
+    def __init__(self, opts):
+        self.directory      = self._directory(opts)
+        self.buffer_size    = int(opts['localfile.buffer_size'])
+        self.flush_interval = float(opts['localfile.flush_interval'])
+        self.max_bytes      = int(opts['localfile.max_bytes'])
+        self.max_files      = int(opts['localfile.max_files'])
+        self.fsync          = opts['localfile.fsync']
+        if self.fsync not in FSYNC_POLICIES:
+            raise ValueError('localfile.fsync must be one of {}: {!r}'.format(
+                                ', '.join(FSYNC_POLICIES), self.fsync))
+        self.codec          = 'msgpack' if msgpack is not None else 'marshal'
+        self.encode         = _CODECS[self.codec][0]
+        self.counters       = {'written': 0, 'flushes': 0, 'files': 0,
+                               'errors': 0}
+        self._lock          = threading.Lock()
+        self._buffer        = []
+        self._buffered      = 0
+        self._file          = None
+        self._size          = 0
+        self._sequence      = 0
+        self._stopping      = threading.Event()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._thread        = threading.Thread(target=self._run,
+                                               name='localfile-flusher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _directory(self, opts):
+        '''
+        Defaults to 'monitor-records' under the minion's cachedir.
+        '''
+        result = opts.get('localfile.dir')
+        if not result:
+            result = os.path.join(opts.get('cachedir', '/var/cache/salt'),
+                                  'monitor-records')
+        return result
+
+    def put(self, record):
+        '''
+        Buffer one record, flushing if the buffer is full.
+        '''
+        data = self.encode(record)
+        with self._lock:
+            self._buffer.append(_LENGTH.pack(len(data)))
+            self._buffer.append(data)
+            self._buffered += _LENGTH.size + len(data)
+            self.counters['written'] += 1
+            if self._buffered >= self.buffer_size:
+                self._flush()
+
+    def flush(self):
+        '''
+        Write the buffered records to the current file.
+        '''
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        '''
+        Flush, close the current file and stop the flusher thread.
+        '''
+        self._stopping.set()
+        with self._lock:
+            self._flush()
+            self._close_file()
+
+    def stats(self):
+        with self._lock:
+            result = dict(self.counters)
+            result['buffered'] = self._buffered
+        result['codec'] = self.codec
+        return result
+
+    def _run(self):
+        '''
+        Flusher thread: flush every flush_interval seconds.
+        '''
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception, ex:
+                log.error('localfile flush failed: %s', ex, exc_info=ex)
+
+    def _flush(self):
+        '''
+        Append the buffer to the current file; the caller holds the lock.
+        '''
+        if not self._buffer:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        try:
+            if self._file is None or self._size >= self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync == 'flush':
+                os.fsync(self._file.fileno())
+            self._size += len(data)
+            self.counters['flushes'] += 1
+        except (IOError, OSError), ex:
+            self.counters['errors'] += 1
+            log.error('localfile write of %d bytes to %s failed: %s',
+                      len(data), self.directory, ex)
+            self._close_file()
+
+    def _rotate(self):
+        '''
+        Start a new file and remove the oldest beyond max_files.
+        '''
+        self._close_file()
+        started = time.strftime('%Y%m%dT%H%M%S')
+        while True:
+            name = '{}-{:06d}{}'.format(started, self._sequence, _SUFFIX)
+            self._sequence += 1
+            try:
+                fd = os.open(os.path.join(self.directory, name),
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+                break
+            except OSError, ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+        self._file = os.fdopen(fd, 'wb')
+        header = _MAGIC + chr(len(self.codec)) + self.codec
+        self._file.write(header)
+        self._size = len(header)
+        self.counters['files'] += 1
+        for old in _files(self.directory)[:-self.max_files]:
+            os.remove(old)
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        try:
+            if self.fsync != 'never':
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._file.close()
+        except (IOError, OSError), ex:
+            log.error("can't close %s: %s", self._file.name, ex)
+        self._file = None
+
+def _files(directory):
+    '''
+    Return the record files in a directory, oldest first.
+    '''
+    return [os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.endswith(_SUFFIX)]
+
+def read(path):
+    '''
+    Yield the records of one file.  A record cut short, e.g. by a
+    crash, ends the file.
+    '''
+    with open(path, 'rb') as records:
+        magic = records.read(len(_MAGIC) + 1)
+        if len(magic) < len(_MAGIC) + 1 or magic[:-1] != _MAGIC:
+            raise ValueError('not a monitor record file: ' + path)
+        codec = records.read(ord(magic[-1]))
+        if codec not in _CODECS:
+            raise ValueError('{} needs the {} codec'.format(path, codec))
+        decode = _CODECS[codec][1]
+        while True:
+            header = records.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                return
+            length, = _LENGTH.unpack(header)
+            data = records.read(length)
+            if len(data) < length:
+                log.warning('%s is truncated', path)
+                return
+            yield decode(data)
+
+def read_dir(directory):
+    '''
+    Yield the records of every file in a directory, oldest first.
+    '''
+    for path in _files(directory):
+        for record in read(path):
+            yield record
+
+def _get_writer():
+    '''
+    Return the process wide writer, starting it on first use.
+    '''
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = RecordWriter(__opts__)
+                atexit.register(_writer.close)
+    return _writer
+
+def stats():
+    '''
+    Return the record, flush and file counters of the writer.
+    '''
+    return _get_writer().stats()
+
+def collector(hostname, cmd, result):
+    '''
+    Collect data in local files.
+    '''
+    _get_writer().put({'time': time.time(),
+                       'host': hostname,
+                       'cmd': cmd,
+                       'result': result})
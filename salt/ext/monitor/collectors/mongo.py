@@ -1,11 +1,35 @@
 '''
 Collect data in a mongo database.
+
+Samples are put on a bounded in-memory queue and the calling task
+returns right away.  One background thread per process owns the mongo
+connection and drains the queue with bulk inserts, flushing when
+'mongo.batch_size' samples are waiting or 'mongo.flush_interval'
+seconds have passed.  When the queue is full new samples are dropped
+and counted rather than stalling the monitor.
+
+Batches that can't be written because mongo is unreachable are
+appended to a local spool in 'mongo.spool_dir' (see
+salt.ext.monitor.spool) instead of being lost.  A replay thread checks
+the spool every 'mongo.replay_interval' seconds and, once writes succeed
+again, inserts the spooled batches in order.  Set 'mongo.spool_dir' to
+'' to drop those batches instead.  When mongo rejects a batch for its
+content, e.g. a set or a '$' key it can't store, its samples are
+inserted one at a time and the ones rejected again are dropped and
+counted, so one bad sample doesn't hold up the rest.
 '''
 
+import atexit
 import datetime
+import os
+import Queue
+import threading
+import time
 
 import pymongo
+import pymongo.errors
 
+import salt.ext.monitor.spool
 import salt.log
 
 log = salt.log.getLogger(__name__)
@@ -16,38 +40,359 @@ __opts__ = {
             'mongo.db': 'salt',
             'mongo.user': '',
             'mongo.password': '',
+            'mongo.batch_size': 100,
+            'mongo.flush_interval': 1.0,
+            'mongo.queue_size': 10000,
+            'mongo.spool_dir': None,
+            'mongo.spool_segment_size': salt.ext.monitor.spool.DEFAULT_SEGMENT_SIZE,
+            'mongo.spool_max_size': salt.ext.monitor.spool.DEFAULT_MAX_SIZE,
+            'mongo.spool_max_age': salt.ext.monitor.spool.DEFAULT_MAX_AGE,
+            'mongo.replay_interval': 10.0,
            }
 
+_writer = None
+_writer_lock = threading.Lock()
+
+# The most keys _escape_key() remembers before starting over
+MAX_ESCAPED_KEYS = 10000
+
+# key -> escaped key, or False for keys that need no escaping
+_escaped_keys = {}
+
+# leaves _escape_dot() doesn't need to look into
+_SCALARS = frozenset([str, unicode, int, long, float, bool, type(None),
+                      datetime.datetime])
+
+def _escape_key(key):
+    '''
+    Return key with its dots replaced by dashes, or False if it has
+    none.  Results are memoized since samples repeat the same keys.
+    '''
+    escaped = _escaped_keys.get(key)
+    if escaped is None:
+        if isinstance(key, basestring) and '.' in key:
+            escaped = key.replace('.', '-')
+        else:
+            escaped = False
+        if len(_escaped_keys) >= MAX_ESCAPED_KEYS:
+            _escaped_keys.clear()
+        _escaped_keys[key] = escaped
+    return escaped
+
 def _escape_dot(in_value):
+    '''
+    Return in_value with the dots in dict keys, which mongo rejects,
+    replaced by dashes.  Dicts and lists are only copied when they, or
+    something inside them, have dotted keys; otherwise in_value itself
+    is returned.
+    '''
+    # the key lookup and scalar checks are inlined since they run for
+    # every key and item of every sample
     if isinstance(in_value, dict):
-        result = {}
+        result = in_value
         for key, value in in_value.iteritems():
-            result[key.replace('.', '-')] = _escape_dot(value)
-    elif isinstance(in_value, list):
-        result = [_escape_dot(x) for x in in_value]
-    else:
+            escaped = _escaped_keys.get(key)
+            if escaped is None:
+                escaped = _escape_key(key)
+            if type(value) in _SCALARS:
+                new_value = value
+            else:
+                new_value = _escape_dot(value)
+            if escaped is False and new_value is value:
+                continue
+            if result is in_value:
+                result = dict(in_value)
+            if escaped is not False:
+                del result[key]
+                key = escaped
+            result[key] = new_value
+        return result
+    if isinstance(in_value, list):
         result = in_value
-    return result
+        for index, value in enumerate(in_value):
+            if type(value) in _SCALARS:
+                continue
+            new_value = _escape_dot(value)
+            if new_value is not value:
+                if result is in_value:
+                    result = list(in_value)
+                result[index] = new_value
+        return result
+    return in_value
+
+class BulkWriter(object):
+    '''
+    Drain queued samples into mongo from a background thread.
+    '''
+    def __init__(self, opts):
+        self.opts           = opts
+        self.batch_size     = int(opts['mongo.batch_size'])
+        self.flush_interval = float(opts['mongo.flush_interval'])
+        self.queue          = Queue.Queue(int(opts['mongo.queue_size']))
+        self.started        = time.time()
+        self.counters       = {'queued': 0,
+                               'dropped': 0,
+                               'written': 0,
+                               'batches': 0,
+                               'errors': 0,
+                               'rejected': 0}
+        self._lock          = threading.Lock()
+        # the writer and the replay thread both insert
+        self._db_lock       = threading.Lock()
+        self._db            = None
+        # orders spooling against the replay thread draining the spool
+        self._spool_lock    = threading.Lock()
+        # set while writes fail, cleared by the first one that succeeds
+        self._failing       = threading.Event()
+        self._stopping      = threading.Event()
+        self.spool          = self._open_spool()
+        self._thread        = threading.Thread(target=self._run,
+                                               name='mongo-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        if self.spool is not None:
+            replayer = threading.Thread(target=self._replay,
+                                        name='mongo-replay')
+            replayer.daemon = True
+            replayer.start()
+
+    def _open_spool(self):
+        '''
+        Return the spool for failed batches, or None if it is disabled.
+        Defaults to 'mongo-spool' under the minion's cachedir.
+        '''
+        directory = self.opts.get('mongo.spool_dir')
+        if directory is None and 'cachedir' in self.opts:
+            directory = os.path.join(self.opts['cachedir'], 'mongo-spool')
+        if not directory:
+            return None
+        try:
+            return salt.ext.monitor.spool.Spool(directory,
+                        int(self.opts['mongo.spool_segment_size']),
+                        int(self.opts['mongo.spool_max_size']),
+                        float(self.opts['mongo.spool_max_age']))
+        except (IOError, OSError), ex:
+            log.error("mongo spool disabled, can't open %s: %s",
+                      directory, ex)
+            return None
+
+    def put(self, hostname, record):
+        '''
+        Queue one sample without blocking.
+        '''
+        try:
+            self.queue.put_nowait((hostname, record))
+            self._count('queued')
+        except Queue.Full:
+            self._count('dropped')
+            log.debug('mongo queue full, dropped sample for %s', hostname)
+
+    def close(self, timeout=10):
+        '''
+        Write whatever is queued and stop the writer thread.
+        '''
+        self._stopping.set()
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self):
+        '''
+        Return a copy of the counters plus the queue depth and the
+        average write rate.
+        '''
+        with self._lock:
+            result = dict(self.counters)
+        elapsed = time.time() - self.started
+        result['depth'] = self.queue.qsize()
+        result['written_per_sec'] = result['written'] / elapsed if elapsed else 0.0
+        if self.spool is not None:
+            result['spool'] = self.spool.stats()
+        return result
+
+    def _count(self, name, num=1):
+        with self._lock:
+            self.counters[name] += num
+
+    def _connect(self):
+        '''
+        Return the database handle; pymongo pools the sockets.
+        '''
+        with self._db_lock:
+            if self._db is None:
+                conn = pymongo.Connection(
+                        self.opts['mongo.host'],
+                        self.opts['mongo.port'],
+                        )
+                db = conn[self.opts['mongo.db']]
+
+                user = self.opts.get('mongo.user')
+                password = self.opts.get('mongo.password')
+                if user and password:
+                    db.authenticate(user, password)
+                self._db = db
+            return self._db
+
+    def _disconnect(self):
+        '''
+        Drop the database handle after a failure.
+        '''
+        with self._db_lock:
+            self._db = None
+
+    def _run(self):
+        '''
+        Writer thread: collect a batch, insert it, repeat.
+        '''
+        running = True
+        while running:
+            batch, running = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def _next_batch(self):
+        '''
+        Wait for a sample, then gather more until the batch is full or
+        the flush interval expires.  Returns (batch, keep running).
+        '''
+        batch = []
+        item = self.queue.get()
+        deadline = time.time() + self.flush_interval
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+        return batch, item is not None
+
+    def _write(self, batch):
+        '''
+        Bulk insert a batch, spooling it if mongo is unreachable.
+        '''
+        for hostname, record in batch:
+            record['result'] = _escape_dot(record['result'])
+        # keep the spool in order while replaying
+        with self._spool_lock:
+            if self.spool is not None and self._failing.is_set():
+                self.spool.append(batch)
+                return
+        try:
+            self._insert(batch)
+        except pymongo.errors.ConnectionFailure, ex:
+            self._disconnect()
+            self._count('errors')
+            if self.spool is None:
+                log.error('mongo write of %d samples failed: %s', len(batch),
+                          ex, exc_info=ex)
+                return
+            log.error('mongo write of %d samples failed, spooling: %s',
+                      len(batch), ex, exc_info=ex)
+            with self._spool_lock:
+                self._failing.set()
+                self.spool.append(batch)
+        except Exception, ex:
+            # e.g. a failed login, which spooling won't fix either
+            self._disconnect()
+            self._count('errors')
+            log.error('mongo write of %d samples failed, dropping them: %s',
+                      len(batch), ex, exc_info=ex)
+
+    def _insert(self, batch):
+        '''
+        Insert escaped samples, one insert per host collection.  Raises
+        pymongo.errors.ConnectionFailure if mongo is unreachable.
+        '''
+        by_host = {}
+        for hostname, record in batch:
+            by_host.setdefault(hostname, []).append(record)
+        db = self._connect()
+        for hostname, records in by_host.iteritems():
+            try:
+                db[hostname].insert(records)
+                self._count('written', len(records))
+            except pymongo.errors.ConnectionFailure:
+                raise
+            except Exception, ex:
+                log.warning('mongo rejected %d samples for %s, inserting '
+                            'them one at a time: %s', len(records),
+                            hostname, ex)
+                self._insert_each(db[hostname], hostname, records)
+        self._count('batches')
+
+    def _insert_each(self, collection, hostname, records):
+        '''
+        Insert records one at a time, dropping the ones mongo rejects.
+        '''
+        for record in records:
+            try:
+                collection.insert(record)
+                self._count('written')
+            except pymongo.errors.ConnectionFailure:
+                raise
+            except Exception, ex:
+                self._count('rejected')
+                log.error('mongo rejected a sample for %s, dropping it: %s',
+                          hostname, ex)
+
+    def _replay(self):
+        '''
+        Replay thread: insert spooled batches once mongo is back.
+        '''
+        interval = float(self.opts['mongo.replay_interval'])
+        while not self._stopping.wait(interval):
+            if not len(self.spool):
+                # e.g. everything spooled expired
+                with self._spool_lock:
+                    if not len(self.spool):
+                        self._failing.clear()
+                continue
+            try:
+                count = self.spool.replay(self._insert)
+                # the writer inserts directly again only once nothing is
+                # left to replay, so the samples stay in order
+                with self._spool_lock:
+                    if not len(self.spool):
+                        self._failing.clear()
+                log.info('replayed %d spooled mongo samples', count)
+            except Exception, ex:
+                self._disconnect()
+                log.warning('mongo still unavailable, %d spool segments '
+                            'waiting: %s', len(self.spool), ex)
+
+def _get_writer():
+    '''
+    Return the process wide writer, starting it on first use.
+    '''
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BulkWriter(__opts__)
+                atexit.register(_writer.close)
+    return _writer
+
+def stats():
+    '''
+    Return the throughput and queue-depth counters of the mongo writer.
+    '''
+    return _get_writer().stats()
 
 def collector(hostname, cmd, result):
     '''
     Collect data in a mongo database.
     '''
-    conn = pymongo.Connection(
-            __opts__['mongo.host'],
-            __opts__['mongo.port'],
-            )
-    db = conn[__opts__['mongo.db']]
-
-    user = __opts__.get('mongo.user')
-    password = __opts__.get('mongo.password')
-    if user and password:
-        db.authenticate(user, password)
-
-    collection = db[hostname]
-    back = _escape_dot(result)
-    log.debug( back )
-    collection.insert({
+    _get_writer().put(hostname, {
         'utctime' : datetime.datetime.utcnow(),
         'cmd' : cmd,
-        'result' : back})
+        'result' : result})
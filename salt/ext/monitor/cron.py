@@ -5,9 +5,74 @@ Parse time and cron related structures.
 This module is used by salt.monitor to schedule command execution.
 '''
 
+import calendar
+import ctypes
+import datetime
+import hashlib
 import locale
 import re
 import sys
+import time
+
+# The longest wall clock shift (e.g. leaving daylight saving time) that
+# CronScheduler will wait out rather than fire the same event twice
+DST_SHIFT = datetime.timedelta(hours=2)
+
+# Give up looking for the next cron event after this many field carries;
+# even 'feb 29' only needs a few dozen
+MAX_CARRIES = 1000
+
+# The number of (year, month) day masks CronScheduler remembers
+MAX_DAY_MASKS = 120
+
+# The most days each month can have, used to reject impossible schedules
+MAX_MONTH_DAYS = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+# What an interval task does after a run overran one or more of its slots:
+#   skip     - drop the missed slots and wait for the next one
+#   once     - run once right away, then continue with the next slot
+#   catch-up - run every missed slot back to back, up to CATCHUP_LIMIT
+MISSED_POLICIES = ('skip', 'once', 'catch-up')
+DEFAULT_MISSED_POLICY = 'once'
+CATCHUP_LIMIT = 10
+
+# AdaptiveScheduler defaults: results whose numbers all moved less than
+# this fraction count as stable, and each stable run multiplies the
+# interval by the backoff factor
+DEFAULT_BAND = 0.05
+DEFAULT_BACKOFF = 2.0
+
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _load_clock_gettime():
+    '''
+    Return clock_gettime() from librt or libc, or None.
+    '''
+    for name in ('librt.so.1', None):
+        try:
+            func = ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        func.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        return func
+    return None
+
+_clock_gettime = _load_clock_gettime()
+
+def monotonic():
+    '''
+    Return seconds from a clock that never jumps, for deadlines and
+    durations.  Falls back to time.time() without clock_gettime().
+    '''
+    if _clock_gettime is None:
+        return time.time()
+    spec = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+        return time.time()
+    return spec.tv_sec + spec.tv_nsec * 1e-9
 
 def parse_interval(interval_dict):
     '''
@@ -29,29 +94,296 @@ def parse_interval(interval_dict):
     return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
 
 
+def splay(name, interval):
+    '''
+    Return a stable offset within [0, interval) seconds derived from a
+    hash of 'name', with millisecond resolution.
+
+    >>> splay('minion1/disk', 60) == splay('minion1/disk', 60)
+    True
+    >>> 0 <= splay('minion1/disk', 60) < 60
+    True
+    '''
+    digest = int(hashlib.md5(name).hexdigest()[:15], 16)
+    return digest % int(interval * 1000) / 1000.0
+
+
 class IntervalScheduler(object):
     '''
-    Generate a sequence of regular interval sleep times.
+    Generate a sequence of regular interval deadlines.
+
+    Schedulers work with monotonic() deadlines: first(now) returns the
+    deadline of the first run and next(now) is called after each run to
+    return the deadline of the following one.  Interval deadlines sit on
+    a fixed grid, so the time a run takes doesn't delay the next one.
+    When a run ends after one or more later slots have passed, the
+    'missed' policy (see MISSED_POLICIES) decides what happens; overruns
+    and skipped slots are counted.
+
+    Without a phase the first run happens right away.  With a phase the
+    runs are aligned to the epoch so that they happen 'phase' seconds
+    into each interval, on every restart and on every host.
     '''
-    def __init__(self, interval):
+    def __init__(self, interval, phase=None, missed=DEFAULT_MISSED_POLICY):
         if interval < 1:
             raise ValueError('interval cannot be less than one second')
+        if missed not in MISSED_POLICIES:
+            raise ValueError('invalid missed run policy \'{}\''.format(missed))
         self.interval = interval
+        self.phase    = phase
+        self.missed   = missed
+        self.slot     = None
+        self.overruns = 0
+        self.skipped  = 0
+
+    def first(self, now, wall=None):
+        '''
+        Return the deadline of the first run.
+        '''
+        self.slot = now
+        if self.phase is not None:
+            if wall is None:
+                wall = time.time()
+            self.slot += (self.phase - wall) % self.interval
+        return self.slot
+
+    def next(self, now):
+        '''
+        Return the deadline of the next run; 'now' is when the last
+        run finished.
+        '''
+        self.slot += self.interval
+        if self.slot >= now:
+            return self.slot
+        self.overruns += 1
+        behind = int((now - self.slot) // self.interval) + 1
+        if self.missed == 'catch-up' and behind <= CATCHUP_LIMIT:
+            return self.slot
+        if self.missed == 'once':
+            # run the latest missed slot now
+            self.skipped += behind - 1
+            self.slot += (behind - 1) * self.interval
+            return now
+        self.skipped += behind
+        self.slot += behind * self.interval
+        return self.slot
+
+
+class AdaptiveScheduler(IntervalScheduler):
+    '''
+    An IntervalScheduler whose interval follows the task's results.
 
-    def next(self):
-        return self.interval
+    The task calls adapt() after each run.  While results stay stable,
+    see 'band', the interval grows by the 'backoff' factor up to
+    'max_interval'.  A run that raised an alert drops the interval to
+    'min_interval' for the next run.  A run whose result moved out of
+    the band brings a backed off interval back to the configured one.
+
+    >>> s = AdaptiveScheduler(60, 10, 300)
+    >>> for stable, alerted in [(True, False), (True, False), (True, False)]:
+    ...     s.adapt(stable, alerted)
+    >>> s.interval
+    300
+    >>> s.adapt(False, True); s.interval
+    10
+    '''
+    def __init__(self, interval, min_interval, max_interval,
+                 band=DEFAULT_BAND, backoff=DEFAULT_BACKOFF, phase=None,
+                 missed=DEFAULT_MISSED_POLICY):
+        IntervalScheduler.__init__(self, interval, phase, missed)
+        if not min_interval <= interval <= max_interval:
+            raise ValueError('interval must be between the adaptive min '
+                             'and max')
+        if min_interval < 1:
+            raise ValueError('interval cannot be less than one second')
+        if band < 0:
+            raise ValueError('adaptive band cannot be negative')
+        if backoff < 1:
+            raise ValueError('adaptive backoff cannot be less than one')
+        self.base         = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.band         = band
+        self.backoff      = backoff
+
+    def adapt(self, stable, alerted):
+        '''
+        Set the interval to the next slot from the outcome of a run.
+        '''
+        if alerted:
+            self.interval = self.min_interval
+        elif stable:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+        else:
+            self.interval = min(self.interval, self.base)
 
 
 class CronScheduler(object):
     '''
     Generate a sequence of sleep times based on the current time and
     the next specified event time.
+
+    The constraints are the output of CronParser.parse().  Each field is
+    compiled into a bitmask so the next event is found by jumping over
+    whole months, days, hours and minutes rather than by stepping
+    through time.  Fields that are finer than the finest given field
+    default to their first value, all other fields match everything,
+    e.g. {'hour': [3]} fires at 03:00:00 every day.  As in cron(8), if
+    both 'day' and 'weekday' are given an event fires when either
+    matches.
+
+    Event times are local wall clock times.  A time skipped by a
+    daylight saving change fires right after the change and a repeated
+    time only fires once.
+
+    >>> s = CronScheduler({'month': [2], 'day': [29], 'hour': [3], 'minute': [27]})
+    >>> s.next_fire(datetime.datetime(2013, 1, 1))
+    datetime.datetime(2016, 2, 29, 3, 27)
     '''
+    UNITS = ('month', 'day', 'hour', 'minute', 'second')
+
     def __init__(self, constraints):
         self.constraints = constraints
+        self.last = None
+        self._day_masks = {}
+        fields = {}
+        for key, values in constraints.iteritems():
+            fields.setdefault(key.rstrip('s'), set()).update(values)
+        if not fields:
+            raise ValueError('cron schedule is empty')
+
+        # units finer than the finest given unit default to their minimum
+        given = [unit for unit in self.UNITS
+                      if unit in fields or (unit == 'day' and 'weekday' in fields)]
+        finest = self.UNITS.index(given[-1])
+        for unit, minval in zip(self.UNITS, (1, 1, 0, 0, 0))[finest+1:]:
+            fields[unit] = [minval]
+
+        self.months  = _to_mask(fields.get('month'),  1, 12)
+        self.days    = _to_mask(fields.get('day'),    1, 31)
+        self.hours   = _to_mask(fields.get('hour'),   0, 23)
+        self.minutes = _to_mask(fields.get('minute'), 0, 59)
+        self.seconds = _to_mask(fields.get('second'), 0, 59)
+        if not self.seconds:
+            raise ValueError('cron seconds must be within [0,59]')
+
+        # weekday masks expressed as days of the month, indexed by the
+        # python weekday (monday=0) of the first of the month
+        weekdays = fields.get('weekday')
+        if weekdays:
+            # cron weekdays start with sunday=1
+            pydays = set((weekday + 5) % 7 for weekday in weekdays)
+            self.weekday_days = [_to_mask([day for day in range(1, 32)
+                                    if (first + day - 1) % 7 in pydays], 1, 31)
+                                 for first in range(7)]
+        else:
+            self.weekday_days = None
+        # either day or weekday may match when both are restricted
+        self.either_day = 'day' in fields and weekdays is not None
 
-    def next(self):
-        raise NotImplementedError('CronScheduler')
+        if self.weekday_days is None and not any(
+                self.months >> month & 1 and
+                _next_bit(self.days, 1) <= MAX_MONTH_DAYS[month]
+                for month in range(1, 13)):
+            raise ValueError('cron schedule never fires')
+
+    def first(self, now):
+        '''
+        Return the monotonic deadline of the first event; cron tasks
+        don't run at startup.
+        '''
+        return now + self.delay()
+
+    def next(self, now):
+        '''
+        Return the monotonic deadline of the next event.
+        '''
+        return now + self.delay()
+
+    def delay(self, now=None):
+        '''
+        Return the number of seconds to sleep until the next event;
+        'now' is the wall clock time.
+        '''
+        if now is None:
+            now = time.time()
+        wall = datetime.datetime.fromtimestamp(int(now))
+        after = wall
+        if self.last is not None and wall < self.last <= wall + DST_SHIFT:
+            # the clock went back; don't repeat events we already fired
+            after = self.last
+        fire = self.next_fire(after)
+        self.last = fire
+        timetuple = fire.timetuple()
+        target = time.mktime(timetuple)
+        if target < now:
+            # an ambiguous local time resolved to its earlier instant
+            later = time.mktime(timetuple[:8] + (0,))
+            if target < later <= target + DST_SHIFT.seconds:
+                target = later
+        return max(target - now, 0)
+
+    def next_fire(self, after):
+        '''
+        Return the first event time later than the naive datetime 'after'.
+        '''
+        year, month, day = after.year, after.month, after.day
+        hour, minute, second = after.hour, after.minute, after.second + 1
+        for carry in xrange(MAX_CARRIES):
+            found = _next_bit(self.months, month)
+            if found is None:
+                year, month, day, hour, minute, second = year+1, 1, 1, 0, 0, 0
+                continue
+            if found != month:
+                month, day, hour, minute, second = found, 1, 0, 0, 0
+
+            found = _next_bit(self._day_mask(year, month), day)
+            if found is None:
+                month, day, hour, minute, second = month+1, 1, 0, 0, 0
+                continue
+            if found != day:
+                day, hour, minute, second = found, 0, 0, 0
+
+            found = _next_bit(self.hours, hour)
+            if found is None:
+                day, hour, minute, second = day+1, 0, 0, 0
+                continue
+            if found != hour:
+                hour, minute, second = found, 0, 0
+
+            found = _next_bit(self.minutes, minute)
+            if found is None:
+                hour, minute, second = hour+1, 0, 0
+                continue
+            if found != minute:
+                minute, second = found, 0
+
+            found = _next_bit(self.seconds, second)
+            if found is None:
+                minute, second = minute+1, 0
+                continue
+            return datetime.datetime(year, month, day, hour, minute, found)
+        raise ValueError('cron schedule never fires: {}'.format(self.constraints))
+
+    def _day_mask(self, year, month):
+        '''
+        Return the bitmask of matching days in a month.
+        '''
+        days = self._day_masks.get((year, month))
+        if days is None:
+            first, ndays = calendar.monthrange(year, month)
+            if self.weekday_days is None:
+                days = self.days
+            elif self.either_day:
+                days = self.days | self.weekday_days[first]
+            else:
+                days = self.weekday_days[first]
+            days &= (2 << ndays) - 2
+            if len(self._day_masks) >= MAX_DAY_MASKS:
+                self._day_masks.clear()
+            self._day_masks[(year, month)] = days
+        return days
 
 
 class CronParser(object):
@@ -116,13 +448,27 @@ class CronParser(object):
             ''',
             re.VERBOSE)
 
-    def create_scheduler(self, schedule_type, cron_dict):
+    def create_scheduler(self, schedule_type, cron_dict, splay_name=None,
+                         missed=DEFAULT_MISSED_POLICY, adaptive=None):
         '''
-        Create a sleep time generator.
+        Create a deadline generator.  Interval schedulers get a phase
+        offset derived from 'splay_name' when one is given and handle
+        overruns with the 'missed' policy.  With an 'adaptive' dict of
+        AdaptiveScheduler arguments the interval adapts to the results.
         '''
         if schedule_type == 'interval':
-            result = IntervalScheduler(parse_interval(cron_dict))
+            interval = parse_interval(cron_dict)
+            phase = None
+            if splay_name is not None:
+                phase = splay(splay_name, interval)
+            if adaptive is not None:
+                result = AdaptiveScheduler(interval, phase=phase,
+                                           missed=missed, **adaptive)
+            else:
+                result = IntervalScheduler(interval, phase, missed)
         elif schedule_type == 'cron':
+            if adaptive is not None:
+                raise ValueError('adaptive schedules need an interval')
             result = CronScheduler(self.parse(cron_dict))
         else:
             raise ValueError('invalid schedule type \'{}\''.format(schedule_type))
@@ -164,7 +510,7 @@ class CronParser(object):
                 continue
             try:
                 if start_str == '*':
-                    start = 1
+                    start = minval
                     end = maxval
                 else:
                     start = self._to_number(start_str, enums, minval, maxval)
@@ -261,3 +607,37 @@ class CronParser(object):
             if incr is not None:
                 result += '/' + str(incr)
         return result
+
+
+def _to_mask(values, minval, maxval):
+    '''
+    Convert a list of numbers into a bitmask.  None selects every
+    number in [minval, maxval]; numbers outside it are dropped.
+
+    >>> bin(_to_mask([1, 3], 0, 7))
+    '0b1010'
+    >>> bin(_to_mask(None, 1, 3))
+    '0b1110'
+    '''
+    if values is None:
+        values = range(minval, maxval + 1)
+    result = 0
+    for value in values:
+        if minval <= value <= maxval:
+            result |= 1 << value
+    return result
+
+def _next_bit(mask, start):
+    '''
+    Return the position of the lowest set bit at or above 'start',
+    or None if there is none.
+
+    >>> _next_bit(0b10100, 3)
+    4
+    >>> _next_bit(0b10100, 5) is None
+    True
+    '''
+    mask >>= start
+    if not mask:
+        return None
+    return start + (mask & -mask).bit_length() - 1
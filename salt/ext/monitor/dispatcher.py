@@ -0,0 +1,299 @@
+'''
+Run monitor tasks from a single dispatcher and a bounded worker pool.
+
+The dispatcher keeps the next deadline of every task in a heap and
+sleeps until the earliest one is due.  Due tasks are handed to a fixed
+number of worker threads.  When a worker finishes a task it asks the
+task's scheduler for the next deadline and pushes the task back on the
+heap.  Deadlines are salt.ext.monitor.cron.monotonic() times.  Tasks
+can be added and removed while the dispatcher runs.
+
+Cron tasks firing on the same boundary get deadlines a few milliseconds
+apart.  Rather than waking up for each of them, the dispatcher hands
+out every task due within 'tolerance' seconds of the current time as
+one batch, in order of the tasks' 'priority' attribute (highest first,
+0 by default), so runs within one tick start together.
+
+Tasks with a 'timeout' attribute are watched by the dispatcher.  A run
+that takes longer is abandoned: a new worker replaces the one stuck in
+it, the task is rescheduled and its timed_out() method is called.
+Python threads can't be killed, so until the abandoned run returns the
+task's later runs are skipped and count as timeouts too.
+
+Use:
+    import salt.ext.monitor.dispatcher
+    dispatcher = salt.ext.monitor.dispatcher.Dispatcher(tasks, workers=4)
+    dispatcher.start()      # blocks until dispatcher.stop() is called
+'''
+
+# Import python modules
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import Queue
+import select
+import threading
+
+# Import salt libs
+import salt.ext.monitor.cron
+import salt.ext.monitor.stats
+import salt.log
+
+log = salt.log.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_TOLERANCE = 0.05
+
+class Dispatcher(object):
+    '''
+    Schedule monitor tasks by deadline and run them on worker threads.
+    '''
+    def __init__(self, tasks=(), workers=DEFAULT_WORKERS,
+                 tolerance=DEFAULT_TOLERANCE):
+        if workers < 1:
+            raise ValueError('monitor.workers cannot be less than one')
+        if tolerance < 0:
+            raise ValueError('monitor.wakeup_tolerance cannot be negative')
+        self.workers  = workers
+        self.tolerance = tolerance
+        self.wakeups  = 0
+        self._tasks   = set()
+        self._heap    = []
+        self._seq     = itertools.count()
+        self._lock    = threading.Lock()
+        self._queue   = Queue.Queue()
+        self._running = False
+        self._deferred = collections.deque()
+        # task -> monotonic time its current run times out
+        self._inflight = {}
+        # tasks whose abandoned run hasn't returned yet
+        self._hung    = set()
+        self._names   = itertools.count()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        for task in tasks:
+            self.add(task)
+
+    def add(self, task, deadline=None):
+        '''
+        Schedule a task to run at the monotonic 'deadline'.  Without a
+        deadline the task's scheduler decides when it first runs.
+        '''
+        if deadline is None:
+            deadline = salt.ext.monitor.cron.monotonic()
+            if task.scheduler is not None:
+                try:
+                    deadline = task.scheduler.first(deadline)
+                except Exception, ex:
+                    log.error("can't schedule %s: %s", task.taskid, ex,
+                              exc_info=ex)
+                    return
+        with self._lock:
+            self._tasks.add(task)
+        self._push(task, deadline)
+
+    def remove(self, task):
+        '''
+        Stop scheduling a task.  A run already in progress completes.
+        '''
+        with self._lock:
+            self._tasks.discard(task)
+
+    def defer(self, func):
+        '''
+        Call func() on the dispatcher thread.  Safe to call from any
+        thread or from a signal handler.
+        '''
+        self._deferred.append(func)
+        self._wakeup()
+
+    def _push(self, task, deadline):
+        '''
+        Put a task on the heap unless it has been removed.
+        '''
+        with self._lock:
+            if task not in self._tasks:
+                return
+            heapq.heappush(self._heap, (deadline, next(self._seq), task))
+            earliest = self._heap[0][2] is task
+        if earliest:
+            self._wakeup()
+
+    def start(self):
+        '''
+        Start the workers and dispatch tasks until stop() is called.
+        '''
+        log.debug('starting dispatcher with {} worker{}'.format(
+                   self.workers,
+                   '' if self.workers == 1 else 's'))
+        self._running = True
+        for num in range(self.workers):
+            self._start_worker()
+        try:
+            self._dispatch()
+        finally:
+            self._running = False
+            for num in range(self.workers):
+                self._queue.put(None)
+
+    def _start_worker(self, timed_out=None):
+        '''
+        Start a worker thread, telling it about the task whose run the
+        worker it replaces was stuck in.
+        '''
+        thread = threading.Thread(target=self._work, args=(timed_out,),
+                    name='monitor-worker-{}'.format(next(self._names)))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        '''
+        Ask the dispatcher loop to exit.  Safe to call from any thread
+        or from a signal handler.
+        '''
+        self._running = False
+        self._wakeup()
+
+    def _wakeup(self):
+        '''
+        Interrupt the dispatcher's sleep so it re-examines the heap.
+        '''
+        try:
+            os.write(self._wakeup_w, '\0')
+        except OSError, ex:
+            # a full pipe means a wakeup is already pending
+            if ex.errno != errno.EAGAIN:
+                raise
+
+    def _dispatch(self):
+        '''
+        Hand every task due within the tolerance to the workers and
+        abandon runs that timed out, then sleep until the next deadline
+        or timeout or until add()/stop() wakes us up.
+        '''
+        while self._running:
+            while self._deferred:
+                func = self._deferred.popleft()
+                try:
+                    func()
+                except Exception, ex:
+                    log.error('deferred call failed: %s', ex, exc_info=ex)
+            now = salt.ext.monitor.cron.monotonic()
+            due = []
+            with self._lock:
+                while self._heap and \
+                        self._heap[0][0] <= now + self.tolerance:
+                    deadline, seq, task = heapq.heappop(self._heap)
+                    if task in self._tasks:
+                        due.append((task, deadline))
+                expired = [task for task, expires in self._inflight.iteritems()
+                           if expires <= now]
+                for task in expired:
+                    del self._inflight[task]
+                    self._hung.add(task)
+                wakeups = self._inflight.values()
+                if self._heap:
+                    wakeups.append(self._heap[0][0])
+                timeout = max(0, min(wakeups) - now) if wakeups else None
+            due.sort(key=by_priority)
+            for item in due:
+                self._queue.put(item)
+            for task in expired:
+                log.warning('%s: abandoning run after %s seconds',
+                            task.taskid, task.timeout)
+                self._start_worker(task)
+                self._reschedule(task)
+            try:
+                readable = select.select([self._wakeup_r], [], [], timeout)[0]
+            except select.error, ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+                continue
+            self.wakeups += 1
+            if readable:
+                try:
+                    os.read(self._wakeup_r, 4096)
+                except OSError, ex:
+                    if ex.errno != errno.EAGAIN:
+                        raise
+
+    def _work(self, timed_out=None):
+        '''
+        Worker thread: run due tasks and put them back on the heap.
+        '''
+        if timed_out is not None:
+            self._timed_out(timed_out)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            task, deadline = item
+            timeout = getattr(task, 'timeout', None)
+            with self._lock:
+                hung = task in self._hung
+                if timeout and not hung:
+                    self._inflight[task] = \
+                        salt.ext.monitor.cron.monotonic() + timeout
+            if hung:
+                log.warning('%s: skipping run, the last one is still stuck',
+                            task.taskid)
+                self._timed_out(task)
+                self._reschedule(task)
+                continue
+            if timeout:
+                self._wakeup()
+            # batched tasks may start up to the tolerance early
+            lag = max(0, salt.ext.monitor.cron.monotonic() - deadline)
+            salt.ext.monitor.stats.dispatcher_lag.add(lag)
+            try:
+                task.run(lag)
+            except Exception, ex:
+                log.error("can't run %s: %s", task.taskid, ex, exc_info=ex)
+            with self._lock:
+                abandoned = task in self._hung
+                self._hung.discard(task)
+                self._inflight.pop(task, None)
+            if abandoned:
+                # the task was rescheduled and this worker replaced
+                log.warning('%s: abandoned run returned', task.taskid)
+                break
+            self._reschedule(task)
+
+    def _timed_out(self, task):
+        '''
+        Tell a task one of its runs timed out.
+        '''
+        try:
+            task.timed_out()
+        except Exception, ex:
+            log.error("can't report timeout of %s: %s", task.taskid, ex,
+                      exc_info=ex)
+
+    def _reschedule(self, task):
+        '''
+        Push a task back on the heap at its scheduler's next deadline.
+        '''
+        if task.scheduler is None:
+            log.debug('task finished: %s', task.taskid)
+            return
+        now = salt.ext.monitor.cron.monotonic()
+        try:
+            deadline = task.scheduler.next(now)
+        except Exception, ex:
+            log.error("can't schedule %s: %s", task.taskid, ex, exc_info=ex)
+            return
+        log.trace('%s: next run in %s seconds', task.taskid, deadline - now)
+        self._push(task, deadline)
+
+def by_priority(item):
+    '''
+    Sort key of a batch of (task, deadline): highest priority first,
+    then earliest deadline.
+    '''
+    task, deadline = item
+    return -getattr(task, 'priority', 0), deadline
@@ -0,0 +1,476 @@
+'''
+Run monitor tasks from an asyncio event loop.
+
+This is the 'asyncio' monitor engine, an alternative to the thread
+based salt.ext.monitor.dispatcher.  Every scheduled task is a timer on
+a single event loop, so idle tasks cost one timer handle each and no
+thread.  The loop comes from trollius, the asyncio backport for python
+2.
+
+Salt functions block, and a task's conditions may call any of them, so
+due tasks run in an executor of 'workers' threads.  Alerts are sent
+from the loop itself: the alert clients hand their outboxes to
+AlertOutbox, which talks to the alert master over the non-blocking
+zeromq socket while the loop watches the socket's file descriptor, see
+salt.ext.monitor.client.use_driver().  Only logging in to the alert
+master, a blocking salt call, goes through the executor.  Tasks hand
+their results to the collectors without blocking as well; the mongo
+and localfile collectors queue them for their own writer, since
+neither pymongo nor file writes can be done without blocking.
+
+Tasks due within 'tolerance' seconds of each other share one timer and
+are handed to the executor together, by priority, as with the thread
+engine.
+
+Runs of tasks with a 'timeout' attribute are abandoned when they take
+longer, as with the thread engine: a new thread replaces the executor
+thread stuck in the run, and until the run returns the task's later
+runs are skipped and count as timeouts.  Reporting a timeout only
+queues the alert, so it is done on the loop.
+
+Use:
+    import salt.ext.monitor.eventloop
+    dispatcher = salt.ext.monitor.eventloop.EventLoopDispatcher(tasks, 4)
+    salt.ext.monitor.client.use_driver(dispatcher.alert_outbox)
+    dispatcher.start()      # blocks until dispatcher.stop() is called
+'''
+
+# Import python modules
+import functools
+import itertools
+import Queue
+import threading
+
+try:
+    import concurrent.futures
+    import trollius
+    from trollius import From
+except ImportError:
+    trollius = None
+
+# Import salt libs
+import salt.crypt
+import salt.exceptions
+import salt.ext.monitor.cron
+import salt.ext.monitor.dispatcher
+import salt.ext.monitor.stats
+import salt.log
+
+# Import zeromq libs
+import zmq
+
+log = salt.log.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+class EventLoopDispatcher(object):
+    '''
+    Schedule monitor tasks as event loop timers and run them in an
+    executor.  Has the same interface as Dispatcher.
+    '''
+    def __init__(self, tasks=(), workers=DEFAULT_WORKERS,
+                 tolerance=salt.ext.monitor.dispatcher.DEFAULT_TOLERANCE):
+        if trollius is None:
+            raise ValueError('the asyncio monitor engine needs trollius')
+        if workers < 1:
+            raise ValueError('monitor.workers cannot be less than one')
+        if tolerance < 0:
+            raise ValueError('monitor.wakeup_tolerance cannot be negative')
+        self.workers   = workers
+        self.tolerance = tolerance
+        self.wakeups   = 0
+        self._tasks    = set()
+        # slot -> [(task, deadline), ...] sharing the timer of the first
+        self._batches  = {}
+        # tasks whose abandoned run hasn't returned yet
+        self._hung     = set()
+        self._loop     = trollius.new_event_loop()
+        self._executor = _Executor(workers)
+        for task in tasks:
+            self.add(task)
+
+    def add(self, task, deadline=None):
+        '''
+        Schedule a task to run at the monotonic 'deadline'.  Without a
+        deadline the task's scheduler decides when it first runs.
+        '''
+        if deadline is None:
+            deadline = salt.ext.monitor.cron.monotonic()
+            if task.scheduler is not None:
+                try:
+                    deadline = task.scheduler.first(deadline)
+                except Exception, ex:
+                    log.error("can't schedule %s: %s", task.taskid, ex,
+                              exc_info=ex)
+                    return
+        self._tasks.add(task)
+        self._loop.call_soon_threadsafe(self._schedule, task, deadline)
+
+    def remove(self, task):
+        '''
+        Stop scheduling a task.  A run already in progress completes.
+        '''
+        self._tasks.discard(task)
+
+    def defer(self, func):
+        '''
+        Call func() on the event loop.  Safe to call from any thread or
+        from a signal handler.
+        '''
+        self._loop.call_soon_threadsafe(self._call, func)
+
+    def alert_outbox(self, client):
+        '''
+        Return an AlertOutbox sending the alerts of 'client' from the
+        event loop, see salt.ext.monitor.client.use_driver().
+        '''
+        return AlertOutbox(client, self._loop, self._executor)
+
+    def start(self):
+        '''
+        Run the event loop until stop() is called.
+        '''
+        log.debug('starting asyncio dispatcher with {} worker{}'.format(
+                   self.workers,
+                   '' if self.workers == 1 else 's'))
+        trollius.set_event_loop(self._loop)
+        # the executor threads are daemons and outlive the loop, since
+        # closing the alert outboxes at exit may need them to log in
+        self._loop.run_forever()
+
+    def stop(self):
+        '''
+        Ask the event loop to exit.  Safe to call from any thread or
+        from a signal handler.
+        '''
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _call(self, func):
+        try:
+            func()
+        except Exception, ex:
+            log.error('deferred call failed: %s', ex, exc_info=ex)
+
+    def _schedule(self, task, deadline):
+        '''
+        Add a task to the batch due within the tolerance of its
+        deadline, or set the timer of a new batch, unless the task has
+        been removed.
+        '''
+        if task not in self._tasks:
+            return
+        if self.tolerance:
+            slot = int(deadline // self.tolerance)
+            slots = (slot - 1, slot)
+        else:
+            slot = deadline
+            slots = (slot,)
+        for key in slots:
+            batch = self._batches.get(key)
+            if batch is not None and deadline - batch[0][1] <= self.tolerance:
+                batch.append((task, deadline))
+                return
+        self._batches[slot] = [(task, deadline)]
+        delay = max(0, deadline - salt.ext.monitor.cron.monotonic())
+        self._loop.call_later(delay, self._due_batch, slot)
+
+    def _due_batch(self, slot):
+        '''
+        Timer callback: hand a batch of due tasks to the executor.
+        '''
+        self.wakeups += 1
+        batch = self._batches.pop(slot)
+        batch.sort(key=salt.ext.monitor.dispatcher.by_priority)
+        for task, deadline in batch:
+            self._due(task, deadline)
+
+    def _due(self, task, deadline):
+        '''
+        Hand a due task to the executor.
+        '''
+        if task not in self._tasks:
+            return
+        if task in self._hung:
+            log.warning('%s: skipping run, the last one is still stuck',
+                        task.taskid)
+            self._timed_out(task)
+            self._reschedule(task)
+            return
+        # batched tasks may start up to the tolerance early
+        lag = max(0, salt.ext.monitor.cron.monotonic() - deadline)
+        salt.ext.monitor.stats.dispatcher_lag.add(lag)
+        run = self._executor.submit(task.run, lag)
+        future = trollius.wrap_future(run, loop=self._loop)
+        future.add_done_callback(functools.partial(self._done, task))
+        timeout = getattr(task, 'timeout', None)
+        if timeout:
+            self._loop.call_later(timeout, self._expire, task, run)
+
+    def _expire(self, task, run):
+        '''
+        Timeout callback: abandon the run if it is still going.
+        '''
+        if not self._executor.abandon(run):
+            return
+        log.warning('%s: abandoning run after %s seconds',
+                    task.taskid, task.timeout)
+        self._hung.add(task)
+        self._timed_out(task)
+        self._reschedule(task)
+
+    def _timed_out(self, task):
+        '''
+        Tell a task one of its runs timed out.
+        '''
+        try:
+            task.timed_out()
+        except Exception, ex:
+            log.error("can't report timeout of %s: %s", task.taskid, ex,
+                      exc_info=ex)
+
+    def _done(self, task, future):
+        '''
+        Executor callback: log failures and set the task's next timer.
+        '''
+        ex = future.exception()
+        if ex is not None:
+            log.error("can't run %s: %s", task.taskid, ex, exc_info=ex)
+        if task in self._hung:
+            # the task was rescheduled when the run was abandoned
+            log.warning('%s: abandoned run returned', task.taskid)
+            self._hung.discard(task)
+            return
+        self._reschedule(task)
+
+    def _reschedule(self, task):
+        '''
+        Set the timer of a task at its scheduler's next deadline.
+        '''
+        if task.scheduler is None:
+            log.debug('task finished: %s', task.taskid)
+            return
+        now = salt.ext.monitor.cron.monotonic()
+        try:
+            deadline = task.scheduler.next(now)
+        except Exception, ex:
+            log.error("can't schedule %s: %s", task.taskid, ex, exc_info=ex)
+            return
+        log.trace('%s: next run in %s seconds', task.taskid, deadline - now)
+        self._schedule(task, deadline)
+
+if trollius is not None:
+    _ExecutorBase = concurrent.futures.Executor
+else:
+    _ExecutorBase = object
+
+class _Executor(_ExecutorBase):
+    '''
+    Run calls on a fixed number of threads.  abandon() replaces the
+    thread stuck in a call with a new one; the stuck thread exits once
+    the call returns.
+    '''
+    def __init__(self, workers):
+        self._queue     = Queue.Queue()
+        self._lock      = threading.Lock()
+        self._abandoned = set()
+        self._names     = itertools.count()
+        for num in range(workers):
+            self._start()
+
+    def _start(self):
+        thread = threading.Thread(target=self._work,
+                    name='monitor-loop-worker-{}'.format(next(self._names)))
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def abandon(self, future):
+        '''
+        Give up on the call of 'future' and start a thread in place of
+        the one running it.  Returns False if the call already returned.
+        '''
+        with self._lock:
+            if future.done():
+                return False
+            self._abandoned.add(future)
+        self._start()
+        return True
+
+    def _work(self):
+        while True:
+            future, func, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result, error = func(*args, **kwargs), None
+            except BaseException, ex:
+                result, error = None, ex
+            with self._lock:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+                abandoned = future in self._abandoned
+                self._abandoned.discard(future)
+            if abandoned:
+                # abandon() started a thread in place of this one
+                break
+
+class _Timeout(Exception):
+    '''
+    The alert master didn't answer in time.
+    '''
+
+class AlertOutbox(object):
+    '''
+    Send the alerts queued on an AlertClient from the event loop.  Works
+    like the client's outbox thread: the socket waits, the retry backoff
+    and the client's counters are the same, but waiting is done by the
+    loop, so a slow alert master holds up nothing but its own alerts.
+    '''
+    def __init__(self, client, loop, executor):
+        self.client   = client
+        self.loop     = loop
+        self.executor = executor
+        self._queued  = trollius.Event(loop=loop)
+        # set once close() was called and the outbox is empty
+        self._closed  = threading.Event()
+        loop.call_soon_threadsafe(self._start)
+
+    def wake(self):
+        '''
+        Tell the outbox alerts were queued.  Safe to call from any
+        thread.
+        '''
+        self.loop.call_soon_threadsafe(self._queued.set)
+
+    def close(self, timeout):
+        '''
+        Wait up to 'timeout' seconds for the queued alerts to be sent,
+        running the loop if it was stopped.
+        '''
+        if self.loop.is_running():
+            self._closed.wait(timeout)
+        elif not self.loop.is_closed():
+            deadline = self.loop.time() + timeout
+            while not self._closed.is_set() and self.loop.time() < deadline:
+                self.loop.run_until_complete(trollius.sleep(0.05,
+                                                            loop=self.loop))
+
+    def _start(self):
+        task = trollius.ensure_future(self._run(), loop=self.loop)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error('alert outbox failed: %s', task.exception(),
+                      exc_info=task.exception())
+        self._closed.set()
+
+    def _run(self):
+        '''
+        Send queued alerts until the client is closed.
+        '''
+        client = self.client
+        while True:
+            alerts = client._next_alerts(block=False)
+            if alerts is None:
+                break
+            if alerts:
+                yield From(self._deliver(alerts))
+                continue
+            # wake() sets the event from the loop, so a wake() after
+            # the check above can't be lost
+            self._queued.clear()
+            yield From(self._queued.wait())
+
+    def _deliver(self, alerts):
+        '''
+        Send alerts, retrying with backoff while the alert master is
+        unreachable.  Other errors drop the alerts.
+        '''
+        client = self.client
+        for load, count in client._loads(alerts):
+            backoff = min(0.5, client.max_backoff)
+            while True:
+                try:
+                    yield From(self._request(load))
+                    client._count('sent', count)
+                    break
+                except (zmq.ZMQError, _Timeout), ex:
+                    client._close_socket()
+                    client._count('retries')
+                    log.warning('alert master %s unreachable, retry in '
+                                '%.1fs: %s', client.opts['master_uri'],
+                                backoff, ex)
+                    yield From(trollius.sleep(backoff, loop=self.loop))
+                    backoff = min(backoff * 2, client.max_backoff)
+                except Exception, ex:
+                    client._close_socket()
+                    client._count('failed', count)
+                    log.error("can't send %d alerts to %s: %s", count,
+                              client.opts['master_uri'], ex, exc_info=ex)
+                    break
+
+    def _request(self, load):
+        '''
+        Send a load, logging in again if the alert master rotated its
+        AES key.
+        '''
+        client = self.client
+        if client.auth is None:
+            client.auth = yield From(self._login())
+        try:
+            yield From(self._send(load))
+        except salt.exceptions.AuthenticationError:
+            client.auth = yield From(self._login())
+            yield From(self._send(load))
+
+    def _login(self):
+        '''
+        Log in to the alert master on an executor thread.
+        '''
+        return self.loop.run_in_executor(self.executor, salt.crypt.SAuth,
+                                         self.client.opts)
+
+    def _send(self, load):
+        '''
+        Encrypt the load, send it and decrypt the reply, waiting at most
+        the client's timeout for each step.
+        '''
+        client = self.client
+        socket = client._get_socket()
+        payload = client._payload(load)
+        yield From(self._ready(socket, zmq.POLLOUT, 'send timed out'))
+        socket.send_pyobj(payload, zmq.NOBLOCK)
+        message = 'no reply in {} seconds'.format(client.timeout)
+        yield From(self._ready(socket, zmq.POLLIN, message))
+        client.auth.crypticle.loads(socket.recv_pyobj(zmq.NOBLOCK))
+
+    def _ready(self, socket, event, message):
+        '''
+        Wait until the socket has 'event', zmq.POLLOUT or zmq.POLLIN.
+        The socket's file descriptor only says its events may have
+        changed, so they are checked again after every wakeup.
+        '''
+        deadline = self.loop.time() + self.client.timeout
+        fd = socket.getsockopt(zmq.FD)
+        while not socket.getsockopt(zmq.EVENTS) & event:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                raise _Timeout(message)
+            changed = trollius.Future(loop=self.loop)
+            self.loop.add_reader(fd, _set_done, changed)
+            try:
+                yield From(trollius.wait([changed], timeout=remaining,
+                                         loop=self.loop))
+            finally:
+                self.loop.remove_reader(fd)
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
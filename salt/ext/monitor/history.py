@@ -0,0 +1,164 @@
+'''
+The recent results of a monitor task, for its conditions.
+
+A task whose conditions use 'history', 'rate', 'delta' or 'avg' keeps
+its last results, up to 'monitor.history' of them (10 by default, or
+the task's 'history: <number>'), with the monotonic time each was
+taken.  While the conditions run, 'history' holds the previous results
+and the current one is kept apart, so:
+
+    history[-1]          = the previous result
+    len(history)         = the number of previous results
+    delta(key)           = the current value minus the previous one
+    rate(key)            = delta(key) per second
+    avg(n, key)          = the mean of the last n values, current included
+    history.last(n, key) = the last n values, oldest first
+
+where 'key' picks a number out of a result: None for the result itself,
+a dotted path of dict keys and list indexes such as 'eth0.bytes_sent',
+or a function of the result.  The helpers return None when there is no
+previous value, so a condition like 'rate("bytes_sent") > 1e6' is
+simply false on the first run.
+
+Use:
+    import salt.ext.monitor.history
+    history = salt.ext.monitor.history.History(10)
+    history.begin(result)       # before the conditions run
+    history.end(result)         # after the run, keeps the result
+'''
+
+# Import python modules
+import collections
+
+# Import salt libs
+import salt.ext.monitor.cron
+
+DEFAULT_SIZE = 10
+
+# The names the generated code sees, see History.names()
+NAMES = ('history', 'rate', 'delta', 'avg')
+
+class History(object):
+    '''
+    A bounded ring of (time, result) samples, oldest first.
+    '''
+    def __init__(self, size=DEFAULT_SIZE):
+        self.samples = collections.deque(maxlen=size)
+        self.current = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        return self.samples[index][1]
+
+    def __iter__(self):
+        return (result for when, result in self.samples)
+
+    def names(self):
+        '''
+        Return the helpers to put in a task's namespace.
+        '''
+        return {'history': self, 'rate': self.rate, 'delta': self.delta,
+                'avg': self.avg}
+
+    def begin(self, result, when=None):
+        '''
+        Make 'result', taken at monotonic time 'when', the current one.
+        '''
+        if when is None:
+            when = salt.ext.monitor.cron.monotonic()
+        self.current = (when, result)
+
+    def end(self, result, when=None):
+        '''
+        Keep 'result' at the time given to begin() or 'when', dropping
+        the oldest result when full.
+        '''
+        if when is None:
+            if self.current is not None:
+                when = self.current[0]
+            else:
+                when = salt.ext.monitor.cron.monotonic()
+        self.samples.append((when, result))
+        self.current = None
+
+    def last(self, num, key=None):
+        '''
+        Return the last 'num' values of 'key', the current one included,
+        oldest first.  Results without the key are left out.
+        '''
+        samples = list(self.samples)
+        if self.current is not None:
+            samples.append(self.current)
+        values = (_lookup(result, key) for when, result in samples[-num:])
+        return [value for value in values if value is not None]
+
+    def delta(self, key=None):
+        '''
+        Return the current value of 'key' minus the previous one.
+        '''
+        pair = self._pair(key)
+        if pair is None:
+            return None
+        (then, old), (now, new) = pair
+        return new - old
+
+    def rate(self, key=None):
+        '''
+        Return the change of 'key' per second since the previous result.
+        '''
+        pair = self._pair(key)
+        if pair is None:
+            return None
+        (then, old), (now, new) = pair
+        if now <= then:
+            return None
+        return (new - old) / float(now - then)
+
+    def avg(self, num, key=None):
+        '''
+        Return the mean of the last 'num' values of 'key'.
+        '''
+        values = self.last(num, key)
+        if not values:
+            return None
+        return sum(values) / float(len(values))
+
+    def _pair(self, key):
+        '''
+        Return ((time, value), (time, value)) of the previous and the
+        current result, or None if either is missing.
+        '''
+        if not self.samples or self.current is None:
+            return None
+        then, old = self.samples[-1]
+        now, new = self.current
+        old, new = _lookup(old, key), _lookup(new, key)
+        if old is None or new is None:
+            return None
+        return (then, old), (now, new)
+
+def _lookup(result, key):
+    '''
+    Return the value 'key' picks out of 'result', or None.
+
+    >>> _lookup({'eth0': {'bytes': [5, 7]}}, 'eth0.bytes.1')
+    7
+    >>> _lookup({'eth0': {}}, 'eth0.bytes') is None
+    True
+    '''
+    if key is None:
+        return result
+    if callable(key):
+        return key(result)
+    value = result
+    for name in str(key).split('.'):
+        try:
+            if isinstance(value, (list, tuple)):
+                value = value[int(name)]
+            else:
+                value = value[name]
+        except (KeyError, IndexError, ValueError, TypeError):
+            return None
+    return value
@@ -1,14 +1,21 @@
 
-import threading
-
 import salt.config
+import salt.ext.monitor.client
+import salt.ext.monitor.dispatcher
+import salt.ext.monitor.eventloop
 import salt.ext.monitor.loader
 import salt.ext.monitor.parsers
+import salt.ext.monitor.process
+import salt.ext.monitor.stats
 import salt.log
 import salt.minion
 
 log = salt.log.getLogger(__name__)
 
+# The classes that schedule and run tasks, by 'monitor.engine'
+ENGINES = {'threads': salt.ext.monitor.dispatcher.Dispatcher,
+           'asyncio': salt.ext.monitor.eventloop.EventLoopDispatcher}
+
 class Monitor(salt.minion.SMinion):
     '''
     The monitor daemon.
@@ -16,19 +23,124 @@ class Monitor(salt.minion.SMinion):
     def __init__(self, opts):
         salt.minion.SMinion.__init__(self, opts)
         self.collectors = salt.ext.monitor.loader.collectors(opts)
+        salt.ext.monitor.process.configure(self.opts)
+        self.tasks = self._parse()
+        workers = self.opts.get('monitor.workers',
+                         salt.ext.monitor.dispatcher.DEFAULT_WORKERS)
+        engine = self.opts.get('monitor.engine', 'threads')
+        if engine not in ENGINES:
+            raise ValueError('unknown monitor.engine: {}'.format(engine))
+        tolerance = self.opts.get('monitor.wakeup_tolerance',
+                         salt.ext.monitor.dispatcher.DEFAULT_TOLERANCE)
+        self.dispatcher = ENGINES[engine](workers=workers, tolerance=tolerance)
+        if engine == 'asyncio':
+            # send alerts from the event loop rather than outbox threads
+            salt.ext.monitor.client.use_driver(self.dispatcher.alert_outbox)
+        salt.ext.monitor.stats.register(self)
+
+    def _parse(self):
+        '''
+        Build the monitor tasks from the 'monitor' configuration.
+        '''
         if 'monitor' in self.opts:
             parser = salt.ext.monitor.parsers.get_parser(self)
-            self.tasks = parser.parse()
-        else:
-            log.warning('monitor not configured in /etc/salt/monitor')
-            self.tasks = []
+            return parser.parse()
+        log.warning('monitor not configured in /etc/salt/monitor')
+        return []
 
     def start(self):
         log.debug('starting monitor with {} task{}'.format(
                    len(self.tasks),
                    '' if len(self.tasks) == 1 else 's'))
         if self.tasks:
+            # fork the process executor's children while this is the only
+            # thread, and after salt-monitor -d daemonized, so they are
+            # children of the daemon; see salt.ext.monitor.process
             for task in self.tasks:
-                threading.Thread(target=task.run).start()
+                if task.options.get('executor') == 'process':
+                    salt.ext.monitor.process.start(task.context)
+                    break
+            for task in self.tasks:
+                self.dispatcher.add(task)
+            self.dispatcher.start()
         else:
             log.error('no monitor tasks to run')
+
+    def request_reload(self, load_opts):
+        '''
+        Reload the configuration returned by load_opts() on the
+        dispatcher thread.  Safe to call from a signal handler.
+        '''
+        self.dispatcher.defer(lambda: self.reload(load_opts()))
+
+    def request_stats(self):
+        '''
+        Write the task statistics to the log from the dispatcher thread.
+        Safe to call from a signal handler.
+        '''
+        self.dispatcher.defer(self.log_stats)
+
+    def log_stats(self):
+        '''
+        Write the task statistics to the log.
+        '''
+        # logged as warnings so they show up at the default log level
+        stats = salt.ext.monitor.stats.report()
+        for line in salt.ext.monitor.stats.format_report(stats):
+            log.warning('stats %s', line)
+
+    def alert_stats(self):
+        '''
+        Return the outbox counters of the alert clients of this process.
+        '''
+        return salt.ext.monitor.client.stats()
+
+    def reload(self, opts):
+        '''
+        Apply the 'monitor*' settings in opts to the running monitor.
+        Tasks whose id and configuration are unchanged keep running on
+        their current schedule; only added and changed tasks are built
+        and scheduled, and removed tasks are stopped.  Salt modules and
+        collectors are not reloaded.
+        '''
+        old_settings = _monitor_settings(self.opts)
+        for key in old_settings:
+            if key not in opts:
+                del self.opts[key]
+        self.opts.update(_monitor_settings(opts))
+        self.opts.pop('monitor', None)
+        if 'monitor' in opts:
+            self.opts['monitor'] = opts['monitor']
+        tasks = self._parse()
+
+        running = {}
+        if _monitor_settings(self.opts) == old_settings:
+            for task in self.tasks:
+                running.setdefault((task.taskid, task.key), []).append(task)
+        else:
+            log.info('monitor settings changed, rescheduling every task')
+        result = []
+        added = 0
+        for task in tasks:
+            same = running.get((task.taskid, task.key))
+            if same:
+                result.append(same.pop())
+            else:
+                result.append(task)
+                self.dispatcher.add(task)
+                added += 1
+        kept = len(result) - added
+        current = set(result)
+        for task in self.tasks:
+            if task not in current:
+                self.dispatcher.remove(task)
+        log.info('reloaded monitor: {} added or changed, {} removed, '
+                 '{} unchanged'.format(added, len(self.tasks) - kept, kept))
+        self.tasks = result
+
+def _monitor_settings(opts):
+    '''
+    Return the monitor settings other than the task list itself.
+    '''
+    return dict((key, value) for key, value in opts.iteritems()
+                if key.startswith('monitor.'))
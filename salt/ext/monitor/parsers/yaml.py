@@ -39,6 +39,64 @@ The configuration is expressed in YAML and must conform to this syntax:
         minute: <number>
         second: <number>
 
+      # spread interval runs over the interval, overriding monitor.splay
+      splay: <boolean>
+
+      # let the 'every' interval follow the results: true, or a dict
+      # with any of these keys
+      adaptive:
+        min:     <interval>  # the interval after an alert (the 'every'
+                             # interval by default)
+        max:     <interval>  # the longest interval (8 times 'every' by
+                             # default)
+        band:    <number>    # stable if no number moved by more than this
+                             # fraction of its value when the stable
+                             # stretch began (0.05)
+        backoff: <number>    # stable runs multiply the interval by this (2)
+
+      # what to do when a run overruns later slots, overriding
+      # monitor.missed: skip, once, or catch-up
+      missed: <policy>
+
+      # collect every result (always, the default) or only results
+      # that differ from the last one collected (on-change), overriding
+      # monitor.collect
+      collect: <mode>
+
+      # with 'collect: on-change', still collect an unchanged result
+      # every <number> runs, overriding monitor.heartbeat
+      heartbeat: <number>
+
+      # share the command's result with other tasks running the same
+      # command: true (the default, for monitor.coalesce_ttl seconds),
+      # false, or a number of seconds
+      coalesce: <boolean-or-number>
+
+      # run the command and conditions in a monitor thread (the
+      # default) or in the pool of worker processes
+      executor: <thread-or-process>
+
+      # abandon (thread) or kill (process) runs that take longer than
+      # <number> seconds, overriding monitor.timeout, or false to let
+      # runs take as long as they need
+      timeout: <number-or-false>
+
+      # collect per-window statistics of the numeric results instead of
+      # every result: false or a window of <number> seconds, overriding
+      # monitor.rollup
+      rollup: <boolean-or-number>
+
+      # with 'rollup', also collect every result, overriding
+      # monitor.rollup_raw
+      raw: <boolean>
+
+      # among tasks due at the same time, higher priorities start first
+      priority: <number>
+
+      # the number of previous results the conditions can see, see
+      # below; overrides monitor.history
+      history: <number>
+
       # execute command at precise date and time
       at:
         month:   <cronlist> # [1-12] or 'jan'-'dec' or 'january'-'december'
@@ -81,6 +139,7 @@ where:
     salt-command = a shell-like commands line of the command and arguments
     salt-commands = salt commands on separate lines and prefixed with '-'
     number = a integer or floating point number
+    interval = a number of seconds or a dict like the 'every' dict
     key = an arbitrary python identifier used when iterating over the
             dict returned by the salt command
     value = an arbitrary python identifier used when iterating over the
@@ -96,6 +155,96 @@ where:
                abbreviation (mon); names are automatically lowercased.
                Use whitespace and/or commas to separate items.
 
+An 'at' schedule fires on the local time that matches every given
+field.  Fields finer than the finest given field default to their first
+value and the rest match anything, so 'hour: 3' fires daily at 03:00:00
+and 'minute: */15' fires at :00:00, :15:00, :30:00 and :45:00.  When
+both 'day' and 'weekday' are given the task runs when either matches.
+Unlike 'every' tasks, 'at' tasks don't run when the monitor starts.
+
+Interval tasks run on a fixed grid of deadlines, so a 10 second task
+that takes 3 seconds still starts every 10 seconds.  If a run ends after
+its next slot has passed the 'missed' policy applies: 'skip' drops the
+missed slots, 'once' (the default) runs once right away and then
+returns to the grid, and 'catch-up' runs every missed slot back to back
+(up to 10, beyond that they are skipped).
+
+Tasks due within 'monitor.wakeup_tolerance' seconds (0.05 by default)
+of each other are started together, up to that much early, in order of
+their 'priority'.
+
+An 'adaptive' interval task samples less while its results are stable
+and more when something happens.  Each run whose numbers all stayed
+within 'band' of their values at the start of the current stable
+stretch multiplies the interval by 'backoff', up to 'max', so a slow
+drift ends the stretch once it adds up to more than the band.  A run
+whose conditions sent an alert drops the interval to 'min' right away,
+and a run whose numbers moved out of the band brings a backed off
+interval back to 'every'.  Non-numeric results only count as stable
+while their set of numbers stays the same.
+
+With 'monitor.splay: True' (or 'splay: true' on a task) an interval
+task first runs at a fixed offset into its interval instead of right
+away.  The offset is a hash of the minion id and task id, so it is the
+same after every restart but differs between tasks and between hosts,
+which spreads their runs evenly over the interval.
+
+With 'collect: on-change' the task keeps a fingerprint of the last
+collected result and skips the collector while the result stays the
+same.  Every 'heartbeat' runs (10 by default) an unchanged result is
+collected anyway, so a quiet task can be told apart from a dead one.
+
+Tasks with the same 'run' line share one call of the salt command:
+when several of them are due at once the command runs once and every
+task evaluates its own conditions and collects on the result.  A result
+is also reused by tasks that start within 'monitor.coalesce_ttl' seconds
+(0 by default) of it being produced.  The ttl can be a number or a dict
+of ttls by salt function, e.g. {'ps.disk_partition_usage': 5}.  Use
+'coalesce: false' for commands with side effects; alert commands are
+never shared.  A task with a 'timeout' waits at most that long for the
+shared call, then runs the command itself.
+
+Tasks with 'executor: process' run their command and conditions in a
+pool of 'monitor.process_workers' worker processes (one per cpu by
+default), so python heavy commands don't slow down the other tasks.
+Alerts raised by the conditions are sent, and the result collected, by
+the monitor itself.  Such tasks don't share command results with other
+tasks.  Worker processes are replaced after 'monitor.process_maxtasks'
+runs (100 by default).
+
+A task's run may take 'timeout' seconds, by default 'monitor.timeout'
+or 300; false lets runs take as long as they need.  Thread runs share
+the 'monitor.workers' threads, so without a timeout a few hung runs
+stall every task.  A thread run that takes longer is abandoned and the
+task goes on with its schedule; until the stuck call returns, later
+runs are skipped and count as timeouts.  A process run that takes
+longer is killed with its worker process, which is replaced.  After
+'monitor.timeout_alerts' timeouts in a row (3 by default) the monitor
+sends an 'alert.error' in the 'monitor.timeout' category.
+
+With 'rollup: <seconds>' (or 'monitor.rollup') the collector gets one
+record per window instead of every result.  The record holds the min,
+max, sum, count and last value of each numeric leaf of the results in
+that window, see salt.ext.monitor.rollup.  Add 'raw: true' to collect
+the results as well.  Rollups apply after 'collect', so combining them
+with 'collect: on-change' skews the statistics.
+
+Conditions can look back at the task's previous results.  'history'
+is the list of previous results (history[-1] is the last one) and
+'delta(key)', 'rate(key)' and 'avg(n, key)' compute the change since the
+previous result, the change per second and the mean of the last n
+values of a number in the results.  'key' is a dotted path such as
+'eth0.bytes_sent', or None (the default) for a result that is a number.
+They return None until there is a previous result.  Tasks whose
+conditions use these names keep 'monitor.history' results (10 by
+default); set 'history' on a task to keep more or fewer.  For example:
+
+    - run: ps.cpu_times
+      every:
+        second: 10
+      if rate('user') > 0.9:
+        - alert.warning cpu.busy 'user cpu above 90% for 10 seconds'
+
 The 'foreach' statement automatically sorts dict and set results.
 If the <value> variable is a dict, foreach automatically wraps <value>
 with an AttrDict that allows you to reference the dict contents as
@@ -128,21 +277,42 @@ and expressions containing ':' with single quotes.  For example,
 
 # Import python modules
 import datetime
+import hashlib
+import imp
+import json
 import logging
+import marshal
 import os
 import re
 import shlex
+import tempfile
+import time
+import types
 
 # Import salt libs
 import salt.log
 # notice intra-package references '.'
-from ..cron import CronParser
-from ..task import MonitorTask
+from ..cron import CronParser, DEFAULT_BACKOFF, DEFAULT_BAND, \
+                   DEFAULT_MISSED_POLICY, parse_interval
+from ..history import DEFAULT_SIZE as DEFAULT_HISTORY, NAMES as HISTORY_NAMES
+from ..task import AttrDict, MonitorTask
 
 log = salt.log.getLogger(__name__)
 
 MONITOR_DEFAULT_INTERVAL = {'minute': 10}
 
+COLLECT_MODES = ('always', 'on-change')
+DEFAULT_TIMEOUT = 300
+DEFAULT_TIMEOUT_ALERTS = 3
+EXECUTORS = ('thread', 'process')
+DEFAULT_HEARTBEAT = 10
+
+# Bump when the generated code changes so stale cache entries are ignored
+CACHE_VERSION = 1
+
+# The names of cache entries, sha1 hex digests, see _cache_key()
+CACHE_NAME_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
 class Parser(object):
     '''
     Parser the monitor commands from YAML in /etc/salt/monitor.
@@ -160,9 +330,29 @@ class Parser(object):
         self.cron_parser      = CronParser()
         self.default_interval = monitor.opts.get('monitor.default_interval',
                                                  MONITOR_DEFAULT_INTERVAL)
+        self.splay            = monitor.opts.get('monitor.splay', False)
+        self.missed           = monitor.opts.get('monitor.missed',
+                                                 DEFAULT_MISSED_POLICY)
+        self.collect          = monitor.opts.get('monitor.collect', 'always')
+        self.heartbeat        = monitor.opts.get('monitor.heartbeat',
+                                                 DEFAULT_HEARTBEAT)
+        self.coalesce_ttl     = monitor.opts.get('monitor.coalesce_ttl', 0)
+        self.timeout          = monitor.opts.get('monitor.timeout',
+                                                 DEFAULT_TIMEOUT)
+        self.timeout_alerts   = monitor.opts.get('monitor.timeout_alerts',
+                                                 DEFAULT_TIMEOUT_ALERTS)
+        self.rollup           = monitor.opts.get('monitor.rollup')
+        self.rollup_raw       = monitor.opts.get('monitor.rollup_raw', False)
+        self.history          = monitor.opts.get('monitor.history',
+                                                 DEFAULT_HISTORY)
         self.functions        = monitor.functions
         self.context          = self._make_context(monitor)
         self.source           = monitor.opts.get('monitor')
+        self.cache_dir        = self._cache_dir(monitor.opts)
+        self.functions_digest = hashlib.sha1(
+                                    '\n'.join(sorted(self.functions))).hexdigest()
+        self.cache_hits       = 0
+        self.cache_misses     = 0
 
     def parse(self):
         return self._expand_tasks(self.source)
@@ -176,57 +366,142 @@ class Parser(object):
             result['collector'] = monitor.collectors.get(name)
         return result
 
+    def _cache_dir(self, opts):
+        '''
+        Return the bytecode cache directory or None if caching is off.
+        Defaults to 'monitor' under the minion's cachedir.
+        '''
+        result = opts.get('monitor.cache_dir')
+        if result is None and 'cachedir' in opts:
+            result = os.path.join(opts['cachedir'], 'monitor')
+        if result:
+            try:
+                if not os.path.isdir(result):
+                    os.makedirs(result)
+            except OSError, ex:
+                log.warning('bytecode cache disabled: %s', ex)
+                result = None
+        return result or None
+
     def _expand_tasks(self, parsed_yaml):
         '''
         Assemble compiled code from the configuration described by
         python dictionaries and lists.
         '''
         results = []
+        used = set()
+        self.cache_hits = self.cache_misses = 0
+        start = time.time()
         for tasknum, taskdict in enumerate(parsed_yaml, 1):
             try:
                 log.trace(taskdict)
                 taskid = taskdict.get('id', 'monitor-{}'.format(tasknum))
-                pysrc = self._expand_task(taskid, taskdict)
-                log.trace("generated '%s' task source:\n%s", taskid, pysrc)
-                pyexe = compile(pysrc, '<monitor-config>', 'exec')
-                scheduler = self._expand_scheduler(taskdict)
-                results.append(MonitorTask(taskid, pyexe, self.context, scheduler))
+                key, cmd, pyexe = self._compile_task(taskid, taskdict)
+                used.add(key)
+                scheduler = self._expand_scheduler(taskid, taskdict)
+                options = self._expand_options(cmd, taskdict, pyexe)
+                results.append(MonitorTask(taskid, cmd, pyexe, self.context,
+                                           scheduler, key, options))
             except ValueError, ex:
                 log.error( 'ignore monitor command #{} {!r}: {}'.format(
                                         tasknum,
                                         taskdict.get('run', '<unknown>'),
                                         ex ) )
+        if self.cache_dir:
+            self._prune_cache(used)
+        log.info('loaded {} task{} in {:.3f}s: {} cache hit{}, {} miss{}'.format(
+                    len(results), '' if len(results) == 1 else 's',
+                    time.time() - start,
+                    self.cache_hits, '' if self.cache_hits == 1 else 's',
+                    self.cache_misses, '' if self.cache_misses == 1 else 'es'))
         return results
 
-    def _expand_task(self, taskid, taskdict):
+    def _compile_task(self, taskid, taskdict):
         '''
-        Translate one task/response dict into an array of python lines.
+        Return (cache key, command words, code object) for a task.
+        The command words and code come from the bytecode cache when the
+        task dict and the salt functions are unchanged.
         '''
-        rawtask = taskdict['run']
-        cmd = self._split_command(rawtask)
-        call = self._expand_call(rawtask)
-        result = [
-'''
-class AttrDict(dict):
-    __getattr__ = dict.__getitem__
-def _run(*args):
-    log.trace("{taskid}: run: %s", ' '.join(args))
-    ret = functions[args[0]](*args[1:])
-    log.trace("{taskid}: result: %s", ret)
-    return ret
-cmd = {cmd}
-result = {call}
-'''.format(taskid=taskid,
-           cmd=cmd,
-           call=call).strip()]
+        key = self._cache_key(taskdict)
+        path = os.path.join(self.cache_dir, key) if self.cache_dir else None
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rb') as cached:
+                    cmd, pysrc, pyexe = marshal.load(cached)
+                self.cache_hits += 1
+                log.trace("cached '%s' task source:\n%s", taskid, pysrc)
+                return key, cmd, pyexe
+            except (IOError, EOFError, ValueError, TypeError), ex:
+                log.warning('ignore bad bytecode cache entry %s: %s', path, ex)
+        cmd = self._split_command(taskdict['run'])
+        pysrc = self._expand_task(taskid, taskdict)
+        log.trace("generated '%s' task source:\n%s", taskid, pysrc)
+        pyexe = compile(pysrc, '<monitor-config>', 'exec')
+        self.cache_misses += 1
+        if path:
+            self._store_cache(path, (cmd, pysrc, pyexe))
+        return key, cmd, pyexe
+
+    def _cache_key(self, taskdict):
+        '''
+        Hash everything the generated code depends on: the task dict,
+        the set of salt functions, the parser and the python version.
+        '''
+        digest = hashlib.sha1()
+        digest.update(imp.get_magic())
+        digest.update(str(CACHE_VERSION))
+        digest.update(self.functions_digest)
+        digest.update(json.dumps(taskdict, sort_keys=True, default=repr))
+        return digest.hexdigest()
+
+    def _store_cache(self, path, entry):
+        '''
+        Atomically write one cache entry; failures only cost a recompile.
+        '''
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as cached:
+                marshal.dump(entry, cached)
+            os.rename(tmp, path)
+        except (IOError, OSError), ex:
+            log.warning("can't write bytecode cache entry %s: %s", path, ex)
+
+    def _prune_cache(self, used):
+        '''
+        Remove cache entries no longer used by the configuration, and
+        temporary files left by an interrupted _store_cache().  Other
+        files in the cache directory are left alone.
+        '''
+        try:
+            for name in os.listdir(self.cache_dir):
+                if name in used:
+                    continue
+                if CACHE_NAME_PATTERN.match(name) or name.startswith('.tmp'):
+                    os.remove(os.path.join(self.cache_dir, name))
+        except OSError, ex:
+            log.warning("can't prune bytecode cache %s: %s", self.cache_dir, ex)
 
+    def _expand_task(self, taskid, taskdict):
+        '''
+        Translate one task/response dict into the source of two python
+        functions: _command() runs the salt command and _react(result)
+        runs the task's foreach and if blocks.  The source is compiled
+        and executed once per task, see MonitorTask.
+        '''
+        call = self._expand_call(taskdict['run'])
+        reaction = []
         for key, value in taskdict.iteritems():
             key = key.strip().replace('\t', ' ')
             if key.startswith('foreach '):
                 params = key[8:].strip().replace(',', ' ').split()
-                result += self._expand_foreach(params, value)
+                reaction += self._expand_foreach(params, value)
             elif key.startswith('if '):
-                result += self._expand_conditional(key, value)
+                reaction += self._expand_conditional(key, value)
+        result = ['def _command():',
+                  '    return ' + call,
+                  'def _react(result):']
+        reaction = '\n'.join(reaction + ['return result']).split('\n')
+        result += _indent(reaction)
         return '\n'.join(result)
 
     def _split_command(self, line):
@@ -250,15 +525,15 @@ result = {call}
         '''
         Expand a parsed command line into a python function call.
         For example, "echo 'the key is $key'"
-            becomes "functions['echo']('the key is {}'.format(key))"
+            becomes "_run('echo', ['the key is {}'.format(key)])"
         '''
         words = self._split_command(line)
         try:
-            args = [repr(words[0])] + [self._expand_references(word, True) for word in words[1:]]
+            args = [self._expand_references(word, True) for word in words[1:]]
         except ValueError, ex:
             ex.args = (ex.args[0] + ', line: ' + line,)
             raise
-        result = '_run({})'.format(', '.join(args))
+        result = '_run({!r}, [{}])'.format(words[0], ', '.join(args))
         return result
 
     def _expand_foreach(self, params, value):
@@ -372,10 +647,11 @@ for {}, {} in sorted(result.iteritems()):''' \
                         if to_string else fmt.format(*refs)
         return result
 
-    def _expand_scheduler(self, taskdict):
+    def _expand_scheduler(self, taskid, taskdict):
         '''
         Create an iterator that generates a sequence of sleep times
-        until the next specified event.
+        until the next specified event.  With splay enabled, interval
+        tasks get a phase derived from the minion id and task id.
         '''
         if 'every' in taskdict:
             sleep_type = 'interval'
@@ -386,9 +662,126 @@ for {}, {} in sorted(result.iteritems()):''' \
         else:
             sleep_type = 'interval'
             cron_dict = self.default_interval
-        result = self.cron_parser.create_scheduler(sleep_type, cron_dict)
+        splay_name = None
+        if taskdict.get('splay', self.splay):
+            splay_name = '{}/{}'.format(self.context.get('id'), taskid)
+        missed = taskdict.get('missed', self.missed)
+        adaptive = None
+        if sleep_type == 'interval':
+            adaptive = self._expand_adaptive(taskdict.get('adaptive'),
+                                             cron_dict)
+        elif taskdict.get('adaptive'):
+            raise ValueError('adaptive schedules need an interval')
+        result = self.cron_parser.create_scheduler(sleep_type, cron_dict,
+                                                   splay_name, missed,
+                                                   adaptive)
         return result
 
+    def _expand_adaptive(self, adaptive, cron_dict):
+        '''
+        Return the AdaptiveScheduler arguments of an 'adaptive' setting,
+        or None if the task's interval is fixed.
+        '''
+        if adaptive is None or adaptive is False:
+            return None
+        if adaptive is True:
+            adaptive = {}
+        if not isinstance(adaptive, dict):
+            raise ValueError('adaptive must be a boolean or a dict: '
+                             '{!r}'.format(adaptive))
+        unknown = set(adaptive) - set(['min', 'max', 'band', 'backoff'])
+        if unknown:
+            raise ValueError('unknown adaptive settings: {}'.format(
+                                ', '.join(sorted(unknown))))
+        interval = parse_interval(cron_dict)
+        result = {}
+        for key, default in [('min', interval), ('max', interval * 8)]:
+            value = adaptive.get(key, default)
+            if isinstance(value, dict):
+                value = parse_interval(value)
+            result[key + '_interval'] = value
+        for key, default in [('band', DEFAULT_BAND),
+                             ('backoff', DEFAULT_BACKOFF)]:
+            result[key] = adaptive.get(key, default)
+        for key, value in result.iteritems():
+            if not isinstance(value, (int, long, float)):
+                raise ValueError('adaptive {} must be a number: {!r}'.format(
+                                    key.replace('_interval', ''), value))
+        return result
+
+    def _expand_options(self, cmd, taskdict, pyexe=None):
+        '''
+        Return the task settings that MonitorTask acts on at run time.
+        '''
+        collect = taskdict.get('collect', self.collect)
+        if collect not in COLLECT_MODES:
+            raise ValueError('collect must be one of {}: {!r}'.format(
+                                ', '.join(COLLECT_MODES), collect))
+        heartbeat = taskdict.get('heartbeat', self.heartbeat)
+        if not isinstance(heartbeat, (int, long)) or heartbeat < 1:
+            raise ValueError('heartbeat must be a positive integer: '
+                             '{!r}'.format(heartbeat))
+        coalesce = taskdict.get('coalesce', True)
+        if coalesce is True:
+            coalesce = self.coalesce_ttl
+            if isinstance(coalesce, dict):
+                coalesce = coalesce.get(cmd[0], 0)
+        if coalesce is False or cmd[0].startswith('alert.'):
+            coalesce = None
+        elif not isinstance(coalesce, (int, long, float)) or coalesce < 0:
+            raise ValueError('coalesce must be a boolean or a number of '
+                             'seconds: {!r}'.format(coalesce))
+        executor = taskdict.get('executor', 'thread')
+        if executor not in EXECUTORS:
+            raise ValueError('executor must be one of {}: {!r}'.format(
+                                ', '.join(EXECUTORS), executor))
+        timeout = taskdict.get('timeout', self.timeout)
+        if timeout is False:
+            timeout = None
+        elif timeout is not None and (
+                not isinstance(timeout, (int, long, float)) or timeout <= 0):
+            raise ValueError('timeout must be a positive number of '
+                             'seconds: {!r}'.format(timeout))
+        rollup = taskdict.get('rollup', self.rollup)
+        if rollup is False:
+            rollup = None
+        elif rollup is not None and (
+                not isinstance(rollup, (int, long, float)) or rollup <= 0):
+            raise ValueError('rollup must be false or a positive number of '
+                             'seconds: {!r}'.format(rollup))
+        raw = taskdict.get('raw', self.rollup_raw)
+        if not isinstance(raw, bool):
+            raise ValueError('raw must be a boolean: {!r}'.format(raw))
+        priority = taskdict.get('priority', 0)
+        if not isinstance(priority, (int, long, float)):
+            raise ValueError('priority must be a number: {!r}'.format(
+                                priority))
+        history = taskdict.get('history')
+        if history is None:
+            history = 0
+            if pyexe is not None and \
+                    _code_names(pyexe).intersection(HISTORY_NAMES):
+                history = self.history
+        if not isinstance(history, (int, long)) or history < 0:
+            raise ValueError('history must be a number of results: '
+                             '{!r}'.format(history))
+        return {'collect': collect, 'heartbeat': heartbeat,
+                'coalesce': coalesce, 'executor': executor,
+                'timeout': timeout, 'timeout_alerts': self.timeout_alerts,
+                'rollup': rollup, 'raw': raw, 'priority': priority,
+                'history': history}
+
+def _code_names(code):
+    '''
+    Return the global and attribute names used by a code object and
+    the functions it defines.
+    '''
+    result = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            result |= _code_names(const)
+    return result
+
 def _indent(lines, num_spaces=4):
     '''
     Indent each line in an array of lines.
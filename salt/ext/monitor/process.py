@@ -0,0 +1,343 @@
+'''
+Run monitor task code in worker processes.
+
+Tasks configured with 'executor: process' run their salt command and
+conditions in a child process so pure python parsing of large results
+doesn't hold the GIL of the monitor.  The children are forked from the
+monitor and inherit its salt functions.  A child returns the task's
+result plus the alert calls the conditions made; the monitor sends the
+alerts and collects the result itself, so the alert connection and the
+collectors stay in the monitor.  A task's result history, see
+salt.ext.monitor.history, is sent to the child with every run.
+
+Each child runs one task at a time and is replaced after
+'monitor.process_maxtasks' runs to bound its memory growth.  A run that
+exceeds its timeout is killed with its child; runs in the other
+children carry on, and a new child is forked when one is next needed.
+
+The monitor forks its children with start() when it starts, after it
+daemonized and before it runs any thread.  Replacements are forked
+later from the running, multithreaded monitor, and a child only gets
+the thread that forked it: a lock another thread held at that moment
+stays held for good in the child.  Python resets the import lock in a
+forked child and _init() replaces the logging locks before the child
+runs anything; other locks shared with the monitor's threads, e.g.
+inside a salt function, aren't safe to take in a process task.
+
+Use:
+    import salt.ext.monitor.process
+    salt.ext.monitor.process.configure(opts)
+    salt.ext.monitor.process.start(task.context)
+    result, alerts, error, times = salt.ext.monitor.process.execute(task, 60)
+'''
+
+# Import python modules
+import atexit
+import logging
+import marshal
+import multiprocessing
+import os
+import signal
+import threading
+
+# Import salt libs
+import salt.ext.monitor.cron
+import salt.log
+
+log = salt.log.getLogger(__name__)
+
+DEFAULT_MAXTASKS = 100
+
+_settings = {'workers': None, 'maxtasks': DEFAULT_MAXTASKS}
+
+# the idle children and the number of children, idle or busy
+_idle = []
+_running = 0
+_lock = threading.Condition(threading.Lock())
+
+# held while forking, so no child inherits the pipe of another
+_fork_lock = threading.Lock()
+
+# the parent's task context and the compiled tasks, in a child
+_context = None
+_namespaces = {}
+
+class Timeout(Exception):
+    '''
+    A run took longer than its timeout and was killed.
+    '''
+
+class ChildDied(Exception):
+    '''
+    The child running a task exited before returning its result.
+    '''
+
+class _Worker(object):
+    '''
+    A child process running the tasks sent over a pipe, one at a time.
+    '''
+    def __init__(self, context):
+        with _fork_lock:
+            self.conn, child = multiprocessing.Pipe()
+            self.process = multiprocessing.Process(target=_serve,
+                                                   args=(child, context),
+                                                   name='monitor-process')
+            self.process.daemon = True
+            self.process.start()
+            child.close()
+        self.runs = 0
+
+    def stop(self):
+        '''
+        Ask an idle child to exit.
+        '''
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.conn.close()
+
+    def kill(self):
+        '''
+        Kill the child, whatever it is doing, and reap it.
+        '''
+        try:
+            os.kill(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            self.process.join()
+        finally:
+            self.conn.close()
+
+def configure(opts):
+    '''
+    Read the pool settings; they apply to the children forked from now.
+    '''
+    _settings['workers'] = opts.get('monitor.process_workers')
+    _settings['maxtasks'] = opts.get('monitor.process_maxtasks',
+                                     DEFAULT_MAXTASKS)
+
+def _workers():
+    '''
+    Return the number of children to run.
+    '''
+    return _settings['workers'] or multiprocessing.cpu_count()
+
+def start(context):
+    '''
+    Fork the children now rather than when tasks first need them.
+    '''
+    global _running
+    while True:
+        with _lock:
+            if _running >= _workers():
+                return
+            _running += 1
+        _release(_fork(context))
+
+def _fork(context):
+    '''
+    Fork a child for a slot already counted in _running.
+    '''
+    log.debug('starting monitor process {} of {}'.format(_running,
+                                                         _workers()))
+    try:
+        return _Worker(context)
+    except Exception:
+        _release(None)
+        raise
+
+def _acquire(context, expires=None):
+    '''
+    Return an idle child, forking one if fewer than 'workers' are
+    running, or None if none is free by the monotonic time 'expires'.
+    '''
+    global _running
+    workers = _workers()
+    with _lock:
+        while not _idle and _running >= workers:
+            if expires is None:
+                _lock.wait()
+                continue
+            remaining = expires - salt.ext.monitor.cron.monotonic()
+            if remaining <= 0:
+                return None
+            _lock.wait(remaining)
+        if _idle:
+            return _idle.pop()
+        _running += 1
+    return _fork(context)
+
+def _release(worker):
+    '''
+    Put a child back in the idle list after a run.  A child that ran
+    'maxtasks' runs is stopped, and None stands for a killed child; in
+    both cases a new one is forked when needed.
+    '''
+    global _running
+    maxtasks = _settings['maxtasks']
+    if worker is not None and maxtasks and worker.runs >= maxtasks:
+        worker.stop()
+        worker = None
+    with _lock:
+        if worker is None:
+            _running -= 1
+        else:
+            _idle.append(worker)
+        _lock.notify()
+
+def _terminate():
+    '''
+    Stop the idle children.  Busy ones are daemonic, so multiprocessing
+    kills them when the monitor exits.
+    '''
+    global _running
+    with _lock:
+        idle = _idle[:]
+        del _idle[:]
+        _running -= len(idle)
+    for worker in idle:
+        worker.stop()
+
+atexit.register(_terminate)
+
+def execute(task, timeout=None):
+    '''
+    Run a task's command and conditions in a child.  Return (result,
+    alerts, error, times): the result to collect, the [(name, args)]
+    alert calls to make, the conditions' error message or None, and
+    the (command, react) run times.  Raises if the command failed,
+    Timeout if it ran, or waited for a free child, longer than
+    'timeout' seconds.
+    '''
+    expires = None
+    if timeout:
+        expires = salt.ext.monitor.cron.monotonic() + timeout
+    worker = _acquire(task.context, expires)
+    if worker is None:
+        raise Timeout('no monitor process free for {} seconds'.format(
+                        timeout))
+    try:
+        worker.conn.send((task.key, marshal.dumps(task.pyexe),
+                          getattr(task, 'history', None)))
+        wait = None
+        if expires is not None:
+            wait = max(0, expires - salt.ext.monitor.cron.monotonic())
+        if not worker.conn.poll(wait):
+            log.warning('killing monitor process %d, its run took more '
+                        'than %s seconds', worker.process.pid, timeout)
+            dead, worker = worker, None
+            _kill(dead)
+            raise Timeout('killed after {} seconds'.format(timeout))
+        ok, value = worker.conn.recv()
+        worker.runs += 1
+    except (EOFError, IOError, OSError), ex:
+        if worker is not None:
+            dead, worker = worker, None
+            _kill(dead)
+        raise ChildDied('monitor process died: {}'.format(ex or 'EOF'))
+    finally:
+        _release(worker)
+    if not ok:
+        raise value
+    return value
+
+def _kill(worker):
+    '''
+    Kill a child that is no longer in the pool, logging rather than
+    raising if that fails.
+    '''
+    try:
+        worker.kill()
+    except Exception, ex:
+        log.error('failed to kill monitor process %d: %s',
+                  worker.process.pid, ex)
+
+def _serve(conn, context):
+    '''
+    Child process main loop: run the tasks sent over 'conn' and send
+    back (True, result) or (False, exception), until None is sent.
+    '''
+    _init(context)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        try:
+            reply = (True, _execute(*request))
+        except Exception, ex:
+            reply = (False, ex)
+        try:
+            conn.send(reply)
+        except Exception, ex:
+            # a result or exception that can't be pickled
+            conn.send((False, ValueError("can't send the result back: "
+                                         '{}'.format(ex))))
+
+def _init(context):
+    '''
+    Child process initializer.
+    '''
+    global _context
+    _reset_logging_locks()
+    _context = dict((name, value) for name, value in context.iteritems()
+                    if not name.startswith('_'))
+    _namespaces.clear()
+
+def _reset_logging_locks():
+    '''
+    Replace the logging locks a thread of the monitor may have held
+    when this child was forked.
+    '''
+    logging._lock = threading.RLock()
+    loggers = [logging.getLogger()] + \
+              logging.Logger.manager.loggerDict.values()
+    for logger in loggers:
+        # placeholders for loggers not created yet have no handlers
+        for handler in getattr(logger, 'handlers', ()):
+            handler.createLock()
+
+def _execute(key, code, history=None):
+    '''
+    Run one task in a child process, see execute().
+    '''
+    namespace = _namespaces.get(key)
+    if namespace is None:
+        namespace = _context.copy()
+        namespace['_run'] = _make_runner(namespace)
+        exec marshal.loads(code) in namespace
+        if key is not None:
+            _namespaces[key] = namespace
+    namespace['_alerts'] = alerts = []
+    if history is not None:
+        namespace.update(history.names())
+    start = salt.ext.monitor.cron.monotonic()
+    result = namespace['_command']()
+    react_start = salt.ext.monitor.cron.monotonic()
+    if history is not None:
+        history.begin(result, react_start)
+    error = None
+    try:
+        result = namespace['_react'](result)
+    except Exception, ex:
+        error = '{}: {}'.format(type(ex).__name__, ex)
+    times = (react_start - start,
+             salt.ext.monitor.cron.monotonic() - react_start)
+    return result, alerts, error, times
+
+def _make_runner(namespace):
+    '''
+    Return the _run() helper for tasks in a child: alert calls are
+    recorded for the parent instead of being made.
+    '''
+    functions = namespace['functions']
+    def _run(name, args):
+        if name.startswith('alert.'):
+            namespace['_alerts'].append((name, args))
+            return None
+        return functions[name](*args)
+    return _run
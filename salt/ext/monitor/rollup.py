@@ -0,0 +1,129 @@
+'''
+Roll up numeric task results before they reach the collector.
+
+A Rollup wraps a collector and keeps, for every numeric leaf of the
+results handed to it, the min, max, sum, count and last value seen in
+the current window.  Windows are aligned to multiples of 'window'
+seconds of wall clock time.  The first result after a window ends
+sends that window downstream as one record shaped like the results,
+with each numeric leaf replaced by its statistics:
+
+    {'window': 60,
+     'start': <epoch seconds>,
+     'samples': 6,
+     'values': {'1-min': {'min': 0.1, 'max': 0.5, 'sum': 1.8,
+                          'count': 6, 'last': 0.3}, ...}}
+
+List items are keyed by their index.  Booleans, strings and other
+non-numeric leaves are not rolled up.  When results change shape
+within a window, e.g. {'a': 1} then {'a': {'b': 2}}, the leaves below
+another numeric leaf are left out of the record.  With 'raw' every
+result is also passed through unchanged.  A window still open when the
+monitor stops is lost.
+
+Use:
+    import salt.ext.monitor.rollup
+    collector = salt.ext.monitor.rollup.Rollup(collector, 60)
+    collector(hostname, cmd, result)
+'''
+
+# Import python modules
+import threading
+import time
+
+# Import salt libs
+import salt.log
+
+log = salt.log.getLogger(__name__)
+
+class Rollup(object):
+    '''
+    A collector that rolls up results for another collector.
+    '''
+    def __init__(self, collector, window, raw=False):
+        self.collector = collector
+        self.window    = window
+        self.raw       = raw
+        self._lock     = threading.Lock()
+        self._start    = None
+        self._samples  = 0
+        self._values   = {}
+
+    def __call__(self, hostname, cmd, result):
+        start = time.time() // self.window * self.window
+        with self._lock:
+            if self._start != start:
+                done = self._take()
+                self._start = start
+            else:
+                done = None
+            self._samples += 1
+            for path, value in flatten(result):
+                self._add(path, value)
+        if done is not None:
+            self.collector(hostname, cmd, done)
+        if self.raw:
+            self.collector(hostname, cmd, result)
+
+    def _add(self, path, value):
+        '''
+        Fold one numeric leaf into the window; the caller holds the lock.
+        '''
+        stats = self._values.get(path)
+        if stats is None:
+            self._values[path] = {'min': value, 'max': value, 'sum': value,
+                                  'count': 1, 'last': value}
+            return
+        if value < stats['min']:
+            stats['min'] = value
+        if value > stats['max']:
+            stats['max'] = value
+        stats['sum'] += value
+        stats['count'] += 1
+        stats['last'] = value
+
+    def _take(self):
+        '''
+        Return the record of the current window, or None if it is empty,
+        and start a new one; the caller holds the lock.
+        '''
+        if not self._samples:
+            return None
+        values = {}
+        skipped = 0
+        for path, stats in self._values.iteritems():
+            if any(path[:end] in self._values for end in range(1, len(path))):
+                skipped += 1
+                continue
+            node = values
+            for name in path[:-1]:
+                node = node.setdefault(name, {})
+            node[path[-1]] = stats
+        if skipped:
+            log.warning('rollup left out %d values below other numeric '
+                        'values', skipped)
+        result = {'window': self.window,
+                  'start': self._start,
+                  'samples': self._samples,
+                  'values': values}
+        self._samples = 0
+        self._values = {}
+        return result
+
+def flatten(result, path=()):
+    '''
+    Yield (path, value) for the numeric leaves of a result, where path
+    is a tuple of dict keys and list indexes as strings.
+    '''
+    if isinstance(result, bool):
+        return
+    if isinstance(result, (int, long, float)):
+        yield path or ('value',), result
+    elif isinstance(result, dict):
+        for key, value in result.iteritems():
+            for leaf in flatten(value, path + (str(key),)):
+                yield leaf
+    elif isinstance(result, (list, tuple)):
+        for index, value in enumerate(result):
+            for leaf in flatten(value, path + (str(index),)):
+                yield leaf
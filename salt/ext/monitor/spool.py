@@ -0,0 +1,182 @@
+'''
+A local append-only spool for records a collector couldn't deliver.
+
+Records are appended to numbered segment files in a directory as
+length-prefixed pickles.  A segment is closed when it reaches
+'segment_size' bytes.  Closed segments are read back with mmap, oldest
+first, and deleted once their records were delivered, so delivery is
+at least once.  The spool keeps at most 'max_size' bytes and drops
+segments older than 'max_age' seconds, oldest first.  Segments left by
+a previous run are picked up again.
+
+Use:
+    import salt.ext.monitor.spool
+    spool = salt.ext.monitor.spool.Spool('/var/cache/salt/spool')
+    spool.append(records)
+    spool.replay(deliver)       # deliver(records) for each spooled list
+'''
+
+# Import python modules
+import cPickle as pickle
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Import salt libs
+import salt.log
+
+log = salt.log.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+_HEADER = struct.Struct('>I')
+_SUFFIX = '.spool'
+
+class Spool(object):
+    '''
+    Segment files holding lists of records, see the module doc.
+    '''
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 max_size=DEFAULT_MAX_SIZE, max_age=DEFAULT_MAX_AGE):
+        self.directory    = directory
+        self.segment_size = segment_size
+        self.max_size     = max_size
+        self.max_age      = max_age
+        self.counters     = {'spooled': 0, 'replayed': 0, 'expired': 0}
+        self._lock        = threading.Lock()
+        self._file        = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._segments = sorted(name for name in os.listdir(directory)
+                                if name.endswith(_SUFFIX))
+        self._sizes = dict((name, os.path.getsize(self._path(name)))
+                           for name in self._segments)
+        self._next = int(self._segments[-1][:-len(_SUFFIX)]) + 1 \
+                     if self._segments else 0
+
+    def __len__(self):
+        '''
+        Return the number of segments, including the open one.
+        '''
+        return len(self._segments)
+
+    def append(self, records):
+        '''
+        Spool a list of records.
+        '''
+        data = pickle.dumps(records, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._file is None:
+                name = '{:010d}{}'.format(self._next, _SUFFIX)
+                self._next += 1
+                self._file = open(self._path(name), 'ab')
+                self._segments.append(name)
+                self._sizes[name] = 0
+            name = self._segments[-1]
+            self._file.write(_HEADER.pack(len(data)) + data)
+            self._file.flush()
+            self._sizes[name] += _HEADER.size + len(data)
+            self.counters['spooled'] += len(records)
+            if self._sizes[name] >= self.segment_size:
+                self._close_segment()
+            self._expire()
+
+    def replay(self, deliver):
+        '''
+        Call deliver(records) for every spooled list of records, oldest
+        first, deleting each segment once it is delivered.  Stops at
+        the first exception, which is raised; that segment is kept and
+        replayed in full next time.  Returns the number of records.
+        '''
+        count = 0
+        while True:
+            with self._lock:
+                self._expire()
+                if not self._segments:
+                    return count
+                if self._file is not None and len(self._segments) == 1:
+                    self._close_segment()
+                name = self._segments[0]
+            replayed = 0
+            for records in self._read(name):
+                deliver(records)
+                replayed += len(records)
+            with self._lock:
+                # expired by append() while we were replaying it
+                if name in self._sizes:
+                    self._remove(name)
+                self.counters['replayed'] += replayed
+            count += replayed
+
+    def stats(self):
+        '''
+        Return the counters plus the number and size of the segments.
+        '''
+        with self._lock:
+            result = dict(self.counters)
+            result['segments'] = len(self._segments)
+            result['bytes'] = sum(self._sizes.itervalues())
+        return result
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read(self, name):
+        '''
+        Yield the record lists of a closed segment.  A record cut short
+        by a crash ends the segment.
+        '''
+        with open(self._path(name), 'rb') as segment:
+            size = os.fstat(segment.fileno()).st_size
+            if not size:
+                return
+            data = mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                offset = 0
+                while offset + _HEADER.size <= size:
+                    length, = _HEADER.unpack_from(data, offset)
+                    offset += _HEADER.size
+                    if offset + length > size:
+                        log.warning('spool segment %s is truncated', name)
+                        break
+                    yield pickle.loads(data[offset:offset + length])
+                    offset += length
+            finally:
+                data.close()
+
+    def _close_segment(self):
+        self._file.close()
+        self._file = None
+
+    def _remove(self, name):
+        '''
+        Delete a segment; the caller holds the lock.
+        '''
+        if self._file is not None and name == self._segments[-1]:
+            self._close_segment()
+        self._segments.remove(name)
+        del self._sizes[name]
+        try:
+            os.remove(self._path(name))
+        except OSError, ex:
+            log.warning("can't remove spool segment %s: %s", name, ex)
+
+    def _expire(self):
+        '''
+        Drop the oldest segments while the spool is too big or they are
+        too old; the caller holds the lock.
+        '''
+        cutoff = time.time() - self.max_age
+        while len(self._segments) > 1:
+            name = self._segments[0]
+            if sum(self._sizes.itervalues()) <= self.max_size and \
+                    os.path.getmtime(self._path(name)) >= cutoff:
+                break
+            log.warning('dropping spool segment %s (%d bytes)', name,
+                        self._sizes[name])
+            self.counters['expired'] += 1
+            self._remove(name)
@@ -0,0 +1,185 @@
+'''
+Latency statistics for monitor tasks.
+
+Every task keeps fixed-bucket histograms of how long each phase of a
+run takes and how late the run started relative to its schedule.  The
+running monitor registers itself here so report() can be read through
+the 'monitor.stats' salt module or dumped to the log on SIGUSR1.  The
+report also carries the alert outbox counters, which only the monitor
+process that sends the alerts can see.
+
+Use:
+    import salt.ext.monitor.stats
+    hist = salt.ext.monitor.stats.Histogram()
+    hist.add(0.0042)
+    hist.percentile(99)
+'''
+
+# Import python modules
+import bisect
+import threading
+
+# Bucket upper bounds in seconds, four per decade from 100us to 100s
+BUCKETS = tuple(round(10 ** (exp / 4.0), 6) for exp in range(-16, 9))
+
+# The phases of a task run that are timed
+PHASES = ('command', 'react', 'alerts', 'collect', 'lag')
+
+_monitor = None
+
+class Histogram(object):
+    '''
+    Count values into fixed buckets; percentiles are reported as the
+    upper bound of the bucket they fall in.
+
+    >>> hist = Histogram()
+    >>> for value in [0.001] * 98 + [0.5, 2.0]:
+    ...     hist.add(value)
+    >>> hist.percentile(50), hist.percentile(99), hist.max
+    (0.001, 0.562341, 2.0)
+    '''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count  = 0
+        self.total  = 0.0
+        self.max    = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        '''
+        Return the bucket bound below which 'pct' percent of the values
+        fall, or None if there are no values.
+        '''
+        if not self.count:
+            return None
+        rank = self.count * pct / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+class LockedHistogram(Histogram):
+    '''
+    A Histogram shared by several threads.
+    '''
+    def __init__(self):
+        Histogram.__init__(self)
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            Histogram.add(self, value)
+
+class TaskStats(object):
+    '''
+    The counters and phase histograms of one task.  A task never runs
+    on two workers at once, so no locking is needed.
+    '''
+    def __init__(self):
+        self.runs   = 0
+        self.errors = 0
+        # results not collected because they had not changed
+        self.unchanged = 0
+        # command results shared with another task, see CommandCache
+        self.coalesced = 0
+        self.timeouts = 0
+        self.phases = dict((phase, Histogram()) for phase in PHASES)
+        # seconds spent sending alerts during the current run
+        self.alert_time = 0.0
+        # alert calls made during the current run
+        self.alert_calls = 0
+
+    def add(self, phase, value):
+        self.phases[phase].add(value)
+
+    def summary(self):
+        result = {'runs': self.runs, 'errors': self.errors,
+                  'unchanged': self.unchanged, 'coalesced': self.coalesced,
+                  'timeouts': self.timeouts}
+        for phase, hist in self.phases.iteritems():
+            result[phase] = hist.summary()
+        return result
+
+def register(monitor):
+    '''
+    Make 'monitor' the source of report().
+    '''
+    global _monitor
+    _monitor = monitor
+
+def report():
+    '''
+    Return the statistics of the registered monitor's tasks plus the
+    overall dispatcher lag and the alert outbox counters of each alert
+    master.
+    '''
+    result = {'dispatcher': {'lag': dispatcher_lag.summary()},
+              'tasks': {},
+              'alerts': {}}
+    if _monitor is not None:
+        result['dispatcher']['wakeups'] = _monitor.dispatcher.wakeups
+        result['alerts'] = _monitor.alert_stats()
+        for task in _monitor.tasks:
+            summary = task.stats.summary()
+            for counter in ('overruns', 'skipped'):
+                if hasattr(task.scheduler, counter):
+                    summary[counter] = getattr(task.scheduler, counter)
+            result['tasks'][task.taskid] = summary
+    return result
+
+def format_report(stats):
+    '''
+    Render report() output as log friendly lines.
+    '''
+    lines = ['dispatcher: wakeups={} lag {}'.format(
+                stats['dispatcher'].get('wakeups', 0),
+                _format_summary(stats['dispatcher']['lag']))]
+    for taskid, task in sorted(stats['tasks'].iteritems()):
+        phases = ' '.join('{} {}'.format(phase, _format_summary(task[phase]))
+                          for phase in PHASES)
+        lines.append('{}: runs={} errors={} timeouts={} overruns={} '
+                     'skipped={} unchanged={} {}'.format(
+                        taskid, task['runs'], task['errors'],
+                        task.get('timeouts', 0),
+                        task.get('overruns', 0), task.get('skipped', 0),
+                        task.get('unchanged', 0), phases))
+    for uri, outbox in sorted(stats.get('alerts', {}).iteritems()):
+        lines.append('alerts {}: queued={} sent={} dropped={} failed={} '
+                     'retries={} reconnects={} depth={}'.format(
+                        uri, outbox['queued'], outbox['sent'],
+                        outbox['dropped'], outbox['failed'],
+                        outbox['retries'], outbox['reconnects'],
+                        outbox['depth']))
+    return lines
+
+def _format_summary(summary):
+    '''
+    Render a histogram summary as 'p50/p99' in milliseconds.
+
+    >>> _format_summary({'count': 1, 'p50': 0.001, 'p99': 0.0125})
+    '1.0/12.5ms'
+    >>> _format_summary({'count': 0})
+    '-'
+    '''
+    if not summary['count']:
+        return '-'
+    return '{:.1f}/{:.1f}ms'.format(summary['p50'] * 1000,
+                                    summary['p99'] * 1000)
+
+# how late tasks start relative to their deadlines, across all tasks
+dispatcher_lag = LockedHistogram()
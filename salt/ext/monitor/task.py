@@ -1,39 +1,384 @@
-import datetime
-import time
+import copy
+import hashlib
+import json
+import threading
 
+import salt.ext.monitor.batch
+import salt.ext.monitor.cron
+import salt.ext.monitor.history
+import salt.ext.monitor.process
+import salt.ext.monitor.rollup
+import salt.ext.monitor.stats
 import salt.log
 
 log = salt.log.getLogger(__name__)
 
+class AttrDict(dict):
+    '''
+    A dict whose items can also be read as attributes, e.g. value.foo.
+    '''
+    __getattr__ = dict.__getitem__
+
+def make_runner(taskid, functions, stats):
+    '''
+    Return the _run() helper called by a task's generated code.
+    Time spent in alert functions is added to the task's stats.
+    '''
+    def _run(name, args):
+        log.trace('%s: run: %s %s', taskid, name, args)
+        if name.startswith('alert.'):
+            start = salt.ext.monitor.cron.monotonic()
+            ret = functions[name](*args)
+            elapsed = salt.ext.monitor.cron.monotonic() - start
+            stats.alert_time += elapsed
+            stats.alert_calls += 1
+            stats.add('alerts', elapsed)
+        else:
+            ret = functions[name](*args)
+        log.trace('%s: result: %s', taskid, ret)
+        return ret
+    return _run
+
+class CommandCache(object):
+    '''
+    Share the results of identical salt commands between tasks.  The
+    first task to ask for a command runs it; tasks asking for the same
+    command while it runs, or within 'ttl' seconds after it finished,
+    get a copy of its result instead of running it again.  Failures are
+    passed to the waiting tasks but not kept.  A task that waits longer
+    than its timeout for the first one runs the command itself, so one
+    hung run doesn't stall every task sharing its command.
+    '''
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, command, ttl=0, timeout=None):
+        '''
+        Return (result, shared) for the command identified by 'key',
+        calling command() if there is no running or fresh entry, or if
+        the running one takes more than 'timeout' seconds.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry.event.is_set() and
+                    entry.expires <= salt.ext.monitor.cron.monotonic()):
+                entry = self.entries[key] = _Pending()
+                leader = True
+            else:
+                leader = False
+        if leader:
+            try:
+                entry.result = command()
+                return entry.result, False
+            except Exception, ex:
+                entry.error = ex
+                raise
+            finally:
+                if entry.error is None:
+                    entry.expires = salt.ext.monitor.cron.monotonic() + ttl
+                entry.event.set()
+        if not entry.event.wait(timeout):
+            log.warning('shared run of %s still running after %s seconds, '
+                        'running it again', ' '.join(key), timeout)
+            return command(), False
+        if entry.error is not None:
+            raise entry.error
+        return copy.deepcopy(entry.result), True
+
+class _Pending(object):
+    '''
+    A CommandCache entry.
+    '''
+    def __init__(self):
+        self.event   = threading.Event()
+        self.result  = None
+        self.error   = None
+        self.expires = 0.0
+
+# the command results shared by all tasks
+commands = CommandCache()
+
+# returned by a failed run
+_FAILED = object()
+_TIMED_OUT = object()
+
 class MonitorTask(object):
     '''
     A single monitor task.
+
+    The generated code in 'pyexe' is executed once, in the task's own
+    namespace, to define two functions: _command() runs the salt command
+    and returns its result, and _react(result) evaluates the task's
+    conditions and returns the result to collect.
+
+    The 'key' is a digest of the task's configuration; tasks with the
+    same id and key are interchangeable, see Monitor.reload().
+
+    The 'options' are the task settings from the configuration:
+        collect   = 'always' or 'on-change'; with 'on-change' a result
+                    equal to the last collected one is only collected
+                    once every 'heartbeat' runs
+        heartbeat = see 'collect'
+        coalesce  = None to always run the command, or the number of
+                    seconds a result may be shared with other tasks
+                    running the same command, see CommandCache
+        executor  = 'thread' or 'process', see salt.ext.monitor.process
+        timeout   = the seconds a run may take, or None
+        timeout_alerts = after this many timeouts in a row an
+                    'alert.error' is sent
+        rollup    = None, or the window in seconds over which results
+                    are rolled up before they are collected, see
+                    salt.ext.monitor.rollup
+        raw       = with 'rollup', also collect every result
+        priority  = tasks due together start in order of priority,
+                    highest first, see salt.ext.monitor.dispatcher
+        history   = the number of previous results the conditions can
+                    see, 0 for none, see salt.ext.monitor.history
+
+    Thread runs that time out are abandoned by the dispatcher, which
+    reads 'timeout' and calls timed_out(); process runs are killed.
+
+    Alerts raised during a run are batched and sent together when the
+    run ends, see salt.ext.monitor.batch.
+
+    A scheduler with an adapt() method, see
+    salt.ext.monitor.cron.AdaptiveScheduler, is told after each run
+    whether the result stayed within its band and whether the run
+    alerted.
     '''
-    def __init__(self, taskid, pyexe, context, scheduler=None):
+    def __init__(self, taskid, cmd, pyexe, context, scheduler=None, key=None,
+                 options=None):
         self.taskid    = taskid
-        self.code      = pyexe
-        self.context   = context
+        self.cmd       = cmd
+        self.key       = key
+        self.pyexe     = pyexe
+        self.options   = options or {}
+        self.fingerprint = None
+        self.unchanged = 0
+        # the numbers of the result that began the current stable
+        # stretch, for adaptive schedules
+        self.reference = None
+        self.timeout   = None
+        if self.options.get('executor') != 'process':
+            self.timeout = self.options.get('timeout')
+        self.timeouts_in_row = 0
+        self.priority  = self.options.get('priority', 0)
+        self.stats     = salt.ext.monitor.stats.TaskStats()
+        self.context   = context.copy()
+        if self.options.get('rollup') and context.get('collector'):
+            self.context['collector'] = salt.ext.monitor.rollup.Rollup(
+                                            context['collector'],
+                                            self.options['rollup'],
+                                            self.options.get('raw', False))
+        self.context['_run'] = make_runner(taskid, context['functions'],
+                                           self.stats)
+        self.history   = None
+        if self.options.get('history'):
+            self.history = salt.ext.monitor.history.History(
+                                self.options['history'])
+            self.context.update(self.history.names())
+        exec pyexe in self.context
+        self.command   = self.context['_command']
+        self.react     = self.context['_react']
         self.scheduler = scheduler
 
-    def run(self):
-        log.trace('start thread for %s', self.taskid)
-        minion = self.context.get('id')
+    def run(self, lag=None):
+        '''
+        Execute the task once and hand the result to the collector.
+        Scheduling is up to the caller, see salt.ext.monitor.dispatcher;
+        'lag' is how many seconds late the caller started this run.
+        '''
+        log.trace('run %s', self.taskid)
+        stats = self.stats
+        stats.runs += 1
+        stats.alert_time = 0.0
+        stats.alert_calls = 0
+        if lag is not None:
+            stats.add('lag', lag)
+        salt.ext.monitor.batch.begin()
+        try:
+            if self.options.get('executor') == 'process':
+                result = self._run_process()
+            else:
+                result = self._run_thread()
+        finally:
+            self._send_alerts()
+        if result is _TIMED_OUT:
+            return
+        self.timeouts_in_row = 0
+        if result is _FAILED:
+            return
+        if self.history is not None:
+            self.history.end(result)
+        if hasattr(self.scheduler, 'adapt'):
+            self._adapt(result)
+        collect_start = salt.ext.monitor.cron.monotonic()
         collector = self.context.get('collector')
-        while True:
+        if collector and self._changed(result):
+            try:
+                collector(self.context.get('id'), self.cmd, result)
+            except Exception, ex:
+                stats.errors += 1
+                log.error('monitor error: %s', self.taskid, exc_info=ex)
+            stats.add('collect', salt.ext.monitor.cron.monotonic() - collect_start)
+
+    def _run_thread(self):
+        '''
+        Run the command and conditions in the calling thread and return
+        the result to collect, or _FAILED if the command failed.
+        '''
+        stats = self.stats
+        start = salt.ext.monitor.cron.monotonic()
+        try:
+            ttl = self.options.get('coalesce')
+            if ttl is None:
+                result = self.command()
+            else:
+                result, shared = commands.get(tuple(self.cmd), self.command,
+                                              ttl, self.options.get('timeout'))
+                if shared:
+                    stats.coalesced += 1
+        except Exception, ex:
+            stats.errors += 1
+            log.error("can't execute %s: %s", self.taskid, ex, exc_info=ex)
+            return _FAILED
+        react_start = salt.ext.monitor.cron.monotonic()
+        stats.add('command', react_start - start)
+        if self.history is not None:
+            self.history.begin(result, react_start)
+        try:
+            result = self.react(result)
+        except Exception, ex:
+            stats.errors += 1
+            log.error("can't execute %s: %s", self.taskid, ex, exc_info=ex)
+        stats.add('react', salt.ext.monitor.cron.monotonic() - react_start
+                           - stats.alert_time)
+        return result
+
+    def _run_process(self):
+        '''
+        Run the command and conditions in the process pool, then make
+        the alert calls they asked for.  Return the result to collect,
+        or _FAILED if the command failed.
+        '''
+        stats = self.stats
+        try:
+            result, alerts, error, times = \
+                salt.ext.monitor.process.execute(self,
+                                                 self.options.get('timeout'))
+        except salt.ext.monitor.process.Timeout:
+            self.timed_out()
+            return _TIMED_OUT
+        except Exception, ex:
+            stats.errors += 1
+            log.error("can't execute %s: %s", self.taskid, ex, exc_info=ex)
+            return _FAILED
+        stats.add('command', times[0])
+        stats.add('react', times[1])
+        if self.history is not None:
+            # about when the child started the conditions
+            self.history.begin(result,
+                               salt.ext.monitor.cron.monotonic() - times[1])
+        if error is not None:
+            stats.errors += 1
+            log.error("can't execute %s: %s", self.taskid, error)
+        for name, args in alerts:
             try:
-                exec self.code in self.context
+                self.context['_run'](name, args)
             except Exception, ex:
+                stats.errors += 1
                 log.error("can't execute %s: %s", self.taskid, ex, exc_info=ex)
-            if collector:
-                jid = datetime.datetime.strftime(
-                             datetime.datetime.now(), 'M%Y%m%d%H%M%S%f')
-                try:
-                    collector(minion, self.context['cmd'], self.context['result'])
-                except Exception, ex:
-                    log.error('monitor error: %s', self.taskid, exc_info=ex)
-            if self.scheduler is None:
-                break
-            duration = self.scheduler.next()
-            log.trace('%s: sleep %s seconds', self.taskid, duration)
-            time.sleep(duration)
-        log.debug('thread exit: %s', self.taskid)
+        return result
+
+    def _send_alerts(self):
+        '''
+        Send the alerts batched during the run, see
+        salt.ext.monitor.batch.
+        '''
+        start = salt.ext.monitor.cron.monotonic()
+        try:
+            sent = salt.ext.monitor.batch.end()
+        except Exception, ex:
+            self.stats.errors += 1
+            log.error("can't send alerts of %s: %s", self.taskid, ex,
+                      exc_info=ex)
+            return
+        if sent:
+            self.stats.add('alerts', salt.ext.monitor.cron.monotonic() - start)
+
+    def timed_out(self):
+        '''
+        Count a run that timed out and alert when the task keeps timing
+        out.
+        '''
+        self.stats.timeouts += 1
+        self.timeouts_in_row += 1
+        timeout = self.options.get('timeout')
+        log.error('%s: run timed out after %s seconds', self.taskid, timeout)
+        if self.timeouts_in_row != self.options.get('timeout_alerts'):
+            return
+        msg = '{} timed out {} times in a row ({} second limit): {}'.format(
+                    self.taskid, self.timeouts_in_row, timeout,
+                    ' '.join(self.cmd))
+        if 'alert.error' in self.context['functions']:
+            self.context['_run']('alert.error', ['monitor.timeout', msg])
+        else:
+            log.error(msg)
+
+    def _adapt(self, result):
+        '''
+        Let an adaptive scheduler set the interval from this run.
+        '''
+        values = dict(salt.ext.monitor.rollup.flatten(result))
+        stable = self.reference is not None and \
+                 _within_band(self.reference, values, self.scheduler.band)
+        if not stable:
+            # measure the next stretch from here, not from the last run,
+            # so a steady drift can't stay within the band forever
+            self.reference = values
+        interval = self.scheduler.interval
+        self.scheduler.adapt(stable, self.stats.alert_calls > 0)
+        if self.scheduler.interval != interval:
+            log.debug('%s: interval %s -> %s seconds', self.taskid,
+                      interval, self.scheduler.interval)
+
+    def _changed(self, result):
+        '''
+        Return True if 'result' should be collected: always, unless the
+        task collects on change and the result's fingerprint matches the
+        last collected one and no heartbeat is due.
+        '''
+        if self.options.get('collect') != 'on-change':
+            return True
+        try:
+            fingerprint = hashlib.md5(json.dumps(result, sort_keys=True,
+                                                 default=repr)).digest()
+        except (TypeError, ValueError):
+            return True
+        if fingerprint == self.fingerprint and \
+                self.unchanged + 1 < self.options.get('heartbeat', 1):
+            self.unchanged += 1
+            self.stats.unchanged += 1
+            return False
+        self.fingerprint = fingerprint
+        self.unchanged = 0
+        return True
+
+def _within_band(reference, new, band):
+    '''
+    Return True if 'new' has the same numbers as 'reference' and none
+    moved by more than 'band' times its reference value.
+
+    >>> _within_band({('a',): 100}, {('a',): 104}, 0.05)
+    True
+    >>> _within_band({('a',): 100}, {('a',): 90}, 0.05)
+    False
+    '''
+    if len(reference) != len(new):
+        return False
+    for path, value in new.iteritems():
+        old = reference.get(path)
+        if old is None or abs(value - old) > band * abs(old):
+            return False
+    return True
@@ -4,22 +4,263 @@ Examples:
     alert.notice  sys.everython 'things are going great'
     alert.warning disk.hardware 'the VAX drive ${value} is wobbling'
     alert.error   turboencabular.wanshaft '${key} is {value:.1f} mm from failure'
+
+Repeated alerts are suppressed on the client.  An alert with the same
+host, category, severity and message as one sent less than
+'alert.dedup_window' seconds ago is dropped; numbers in the message are
+ignored when comparing, so 'disk 91% full' repeats 'disk 90% full',
+but digits within names are not, so 'eth1 down' doesn't repeat 'eth0
+down'.  When the window of a suppressed alert closes a single alert
+reports how many were dropped and the latest message.
+
+Each category may also send at most 'alert.rate_limit' alerts per
+minute, with bursts of up to 'alert.rate_burst'; the summaries above
+count too.  Alerts over the limit are counted per category, and once
+the category may send again one alert reports how many were dropped
+and the latest message.  At most 'alert.max_suppressed' alerts and
+categories are remembered.
 '''
 
+import collections
 import logging
+import re
+import threading
+import time
+
 import salt.ext.monitor.client
 
 log = logging.getLogger(__name__)
 
+DEFAULT_DEDUP_WINDOW = 300
+DEFAULT_RATE_LIMIT = 60
+DEFAULT_RATE_BURST = 20
+DEFAULT_MAX_SUPPRESSED = 10000
+
+# a number that isn't part of a name or of a dotted version or address
+_NUMBER = re.compile(r'(?<![\w.])\d+(?:\.\d+)?(?!\.?\d)')
+_SPACE = re.compile(r'\s+')
+
+_lock = threading.Lock()
+# (host, level, category, normalized msg) -> _Window, oldest first
+_windows = collections.OrderedDict()
+# category -> _Bucket, least recently used first
+_buckets = collections.OrderedDict()
+# category -> _Bucket of the categories with dropped alerts to report
+_dropping = collections.OrderedDict()
+# (time, Timer) of the pending flush()
+_timer = None
+
+class _Window(object):
+    '''
+    The suppression window opened by a sent alert.
+    '''
+    def __init__(self, expires, level, category, msg):
+        self.expires    = expires
+        self.level      = level
+        self.category   = category
+        self.msg        = msg
+        self.suppressed = 0
+
+class _Bucket(object):
+    '''
+    The rate limit token bucket of a category, and the alerts it has
+    dropped since it last reported them.
+    '''
+    def __init__(self, tokens, now):
+        self.tokens  = tokens
+        self.updated = now
+        self.dropped = 0
+        self.level   = None
+        self.msg     = None
+
+    def take(self, now, rate, burst):
+        '''
+        Refill the bucket, then take a token if there is one.
+        '''
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refilled(self, rate):
+        '''
+        Return the time the bucket has a token again.
+        '''
+        return self.updated + max(0, 1 - self.tokens) / rate
+
+def _normalize(msg):
+    '''
+    Return the part of an alert message that identifies repeats.
+
+    >>> _normalize('/var  is 91.5% full ')
+    '/var is #% full'
+    >>> _normalize('eth1 dropped 20 packets from 10.0.0.2')
+    'eth1 dropped # packets from 10.0.0.2'
+    '''
+    return _SPACE.sub(' ', _NUMBER.sub('#', msg)).strip()
+
+def _suppress(host, level, category, msg):
+    '''
+    Decide whether an alert is sent.  Return (send, summaries), where
+    summaries are the (level, category, msg) alerts reporting closed
+    windows and rate limited categories that may be sent now.
+    '''
+    window = __opts__.get('alert.dedup_window', DEFAULT_DEDUP_WINDOW)
+    limit = __opts__.get('alert.max_suppressed', DEFAULT_MAX_SUPPRESSED)
+    now = time.time()
+    key = (host, level, category, _normalize(msg))
+    with _lock:
+        summaries = _summaries(now, limit)
+        current = _windows.get(key)
+        if current is not None:
+            current.suppressed += 1
+            current.msg = msg
+            if current.suppressed == 1:
+                _schedule_flush(current.expires)
+            return False, summaries
+        if not _admit(now, level, category, msg, 1, limit):
+            return False, summaries
+        if window > 0:
+            _windows[key] = _Window(now + window, level, category, msg)
+        return True, summaries
+
+def _admit(now, level, category, msg, count, limit):
+    '''
+    Take a token from the category's bucket for an alert standing for
+    'count' alerts.  Return False, and count them as dropped, if there
+    is none.
+    '''
+    rate = __opts__.get('alert.rate_limit', DEFAULT_RATE_LIMIT) / 60.0
+    burst = __opts__.get('alert.rate_burst', DEFAULT_RATE_BURST)
+    if rate <= 0:
+        return True
+    bucket = _buckets.pop(category, None) or _Bucket(burst, now)
+    _buckets[category] = bucket
+    if len(_buckets) > limit:
+        evicted, oldest = _buckets.popitem(last=False)
+        _dropping.pop(evicted, None)
+    if bucket.take(now, rate, burst):
+        return True
+    bucket.dropped += count
+    bucket.level = level
+    bucket.msg = msg
+    if category not in _dropping:
+        _dropping[category] = bucket
+        _schedule_flush(bucket.refilled(rate))
+    return False
+
+def _summaries(now, limit):
+    '''
+    Return the summaries that may be sent now: those of closed windows
+    that get a token, and one per rate limited category that has a
+    token again.  A window summary without a token counts as dropped
+    by its category instead.
+    '''
+    summaries = []
+    for level, category, count, msg in _expire(now, limit):
+        if _admit(now, level, category, msg, count, limit):
+            summaries.append((level, category,
+                '{} similar alert{} suppressed: {}'.format(
+                    count, '' if count == 1 else 's', msg)))
+    rate = __opts__.get('alert.rate_limit', DEFAULT_RATE_LIMIT) / 60.0
+    burst = __opts__.get('alert.rate_burst', DEFAULT_RATE_BURST)
+    for category, bucket in _dropping.items():
+        if rate > 0 and not bucket.take(now, rate, burst):
+            continue
+        del _dropping[category]
+        summaries.append((bucket.level, category,
+            '{} alert{} rate limited: {}'.format(
+                bucket.dropped, '' if bucket.dropped == 1 else 's',
+                bucket.msg)))
+        bucket.dropped = 0
+    return summaries
+
+def _expire(now, limit):
+    '''
+    Close expired windows, and the oldest ones beyond 'limit', and
+    return (level, category, suppressed, msg) for those that suppressed
+    alerts.
+    '''
+    closed = []
+    while _windows:
+        key, oldest = next(_windows.iteritems())
+        if oldest.expires > now and len(_windows) < limit:
+            break
+        del _windows[key]
+        if oldest.suppressed:
+            closed.append((oldest.level, oldest.category, oldest.suppressed,
+                           oldest.msg))
+    return closed
+
+def _schedule_flush(when):
+    '''
+    Call flush() at time 'when' so summaries are sent even if no other
+    alert comes along.  Only the earliest flush is pending at a time.
+    '''
+    global _timer
+    if _timer is not None:
+        if _timer[0] <= when:
+            return
+        _timer[1].cancel()
+    timer = threading.Timer(max(0, when - time.time()) + 0.01, flush)
+    timer.daemon = True
+    timer.start()
+    _timer = (when, timer)
+
+def _send(host, level, category, msg):
+    aclient = salt.ext.monitor.client.get_client(__opts__)
+    aclient.alert(host, level, category, msg)
+
+def flush():
+    '''
+    Send the summaries of suppression windows that have closed and of
+    rate limited categories that may send again.
+    '''
+    host = __opts__.get('id', 'unknown')
+    limit = __opts__.get('alert.max_suppressed', DEFAULT_MAX_SUPPRESSED)
+    rate = __opts__.get('alert.rate_limit', DEFAULT_RATE_LIMIT) / 60.0
+    global _timer
+    with _lock:
+        _timer = None
+        summaries = _summaries(time.time(), limit)
+        for window in _windows.itervalues():
+            if window.suppressed:
+                _schedule_flush(window.expires)
+                break
+        if rate > 0:
+            for bucket in _dropping.itervalues():
+                _schedule_flush(bucket.refilled(rate))
+    for level, category, msg in summaries:
+        _send(host, level, category, msg)
+    return len(summaries)
+
+def outbox():
+    '''
+    Return the queued, sent, dropped and failed alert counters and the
+    outbox depth of each alert master.
+    The counters belong to the process sending the alerts, so this is
+    only meaningful inside salt-monitor, e.g. as a task:
+        - run: alert.outbox
+    'salt-call alert.outbox' only sees its own, empty, outbox.  The
+    monitor also reports the counters in monitor.stats and logs them on
+    SIGUSR1.
+    '''
+    return salt.ext.monitor.client.stats()
+
 def _alert(level, category, msg):
     '''
-    Send the alert to the alert service.
+    Send the alert to the alert service unless it is suppressed.
     '''
-    __opts__['master_uri'] = 'tcp://{}:{}'.format(__opts__['alert_master'],
-                                                  __opts__['alert.port'])
     host = __opts__.get('id', 'unknown')
-    aclient = salt.ext.monitor.client.AlertClient(__opts__)
-    aclient.alert(host, level, category, msg)
+    send, summaries = _suppress(host, level, category, msg)
+    for summary in summaries:
+        _send(host, *summary)
+    if not send:
+        log.debug('suppressed alert: %s %s %s', level, category, msg)
+        return None
+    _send(host, level, category, msg)
     return [host, level, category, msg]
 
 def notice(category, msg):
@@ -0,0 +1,21 @@
+'''
+Module for inspecting the salt monitor.
+Examples:
+    monitor.stats
+'''
+
+import salt.ext.monitor.stats
+
+def stats():
+    '''
+    Return run counts and latency histograms for every monitor task,
+    plus how late the dispatcher starts tasks.  Each histogram reports
+    count, mean, p50, p99 and max in seconds; 'react' excludes the time
+    spent in 'alerts' and 'lag' is how late a run started.  Interval
+    tasks also report how many runs overran their slot and how many
+    slots were skipped.  'alerts' has the alert outbox counters of
+    each alert master, see alert.outbox.
+    Only meaningful inside the salt-monitor process, e.g. as a task:
+        - run: monitor.stats
+    '''
+    return salt.ext.monitor.stats.report()
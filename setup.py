@@ -94,7 +94,9 @@ setup(
                 'salt.ext.monitor.collectors',
                 'salt.ext.monitor.parsers',
                 ],
-      py_modules=['salt.modules.alert'],
+      py_modules=['salt.modules.alert',
+                  'salt.modules.monitor',
+                  ],
       scripts=['scripts/salt-monitor'],
       data_files=[(os.path.join(etc_path, 'salt'),
                     ['conf/monitor']),
@@ -6,16 +6,23 @@ Unit tests for salt/ext/monitor/parser/yaml.py.
 
 import doctest
 import imp
+import os
 import salt
+import shutil
 import sys
+import tempfile
+import time
 import unittest
 
 # Create mock salt.log module used by salt.ext.monitor.parsers
 code = '''
 def getLogger(*args, **kwargs):
-    pass
+    return Logger()
 def trace(*args, **kwargs):
     pass
+class Logger(object):
+    def __getattr__(self, name):
+        return trace
 '''
 salt.log = imp.new_module('log')
 exec code in salt.log.__dict__
@@ -26,10 +33,21 @@ import salt.ext.monitor.parsers
 def dummy(*args, **kwargs):
     pass
 
+calls = []
+
+def record(*args):
+    calls.append(args)
+    return list(args)
+
+def sleep(seconds):
+    time.sleep(float(seconds))
+
 class MockMonitor(object):
     def __init__(self):
         self.opts = {}
-        self.functions = {'test.echo': dummy}
+        self.functions = {'test.echo': dummy, 'test.record': record,
+                          'test.sleep': sleep, 'alert.record': record,
+                          'alert.error': record}
 
 class TestYaml(unittest.TestCase):
 
@@ -134,5 +152,205 @@ class TestYaml(unittest.TestCase):
                                [ "if value['available'] > 100 and value['total'] < 1000:",
                                  "    _run('test.echo', ['{} too low'.format(value['available'])])" ])
 
+    def test_expand_tasks(self):
+        del calls[:]
+        tasks = self.parser._expand_tasks([
+                    {'id': 'numbers', 'run': 'test.record 1 2',
+                     'foreach value': ['test.record "got $value"']},
+                    {'run': 'test.record 3'}])
+        self.assertEqual([task.taskid for task in tasks],
+                         ['numbers', 'monitor-2'])
+        self.assertEqual(tasks[0].cmd, ['test.record', '1', '2'])
+        for task in tasks:
+            task.react(task.command())
+        self.assertEqual(calls, [('1', '2'), ('got 1',), ('got 2',), ('3',)])
+        # each task keeps its own namespace
+        self.assertFalse(tasks[0].context is tasks[1].context)
+        self.assertFalse('result' in tasks[0].context)
+
+    def test_bytecode_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            monitor = MockMonitor()
+            monitor.opts['monitor.cache_dir'] = cache_dir
+            config = [{'run': 'test.record 1'}, {'run': 'test.record 2'}]
+            parser = salt.ext.monitor.parsers.get_parser(monitor)
+            parser._expand_tasks(config)
+            self.assertEqual((parser.cache_hits, parser.cache_misses), (0, 2))
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            # pruning leaves files it didn't write alone
+            for name in ['README', '.tmpabc123']:
+                open(os.path.join(cache_dir, name), 'w').close()
+
+            parser = salt.ext.monitor.parsers.get_parser(monitor)
+            tasks = parser._expand_tasks(config[:1] + [{'run': 'test.record 3'}])
+            self.assertEqual((parser.cache_hits, parser.cache_misses), (1, 1))
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            self.assertTrue('README' in os.listdir(cache_dir))
+            self.assertEqual(tasks[0].cmd, ['test.record', '1'])
+            self.assertEqual(tasks[0].command(), ['1'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_collect_on_change(self):
+        collected = []
+        self.parser.context['collector'] = \
+            lambda host, cmd, result: collected.append(result)
+        task, = self.parser._expand_tasks([
+                    {'run': 'test.record 1', 'collect': 'on-change',
+                     'heartbeat': 3}])
+        for run in range(5):
+            task.run()
+        task.command = lambda: ['2']
+        task.run()
+        self.assertEqual(collected, [['1'], ['1'], ['2']])
+        self.assertEqual(task.stats.unchanged, 3)
+        self.assertEqual(self.parser._expand_tasks([
+                    {'run': 'test.record 1', 'collect': 'sometimes'},
+                    {'run': 'test.record 1', 'heartbeat': 0}]), [])
+
+    def test_coalesce(self):
+        del calls[:]
+        monitor = MockMonitor()
+        monitor.opts['monitor.coalesce_ttl'] = {'test.record': 60}
+        parser = salt.ext.monitor.parsers.get_parser(monitor)
+        tasks = parser._expand_tasks([
+                    {'run': 'test.record coalesce'},
+                    {'run': 'test.record coalesce',
+                     'if result[0] == "coalesce"': ['test.record matched']},
+                    {'run': 'test.record coalesce', 'coalesce': False}])
+        for task in tasks:
+            task.run()
+        self.assertEqual(calls, [('coalesce',), ('matched',), ('coalesce',)])
+        self.assertEqual([task.stats.coalesced for task in tasks], [0, 1, 0])
+        self.assertEqual(parser._expand_tasks([
+                    {'run': 'test.record 1', 'coalesce': -1}]), [])
+
+    def test_process_executor(self):
+        del calls[:]
+        collected = []
+        self.parser.context['collector'] = \
+            lambda host, cmd, result: collected.append(result)
+        task, = self.parser._expand_tasks([
+                    {'run': 'test.record 5', 'executor': 'process',
+                     'if result[0] == "5"': ['alert.record "five"']}])
+        task.run()
+        # the command ran in a child; only the alert ran here
+        self.assertEqual(calls, [('five',)])
+        self.assertEqual(collected, [['5']])
+        self.assertEqual(task.stats.errors, 0)
+        self.assertEqual(self.parser._expand_tasks([
+                    {'run': 'test.record 1', 'executor': 'fiber'}]), [])
+
+    def test_timeout_default(self):
+        task, patient = self.parser._expand_tasks([
+                    {'run': 'test.record 1'},
+                    {'run': 'test.record 1', 'timeout': False}])
+        self.assertEqual(task.options['timeout'], 300)
+        self.assertEqual(patient.options['timeout'], None)
+        monitor = MockMonitor()
+        monitor.opts['monitor.timeout'] = False
+        parser = salt.ext.monitor.parsers.get_parser(monitor)
+        task, = parser._expand_tasks([{'run': 'test.record 1'}])
+        self.assertEqual(task.options['timeout'], None)
+
+    def test_process_timeout(self):
+        del calls[:]
+        monitor = MockMonitor()
+        monitor.opts['monitor.timeout_alerts'] = 1
+        parser = salt.ext.monitor.parsers.get_parser(monitor)
+        task, = parser._expand_tasks([
+                    {'id': 'slow', 'run': 'test.sleep 5',
+                     'executor': 'process', 'timeout': 0.2}])
+        self.assertEqual(task.timeout, None)
+        start = time.time()
+        task.run()
+        self.assertTrue(time.time() - start < 4)
+        self.assertEqual(task.stats.timeouts, 1)
+        self.assertEqual(calls[0][0], 'monitor.timeout')
+        self.assertEqual(parser._expand_tasks([
+                    {'run': 'test.sleep 1', 'timeout': 0}]), [])
+
+    def test_rollup(self):
+        collected = []
+        self.parser.context['collector'] = \
+            lambda host, cmd, result: collected.append(result)
+        task, raw = self.parser._expand_tasks([
+                    {'run': 'test.record 1', 'rollup': 3600},
+                    {'run': 'test.record 1', 'rollup': 3600, 'raw': True}])
+        task.run()
+        raw.run()
+        self.assertEqual(collected, [['1']])
+        # end the window
+        task.context['collector']._start = 0
+        task.run()
+        self.assertEqual(collected[1]['samples'], 1)
+        self.assertEqual(self.parser._expand_tasks([
+                    {'run': 'test.record 1', 'rollup': 'hourly'},
+                    {'run': 'test.record 1', 'raw': 'yes'}]), [])
+
+    def test_adaptive(self):
+        task, = self.parser._expand_tasks([
+                    {'run': 'test.record 1', 'every': {'second': 10},
+                     'adaptive': {'min': 2, 'max': {'minute': 1}},
+                     'if int(result[0]) > 1': ['alert.record "high"']}])
+        scheduler = task.scheduler
+        task.run()
+        self.assertEqual(scheduler.interval, 10)
+        task.run()
+        self.assertEqual(scheduler.interval, 20)
+        task.command = lambda: ['2']
+        task.run()
+        self.assertEqual(scheduler.interval, 2)
+        self.assertEqual(self.parser._expand_tasks([
+                    {'run': 'test.record 1', 'at': {'minute': 5},
+                     'adaptive': True},
+                    {'run': 'test.record 1', 'adaptive': {'step': 2}},
+                    {'run': 'test.record 1', 'adaptive': {'band': 'x'}}]), [])
+
+    def test_adaptive_drift(self):
+        task, = self.parser._expand_tasks([
+                    {'run': 'test.record 1', 'every': {'second': 10},
+                     'adaptive': {'max': {'minute': 10}}}])
+        intervals = []
+        for run in range(12):
+            # creeps up 4% a run, within the 5% band of the previous one
+            task.command = lambda: {'load': 100 * 1.04 ** run}
+            task.run()
+            intervals.append(task.scheduler.interval)
+        self.assertEqual(max(intervals), 20)
+        task.command = lambda: {'load': 100}
+        for run in range(5):
+            task.run()
+        self.assertEqual(task.scheduler.interval, 160)
+
+    def test_history(self):
+        del calls[:]
+        plain, task = self.parser._expand_tasks([
+                    {'run': 'test.record 1'},
+                    {'run': 'test.record 1',
+                     'if delta("n") == 2': ['alert.record "delta"']}])
+        self.assertEqual(plain.history, None)
+        self.assertEqual(task.options['history'], 10)
+        for num in (1, 3, 4):
+            task.command = lambda: {'n': num}
+            task.run()
+        self.assertEqual(calls, [('delta',)])
+        self.assertEqual(list(task.history), [{'n': 1}, {'n': 3}, {'n': 4}])
+        self.assertEqual(self.parser._expand_tasks([
+                    {'run': 'test.record 1', 'history': -1}]), [])
+
+    def test_process_history(self):
+        del calls[:]
+        task, = self.parser._expand_tasks([
+                    {'run': 'test.record 5', 'executor': 'process',
+                     'history': 2,
+                     'if history and history[-1] == result':
+                        ['alert.record "same"']}])
+        task.run()
+        task.run()
+        self.assertEqual(calls, [('same',)])
+        self.assertEqual(len(task.history), 2)
+
 def test_suite():
     return unittest.TestLoader().loadTestsFromName(__name__)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/modules/alert.py.
+"""
+
+import doctest
+import imp
+import os
+import salt
+import salt.ext.monitor
+import sys
+import time
+import unittest
+
+# Create a mock alert client used by salt.modules.alert
+code = '''
+sent = []
+class Client(object):
+    def alert(self, *args):
+        sent.append(args)
+def get_client(opts):
+    return Client()
+'''
+client = imp.new_module('client')
+exec code in client.__dict__
+salt.ext.monitor.client = client
+sys.modules['salt.ext.monitor.client'] = client
+
+alert = imp.load_source('alert', os.path.join(os.path.dirname(__file__),
+                        '..', 'salt', 'modules', 'alert.py'))
+
+class TestAlert(unittest.TestCase):
+
+    def setUp(self):
+        alert.__opts__ = {'id': 'host'}
+        alert._windows.clear()
+        alert._buckets.clear()
+        alert._dropping.clear()
+        del client.sent[:]
+
+    def tearDown(self):
+        if alert._timer is not None:
+            alert._timer[1].cancel()
+            alert._timer = None
+
+    def test_doc(self):
+        doctest.testmod(alert)
+
+    def test_dedup(self):
+        alert.__opts__['alert.dedup_window'] = 0.05
+        alert.warning('disk.full', '/var is 91% full')
+        self.assertEqual(alert.warning('disk.full', '/var is 92% full'), None)
+        alert.error('disk.full', '/var is 92% full')
+        self.assertEqual(len(client.sent), 2)
+        # the summary is sent by a timer when the window closes
+        time.sleep(0.3)
+        self.assertEqual(len(client.sent), 3)
+        self.assertEqual(client.sent[2], ('host', 'WARNING', 'disk.full',
+                         '1 similar alert suppressed: /var is 92% full'))
+
+    def test_names_with_digits(self):
+        alert.warning('net.down', 'eth0 is down')
+        alert.warning('net.down', 'eth1 is down')
+        alert.warning('net.down', 'eth1 is down')
+        self.assertEqual([msg for host, level, category, msg in client.sent],
+                         ['eth0 is down', 'eth1 is down'])
+
+    def test_rate_limit(self):
+        alert.__opts__.update({'alert.dedup_window': 0,
+                               'alert.rate_limit': 600,
+                               'alert.rate_burst': 2})
+        for num in range(5):
+            alert.notice('load', 'message {}'.format(chr(ord('a') + num)))
+        self.assertEqual(len(client.sent), 2)
+        alert.notice('other', 'message')
+        self.assertEqual(len(client.sent), 3)
+        # one summary for the category once it has a token again
+        time.sleep(0.3)
+        self.assertEqual(client.sent[3:], [('host', 'NOTICE', 'load',
+                         '3 alerts rate limited: message e')])
+
+    def test_rate_limited_storm(self):
+        alert.__opts__.update({'alert.dedup_window': 0.05,
+                               'alert.rate_limit': 600,
+                               'alert.rate_burst': 2})
+        for num in range(50):
+            alert.error('disk.failed', 'disk{} failed'.format(num))
+        self.assertEqual(len(client.sent), 2)
+        # the dropped alerts opened no windows of their own, so they
+        # come back as a single summary rather than one each
+        time.sleep(0.3)
+        self.assertEqual(client.sent[2:], [('host', 'ERROR', 'disk.failed',
+                         '48 alerts rate limited: disk49 failed')])
+
+    def test_summaries_rate_limited(self):
+        alert.__opts__.update({'alert.dedup_window': 0.05,
+                               'alert.rate_limit': 0.6,
+                               'alert.rate_burst': 1})
+        alert.notice('load', 'load is high')
+        alert.notice('load', 'load is high')
+        alert.notice('load', 'load is high')
+        time.sleep(0.3)
+        # the window's summary found no token and waits in the bucket
+        self.assertEqual(len(client.sent), 1)
+        self.assertEqual(alert._buckets['load'].dropped, 2)
+        self.assertEqual(alert._buckets['load'].msg, 'load is high')
+
+    def test_bounded(self):
+        alert.__opts__['alert.max_suppressed'] = 10
+        for num in range(20):
+            alert.notice('cat{}'.format(num), 'msg')
+        self.assertEqual(len(alert._windows), 10)
+        self.assertEqual(len(alert._buckets), 10)
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
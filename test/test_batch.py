@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/batch.py.
+"""
+
+import salt.ext.monitor.batch
+import threading
+import unittest
+
+class MockClient(object):
+    def __init__(self):
+        self.batches = []
+
+    def alert(self, *alert):
+        if not salt.ext.monitor.batch.add(self, alert):
+            self.batches.append([alert])
+
+    def alert_batch(self, alerts):
+        self.batches.append(alerts)
+
+class TestBatch(unittest.TestCase):
+
+    def test_no_batch(self):
+        client = MockClient()
+        client.alert('host', 'ERROR', 'cat', 'one')
+        self.assertEqual(client.batches, [[('host', 'ERROR', 'cat', 'one')]])
+        self.assertEqual(salt.ext.monitor.batch.end(), 0)
+
+    def test_batch(self):
+        first, second = MockClient(), MockClient()
+        salt.ext.monitor.batch.begin()
+        first.alert('host', 'ERROR', 'cat', 'one')
+        second.alert('host', 'ERROR', 'cat', 'two')
+        first.alert('host', 'ERROR', 'cat', 'three')
+        self.assertEqual(first.batches, [])
+        self.assertEqual(salt.ext.monitor.batch.end(), 3)
+        self.assertEqual(first.batches, [[('host', 'ERROR', 'cat', 'one'),
+                                          ('host', 'ERROR', 'cat', 'three')]])
+        self.assertEqual(len(second.batches), 1)
+        # the batch is closed
+        first.alert('host', 'ERROR', 'cat', 'four')
+        self.assertEqual(len(first.batches), 2)
+
+    def test_per_thread(self):
+        client = MockClient()
+        salt.ext.monitor.batch.begin()
+        thread = threading.Thread(target=client.alert,
+                                  args=('host', 'ERROR', 'cat', 'other'))
+        thread.start()
+        thread.join()
+        self.assertEqual(len(client.batches), 1)
+        salt.ext.monitor.batch.end()
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/client.py.
+"""
+
+import imp
+import os
+import salt
+import sys
+import time
+import unittest
+
+# Create mock salt.log module used by salt.ext.monitor.client
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+# Create mock salt.exceptions and salt.crypt modules; a reply of
+# 'rotated' fails to decrypt as if the alert master rotated its key
+code = '''
+class AuthenticationError(Exception):
+    pass
+'''
+salt.exceptions = imp.new_module('exceptions')
+exec code in salt.exceptions.__dict__
+sys.modules['salt.exceptions'] = salt.exceptions
+
+code = '''
+import salt.exceptions
+logins = []
+class Crypticle(object):
+    def dumps(self, load):
+        return load
+    def loads(self, data):
+        if data == 'rotated':
+            raise salt.exceptions.AuthenticationError('key rotated')
+        return data
+class SAuth(object):
+    def __init__(self, opts):
+        logins.append(opts)
+        self.crypticle = Crypticle()
+'''
+salt.crypt = imp.new_module('crypt')
+exec code in salt.crypt.__dict__
+sys.modules['salt.crypt'] = salt.crypt
+
+# Create a mock zmq module.  Each request takes the next of 'replies'
+# as its reply, None for a reply that never comes, or 'ok' when there
+# are none left.  Polls don't wait: they return what is ready, after
+# waiting for 'gate' before a send.
+code = '''
+import threading
+REQ = 3
+LINGER = 17
+POLLIN = 1
+POLLOUT = 4
+NOBLOCK = 1
+replies = []
+sockets = []
+gate = threading.Event()
+gate.set()
+class ZMQError(Exception):
+    pass
+class Context(object):
+    @classmethod
+    def instance(cls):
+        return cls()
+    def socket(self, kind):
+        socket = Socket()
+        sockets.append(socket)
+        return socket
+class Socket(object):
+    def __init__(self):
+        self.sent = []
+        self.pending = []
+        self.closed = False
+    def setsockopt(self, option, value):
+        pass
+    def connect(self, uri):
+        pass
+    def close(self):
+        self.closed = True
+    def send_pyobj(self, payload, flags=0):
+        self.sent.append(payload['load'])
+        reply = replies.pop(0) if replies else 'ok'
+        if reply is not None:
+            self.pending.append(reply)
+    def recv_pyobj(self, flags=0):
+        return self.pending.pop(0)
+class Poller(object):
+    def __init__(self):
+        self.flags = {}
+    def register(self, socket, flags):
+        self.flags[socket] = flags
+    def poll(self, timeout=None):
+        ready = []
+        for socket, flags in self.flags.items():
+            if flags == POLLOUT:
+                gate.wait()
+                ready.append((socket, flags))
+            elif socket.pending:
+                ready.append((socket, flags))
+        return ready
+'''
+zmq = imp.new_module('zmq')
+exec code in zmq.__dict__
+sys.modules['zmq'] = zmq
+
+# load the module itself, test_alert.py puts a mock in its place
+client = imp.load_source('alert_client', os.path.join(
+                         os.path.dirname(__file__),
+                         '..', 'salt', 'ext', 'monitor', 'client.py'))
+
+class FakeTime(object):
+    def __init__(self):
+        self.sleeps = []
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+def alert(num):
+    return ('host', 'ERROR', 'cat', 'alert {}'.format(num))
+
+class TestAlertClient(unittest.TestCase):
+
+    def setUp(self):
+        del zmq.replies[:]
+        del zmq.sockets[:]
+        del salt.crypt.logins[:]
+        zmq.gate.set()
+        self.time = client.time
+        client.time = FakeTime()
+        self.opts = {'master_uri': 'tcp://salt:4507', 'alert.timeout': 1}
+
+    def tearDown(self):
+        zmq.gate.set()
+        client.time = self.time
+
+    def sent(self):
+        return [load for socket in zmq.sockets for load in socket.sent]
+
+    def test_send(self):
+        zmq.gate.clear()
+        aclient = client.AlertClient(self.opts)
+        aclient.alert_batch([alert(1)])
+        while not aclient.outbox.empty():
+            time.sleep(0.01)
+        aclient.alert_batch([alert(2)])
+        aclient.alert_batch([alert(3)])
+        zmq.gate.set()
+        aclient.close()
+        loads = self.sent()
+        self.assertEqual(loads[0]['cmd'], '_alert')
+        self.assertEqual(loads[0]['msg'], 'alert 1')
+        self.assertEqual(loads[0]['SEVERITY'], 'ERROR')
+        self.assertEqual(loads[1]['cmd'], '_alert_batch')
+        self.assertEqual(len(loads[1]['alerts']), 2)
+        stats = aclient.stats()
+        self.assertEqual((stats['queued'], stats['sent'], stats['reconnects'],
+                          stats['depth']), (3, 3, 1, 0))
+
+    def test_outbox_full(self):
+        self.opts['alert.outbox_size'] = 2
+        zmq.gate.clear()
+        aclient = client.AlertClient(self.opts)
+        aclient.alert_batch([alert(0)])
+        # the outbox thread holds the first alert while the send waits
+        while not aclient.outbox.empty():
+            time.sleep(0.01)
+        self.assertTrue(aclient.alert_batch([alert(1)]))
+        self.assertTrue(aclient.alert_batch([alert(2)]))
+        self.assertFalse(aclient.alert_batch([alert(3), alert(4)]))
+        stats = aclient.stats()
+        self.assertEqual((stats['queued'], stats['dropped'], stats['depth']),
+                         (3, 2, 2))
+        zmq.gate.set()
+        aclient.close()
+        self.assertEqual(aclient.stats()['sent'], 3)
+
+    def test_timeout(self):
+        zmq.replies[:] = [None, 'ok']
+        aclient = client.AlertClient(self.opts)
+        aclient.alert_batch([alert(1)])
+        aclient.close()
+        # the socket that lost its reply was replaced and the alert resent
+        self.assertEqual(len(zmq.sockets), 2)
+        self.assertTrue(zmq.sockets[0].closed)
+        self.assertEqual([load['msg'] for load in self.sent()],
+                         ['alert 1', 'alert 1'])
+        stats = aclient.stats()
+        self.assertEqual((stats['sent'], stats['retries'], stats['reconnects'],
+                          stats['failed']), (1, 1, 2, 0))
+
+    def test_backoff(self):
+        self.opts['alert.max_backoff'] = 3
+        zmq.replies[:] = [None] * 5
+        aclient = client.AlertClient(self.opts)
+        aclient.alert_batch([alert(1)])
+        aclient.close()
+        self.assertEqual(client.time.sleeps, [0.5, 1.0, 2.0, 3.0, 3.0])
+        self.assertEqual(aclient.stats()['sent'], 1)
+        self.assertEqual(len(zmq.sockets), 6)
+
+    def test_login_again(self):
+        zmq.replies[:] = ['rotated', 'ok']
+        aclient = client.AlertClient(self.opts)
+        aclient.alert_batch([alert(1)])
+        aclient.close()
+        self.assertEqual(len(salt.crypt.logins), 2)
+        self.assertEqual(len(self.sent()), 2)
+        stats = aclient.stats()
+        self.assertEqual((stats['sent'], stats['retries']), (1, 0))
+
+    def test_max_batch(self):
+        zmq.gate.clear()
+        aclient = client.AlertClient(self.opts)
+        aclient.alert_batch([alert(0)])
+        while not aclient.outbox.empty():
+            time.sleep(0.01)
+        alerts = [alert(num) for num in range(1, 181)]
+        for start in range(0, 180, 60):
+            aclient.alert_batch(alerts[start:start + 60])
+        zmq.gate.set()
+        aclient.close()
+        loads = self.sent()
+        self.assertEqual([len(load.get('alerts', [load])) for load in loads],
+                         [1, client.MAX_BATCH, 80])
+        self.assertEqual([item['msg'] for item in loads[1]['alerts'] +
+                                                  loads[2]['alerts']],
+                         [msg for host, level, cat, msg in alerts])
+        self.assertEqual(aclient.stats()['sent'], 181)
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
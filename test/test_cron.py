@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 
+import datetime
 import doctest
 import locale
+import os
+import time
 import unittest
 
 import salt.ext.monitor.cron
@@ -86,6 +89,168 @@ class TestTime(unittest.TestCase):
         self._test_parse_cron({"weekday" : "wed-sat"},       {"weekday" : [4, 5, 6, 7]})
         self._test_parse_cron({"weekday" : "wed-sat/2"},     {"weekday" : [4, 6]})
 
+    def test_cron_parse_wildcard(self):
+        self._test_parse_cron({'hour' : '*/6'}, {'hour' : [0, 6, 12, 18]})
+        self._test_parse_cron({'minute' : '*/15'}, {'minute' : [0, 15, 30, 45]})
+
+class TestIntervalScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.cron = salt.ext.monitor.cron.CronParser()
+
+    def _scheduler(self, missed):
+        return self.cron.create_scheduler('interval', {'second' : 10},
+                                          missed=missed)
+
+    def test_first(self):
+        scheduler = self.cron.create_scheduler('interval', {'second' : 10})
+        self.assertEqual(scheduler.first(100.0), 100.0)
+
+    def test_no_drift(self):
+        scheduler = self._scheduler('once')
+        scheduler.first(100.0)
+        self.assertEqual(scheduler.next(103.0), 110.0)
+        self.assertEqual(scheduler.next(113.5), 120.0)
+        self.assertEqual((scheduler.overruns, scheduler.skipped), (0, 0))
+
+    def test_missed_skip(self):
+        scheduler = self._scheduler('skip')
+        scheduler.first(100.0)
+        self.assertEqual(scheduler.next(125.0), 130.0)
+        self.assertEqual((scheduler.overruns, scheduler.skipped), (1, 2))
+        self.assertEqual(scheduler.next(131.0), 140.0)
+
+    def test_missed_once(self):
+        scheduler = self._scheduler('once')
+        scheduler.first(100.0)
+        self.assertEqual(scheduler.next(125.0), 125.0)
+        self.assertEqual((scheduler.overruns, scheduler.skipped), (1, 1))
+        self.assertEqual(scheduler.next(126.0), 130.0)
+
+    def test_missed_catch_up(self):
+        scheduler = self._scheduler('catch-up')
+        scheduler.first(100.0)
+        self.assertEqual(scheduler.next(125.0), 110.0)
+        self.assertEqual(scheduler.next(125.1), 120.0)
+        self.assertEqual(scheduler.next(125.2), 130.0)
+        self.assertEqual((scheduler.overruns, scheduler.skipped), (2, 0))
+        # too far behind to catch up
+        self.assertEqual(scheduler.next(1000.0), 1010.0)
+        self.assertEqual(scheduler.skipped, 87)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, self._scheduler, 'later')
+
+    def test_adaptive(self):
+        scheduler = self.cron.create_scheduler('interval', {'second' : 20},
+                                               adaptive={'min_interval': 5,
+                                                         'max_interval': 60})
+        scheduler.first(100.0)
+        scheduler.adapt(True, False)
+        self.assertEqual(scheduler.next(101.0), 140.0)
+        scheduler.adapt(True, False)
+        self.assertEqual(scheduler.next(141.0), 200.0)
+        # an alert tightens the very next slot
+        scheduler.adapt(True, True)
+        self.assertEqual(scheduler.next(201.0), 205.0)
+        scheduler.adapt(False, False)
+        self.assertEqual(scheduler.next(206.0), 210.0)
+        self.assertRaises(ValueError, self.cron.create_scheduler, 'interval',
+                          {'second' : 20}, adaptive={'min_interval': 30,
+                                                     'max_interval': 60})
+        self.assertRaises(ValueError, self.cron.create_scheduler, 'cron',
+                          {'minute' : 5}, adaptive={'min_interval': 30,
+                                                    'max_interval': 60})
+
+    def test_splay(self):
+        splay = salt.ext.monitor.cron.splay
+        self.assertEqual(splay('m1/disk', 60), splay('m1/disk', 60))
+        offsets = set(splay('m{}/disk'.format(num), 60) for num in range(100))
+        self.assertTrue(len(offsets) > 90)
+        self.assertTrue(all(0 <= offset < 60 for offset in offsets))
+        # the first run lands on the phase of the interval
+        scheduler = self.cron.create_scheduler('interval', {'minute' : 1},
+                                               'm1/disk')
+        for now in (1000000.0, 1000030.5, 1000059.9):
+            wait = scheduler.first(0, now)
+            self.assertTrue(0 <= wait < 60)
+            self.assertAlmostEqual((now + wait) % 60, scheduler.phase)
+
+class TestCronScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.cron = salt.ext.monitor.cron.CronParser()
+
+    def _scheduler(self, cron_dict):
+        return self.cron.create_scheduler('cron', cron_dict)
+
+    def _test_next(self, cron_dict, after, expected):
+        scheduler = self._scheduler(cron_dict)
+        actual = scheduler.next_fire(datetime.datetime(*after))
+        self.assertEqual(actual, datetime.datetime(*expected))
+
+    def test_time_of_day(self):
+        daily = {'hour' : '3', 'minute' : '27'}
+        self._test_next(daily, (2012, 1, 1), (2012, 1, 1, 3, 27))
+        self._test_next(daily, (2012, 1, 1, 3, 27), (2012, 1, 2, 3, 27))
+        self._test_next(daily, (2012, 12, 31, 4), (2013, 1, 1, 3, 27))
+        self._test_next({'hour' : '3'}, (2012, 1, 1, 3), (2012, 1, 2, 3))
+        self._test_next({'minute' : '*/15'},
+                        (2012, 1, 1, 10, 7, 30), (2012, 1, 1, 10, 15))
+        self._test_next({'minute' : '*/15'},
+                        (2012, 1, 1, 23, 45), (2012, 1, 2, 0, 0))
+        self._test_next({'second' : '30'},
+                        (2012, 1, 1, 10, 0, 30), (2012, 1, 1, 10, 1, 30))
+
+    def test_sparse(self):
+        leap = {'month' : 'feb', 'day' : '29', 'hour' : '3', 'minute' : '27'}
+        self._test_next(leap, (2013, 3, 1), (2016, 2, 29, 3, 27))
+        self._test_next(leap, (2096, 3, 1), (2104, 2, 29, 3, 27))
+        self._test_next({'month' : 'jan', 'day' : '31'},
+                        (2012, 2, 1), (2013, 1, 31))
+
+    def test_weekday(self):
+        weekly = {'weekday' : 'sun', 'hour' : '3', 'minute' : '27'}
+        self._test_next(weekly, (2012, 1, 2), (2012, 1, 8, 3, 27))
+        self._test_next(weekly, (2012, 1, 8, 3, 27), (2012, 1, 15, 3, 27))
+        self._test_next({'weekday' : 'mon-fri'},
+                        (2012, 1, 6, 12), (2012, 1, 9))
+
+    def test_day_or_weekday(self):
+        either = {'day' : '1', 'weekday' : 'mon'}
+        self._test_next(either, (2012, 1, 3), (2012, 1, 9))
+        self._test_next(either, (2012, 1, 30), (2012, 2, 1))
+
+    def test_never(self):
+        self.assertRaises(ValueError, self._scheduler,
+                          {'month' : 'feb', 'day' : '30'})
+        self.assertRaises(ValueError, self._scheduler, {})
+        self.assertRaises(ValueError, self._scheduler, {'second' : '60,61'})
+
+    def test_dst(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            # 02:30 doesn't exist on 2012-03-11; fire right after the jump
+            scheduler = self._scheduler({'hour' : '2', 'minute' : '30'})
+            now = time.mktime((2012, 3, 11, 1, 0, 0, 0, 0, 0))
+            self.assertTrue(0 < scheduler.delay(now) <= 2.5 * 3600)
+
+            # 01:30 happens twice on 2012-11-04; fire only once
+            scheduler = self._scheduler({'hour' : '1', 'minute' : '30'})
+            now = time.mktime((2012, 11, 4, 0, 0, 0, 0, 0, 1))
+            first = scheduler.delay(now)
+            self.assertTrue(0 < first <= 2.5 * 3600)
+            second = scheduler.delay(now + first + 60 * 60)
+            self.assertTrue(second > 20 * 3600)
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
 def test_suite():
     locale.setlocale(locale.LC_ALL, 'C')
     return unittest.TestLoader().loadTestsFromName(__name__)
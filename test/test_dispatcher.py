@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/dispatcher.py.
+"""
+
+import imp
+import salt
+import sys
+import threading
+import time
+import unittest
+
+# Create mock salt.log module used by salt.ext.monitor.dispatcher
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+import salt.ext.monitor.dispatcher
+
+class MockScheduler(object):
+    def __init__(self, interval):
+        self.interval = interval
+
+    def first(self, now):
+        return now
+
+    def next(self, now):
+        return now + self.interval
+
+class MockTask(object):
+    def __init__(self, taskid, runs, done, scheduler=None):
+        self.taskid = taskid
+        self.runs = runs
+        self.done = done
+        self.scheduler = scheduler
+
+    def run(self, lag=None):
+        self.runs.append(self.taskid)
+        if len(self.runs) >= 3:
+            self.done.set()
+
+class HungTask(object):
+    '''
+    A task whose first run blocks until 'release' is set.
+    '''
+    def __init__(self, timeout):
+        self.taskid = 'hung'
+        self.timeout = timeout
+        self.scheduler = MockScheduler(0.01)
+        self.release = threading.Event()
+        self.returned = threading.Event()
+        self.runs = 0
+        self.timeouts = 0
+
+    def run(self, lag=None):
+        self.runs += 1
+        if self.runs == 1:
+            self.release.wait(5)
+            self.returned.set()
+
+    def timed_out(self):
+        self.timeouts += 1
+
+class TestDispatcher(unittest.TestCase):
+
+    def _run(self, tasks, workers=2):
+        dispatcher = salt.ext.monitor.dispatcher.Dispatcher(tasks, workers)
+        thread = threading.Thread(target=dispatcher.start)
+        thread.daemon = True
+        thread.start()
+        return dispatcher, thread
+
+    def test_bad_workers(self):
+        self.assertRaises(ValueError,
+                          salt.ext.monitor.dispatcher.Dispatcher, [], 0)
+
+    def test_reschedule(self):
+        runs = []
+        done = threading.Event()
+        task = MockTask('a', runs, done, MockScheduler(0.01))
+        dispatcher, thread = self._run([task])
+        done.wait(5)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(len(runs) >= 3)
+
+    def test_run_once(self):
+        runs = []
+        done = threading.Event()
+        tasks = [MockTask(name, runs, done) for name in 'abc']
+        dispatcher, thread = self._run(tasks)
+        done.wait(5)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertEqual(sorted(runs), ['a', 'b', 'c'])
+
+    def test_remove(self):
+        runs = []
+        done = threading.Event()
+        task = MockTask('a', runs, done, MockScheduler(0.01))
+        dispatcher, thread = self._run([task])
+        done.wait(5)
+        dispatcher.remove(task)
+        count = len(runs)
+        done.clear()
+        done.wait(0.1)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertTrue(len(runs) <= count + 1)
+
+    def test_defer(self):
+        called = threading.Event()
+        dispatcher, thread = self._run([])
+        dispatcher.defer(called.set)
+        called.wait(5)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertTrue(called.is_set())
+
+    def test_batch(self):
+        runs = []
+        done = threading.Event()
+        tasks = [MockTask(name, runs, done) for name in 'abc']
+        for task, priority in zip(tasks, [0, 5, 1]):
+            task.priority = priority
+        dispatcher = salt.ext.monitor.dispatcher.Dispatcher([], workers=1,
+                                                            tolerance=0.05)
+        now = salt.ext.monitor.cron.monotonic()
+        for num, task in enumerate(tasks):
+            dispatcher.add(task, now + 0.1 + num * 0.01)
+        thread = threading.Thread(target=dispatcher.start)
+        thread.daemon = True
+        thread.start()
+        done.wait(5)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertEqual(runs, ['b', 'c', 'a'])
+        self.assertRaises(ValueError, salt.ext.monitor.dispatcher.Dispatcher,
+                          [], 1, -1)
+
+    def test_timeout(self):
+        task = HungTask(0.05)
+        runs = []
+        done = threading.Event()
+        other = MockTask('other', runs, done, MockScheduler(0.01))
+        dispatcher, thread = self._run([task, other], workers=1)
+        # the only worker is replaced, so other tasks keep running
+        done.wait(5)
+        self.assertTrue(len(runs) >= 3)
+        self.assertTrue(task.timeouts >= 1)
+        self.assertEqual(task.runs, 1)
+        task.release.set()
+        task.returned.wait(5)
+        deadline = time.time() + 5
+        while task.runs < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertTrue(task.runs >= 2)
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/eventloop.py.
+"""
+
+import imp
+import os
+import salt
+import sys
+import threading
+import time
+import unittest
+
+# Create mock salt.log module used by salt.ext.monitor.eventloop
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+# Create mock salt.exceptions and salt.crypt modules unless
+# test_client.py already did; tests run after every module is imported,
+# so replacing them would pull them from under its tests
+if 'salt.exceptions' not in sys.modules:
+    code = '''
+class AuthenticationError(Exception):
+    pass
+'''
+    salt.exceptions = imp.new_module('exceptions')
+    exec code in salt.exceptions.__dict__
+    sys.modules['salt.exceptions'] = salt.exceptions
+
+if 'salt.crypt' not in sys.modules:
+    code = '''
+class Crypticle(object):
+    def dumps(self, load):
+        return load
+    def loads(self, data):
+        return data
+class SAuth(object):
+    def __init__(self, opts):
+        self.crypticle = Crypticle()
+'''
+    salt.crypt = imp.new_module('crypt')
+    exec code in salt.crypt.__dict__
+    sys.modules['salt.crypt'] = salt.crypt
+
+# Create a mock zmq module.  Each request takes the next of 'replies'
+# as its reply, None for a reply that never comes, or 'ok' when there
+# are none left.  A socket's FD is a pipe that is never written, so the
+# loop only sees the events getsockopt(EVENTS) has at the time.
+code = '''
+import os
+import threading
+REQ = 3
+LINGER = 17
+FD = 14
+EVENTS = 15
+POLLIN = 1
+POLLOUT = 4
+NOBLOCK = 1
+replies = []
+sockets = []
+class ZMQError(Exception):
+    pass
+class Context(object):
+    @classmethod
+    def instance(cls):
+        return cls()
+    def socket(self, kind):
+        socket = Socket()
+        sockets.append(socket)
+        return socket
+class Socket(object):
+    def __init__(self):
+        self.sent = []
+        self.threads = []
+        self.pending = []
+        self.closed = False
+        self.fd, self.writer = os.pipe()
+    def setsockopt(self, option, value):
+        pass
+    def getsockopt(self, option):
+        if option == FD:
+            return self.fd
+        return POLLOUT | (POLLIN if self.pending else 0)
+    def connect(self, uri):
+        pass
+    def close(self):
+        self.closed = True
+        os.close(self.fd)
+        os.close(self.writer)
+    def send_pyobj(self, payload, flags=0):
+        self.sent.append(payload['load'])
+        self.threads.append(threading.current_thread())
+        reply = replies.pop(0) if replies else 'ok'
+        if reply is not None:
+            self.pending.append(reply)
+    def recv_pyobj(self, flags=0):
+        return self.pending.pop(0)
+'''
+zmq = imp.new_module('zmq')
+exec code in zmq.__dict__
+sys.modules['zmq'] = zmq
+
+import salt.ext.monitor.cron
+import salt.ext.monitor.eventloop
+
+# load the module itself, test_alert.py puts a mock in its place
+client = imp.load_source('eventloop_alert_client', os.path.join(
+                         os.path.dirname(__file__),
+                         '..', 'salt', 'ext', 'monitor', 'client.py'))
+
+class MockScheduler(object):
+    def __init__(self, interval):
+        self.interval = interval
+
+    def first(self, now):
+        return now
+
+    def next(self, now):
+        return now + self.interval
+
+class MockTask(object):
+    def __init__(self, taskid, runs, done, scheduler=None):
+        self.taskid = taskid
+        self.runs = runs
+        self.done = done
+        self.scheduler = scheduler
+
+    def run(self, lag=None):
+        self.runs.append(self.taskid)
+        if len(self.runs) >= 3:
+            self.done.set()
+
+class HungTask(object):
+    '''
+    A task whose runs hang until 'release' is set.
+    '''
+    def __init__(self, taskid, scheduler):
+        self.taskid = taskid
+        self.scheduler = scheduler
+        self.timeout = 0.1
+        self.timeouts = 0
+        self.release = threading.Event()
+
+    def run(self, lag=None):
+        self.release.wait()
+
+    def timed_out(self):
+        self.timeouts += 1
+
+def alert(num):
+    return ('host', 'ERROR', 'cat', 'alert {}'.format(num))
+
+@unittest.skipIf(salt.ext.monitor.eventloop.trollius is None,
+                 'trollius is not installed')
+class TestEventLoopDispatcher(unittest.TestCase):
+
+    def _run(self, tasks, workers=2):
+        dispatcher = salt.ext.monitor.eventloop.EventLoopDispatcher(tasks,
+                                                                    workers)
+        thread = threading.Thread(target=dispatcher.start)
+        thread.daemon = True
+        thread.start()
+        return dispatcher, thread
+
+    def test_bad_workers(self):
+        self.assertRaises(ValueError,
+                          salt.ext.monitor.eventloop.EventLoopDispatcher, [], 0)
+
+    def test_reschedule(self):
+        runs = []
+        done = threading.Event()
+        task = MockTask('a', runs, done, MockScheduler(0.01))
+        dispatcher, thread = self._run([task])
+        done.wait(5)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(len(runs) >= 3)
+
+    def test_run_once(self):
+        runs = []
+        done = threading.Event()
+        tasks = [MockTask(name, runs, done) for name in 'abc']
+        dispatcher, thread = self._run(tasks)
+        done.wait(5)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertEqual(sorted(runs), ['a', 'b', 'c'])
+
+    def test_batch(self):
+        runs = []
+        done = threading.Event()
+        tasks = [MockTask(name, runs, done) for name in 'abc']
+        for task, priority in zip(tasks, [0, 5, 1]):
+            task.priority = priority
+        dispatcher, thread = self._run([], workers=1)
+        now = salt.ext.monitor.cron.monotonic()
+        for num, task in enumerate(tasks):
+            dispatcher.add(task, now + 0.1 + num * 0.01)
+        done.wait(5)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertEqual(runs, ['b', 'c', 'a'])
+        self.assertEqual(dispatcher.wakeups, 1)
+
+    def test_defer(self):
+        called = threading.Event()
+        dispatcher, thread = self._run([])
+        dispatcher.defer(called.set)
+        called.wait(5)
+        dispatcher.stop()
+        thread.join(5)
+        self.assertTrue(called.is_set())
+
+    def test_timeout(self):
+        # the one worker is stuck in the hung run, yet the other task
+        # still runs on the thread that replaced it
+        hung = HungTask('hung', MockScheduler(0.05))
+        runs = []
+        done = threading.Event()
+        other = MockTask('other', runs, done, MockScheduler(0.05))
+        dispatcher, thread = self._run([hung], workers=1)
+        try:
+            while not hung.timeouts:
+                time.sleep(0.01)
+            dispatcher.add(other)
+            done.wait(5)
+            # later runs are skipped while the first one hangs
+            deadline = time.time() + 5
+            while hung.timeouts < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            hung.release.set()
+            dispatcher.stop()
+            thread.join(5)
+        self.assertEqual(runs[:3], ['other'] * 3)
+        self.assertTrue(hung.timeouts > 1)
+
+@unittest.skipIf(salt.ext.monitor.eventloop.trollius is None,
+                 'trollius is not installed')
+class TestAlertOutbox(unittest.TestCase):
+
+    def setUp(self):
+        del zmq.replies[:]
+        del zmq.sockets[:]
+        self.zmq = salt.ext.monitor.eventloop.zmq
+        salt.ext.monitor.eventloop.zmq = zmq
+        self.opts = {'master_uri': 'tcp://salt:4507', 'alert.timeout': 0.2,
+                     'alert.max_backoff': 0.01}
+        self.dispatcher = salt.ext.monitor.eventloop.EventLoopDispatcher()
+        client.use_driver(self.dispatcher.alert_outbox)
+        self.thread = None
+
+    def tearDown(self):
+        client.use_driver(None)
+        salt.ext.monitor.eventloop.zmq = self.zmq
+        if self.thread is not None:
+            self.dispatcher.stop()
+            self.thread.join(5)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.dispatcher.start)
+        self.thread.daemon = True
+        self.thread.start()
+        running = threading.Event()
+        self.dispatcher.defer(running.set)
+        running.wait(5)
+
+    def sent(self):
+        return [load for socket in zmq.sockets for load in socket.sent]
+
+    def test_send(self):
+        self.start()
+        aclient = client.AlertClient(self.opts)
+        aclient.alert_batch([alert(1)])
+        aclient.alert_batch([alert(2), alert(3)])
+        aclient.close()
+        self.assertEqual([item['msg'] for load in self.sent()
+                                      for item in load.get('alerts', [load])],
+                         ['alert 1', 'alert 2', 'alert 3'])
+        # sent from the event loop, not from an outbox thread
+        self.assertEqual(set(zmq.sockets[0].threads), set([self.thread]))
+        stats = aclient.stats()
+        self.assertEqual((stats['queued'], stats['sent'], stats['depth']),
+                         (3, 3, 0))
+
+    def test_timeout(self):
+        zmq.replies[:] = [None, 'ok']
+        self.start()
+        aclient = client.AlertClient(self.opts)
+        aclient.alert_batch([alert(1)])
+        aclient.close()
+        # the socket that lost its reply was replaced and the alert resent
+        self.assertEqual(len(zmq.sockets), 2)
+        self.assertTrue(zmq.sockets[0].closed)
+        self.assertEqual([load['msg'] for load in self.sent()],
+                         ['alert 1', 'alert 1'])
+        stats = aclient.stats()
+        self.assertEqual((stats['sent'], stats['retries'], stats['reconnects'],
+                          stats['failed']), (1, 1, 2, 0))
+
+    def test_close_stopped(self):
+        # at exit the loop no longer runs; close() runs it to send
+        aclient = client.AlertClient(self.opts)
+        aclient.alert_batch([alert(1)])
+        aclient.close()
+        self.assertEqual([load['msg'] for load in self.sent()], ['alert 1'])
+        self.assertEqual(aclient.stats()['sent'], 1)
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/history.py.
+"""
+
+import doctest
+import unittest
+
+import salt.ext.monitor.history
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.history = salt.ext.monitor.history.History(3)
+
+    def _sample(self, result, when):
+        self.history.begin(result, when)
+        self.history.end(result)
+
+    def test_doc(self):
+        doctest.testmod(salt.ext.monitor.history)
+
+    def test_helpers(self):
+        history = self.history
+        history.begin({'bytes': 100}, 10.0)
+        self.assertEqual(history.delta('bytes'), None)
+        self.assertEqual(history.rate('bytes'), None)
+        self.assertEqual(history.avg(2, 'bytes'), 100)
+        history.end({'bytes': 100})
+        history.begin({'bytes': 300}, 20.0)
+        self.assertEqual(history[-1], {'bytes': 100})
+        self.assertEqual(history.delta('bytes'), 200)
+        self.assertEqual(history.rate('bytes'), 20.0)
+        self.assertEqual(history.avg(2, 'bytes'), 200.0)
+        self.assertEqual(history.rate(lambda result: result['bytes'] * 2),
+                         40.0)
+        self.assertEqual(history.delta('packets'), None)
+
+    def test_bounded(self):
+        for num in range(10):
+            self._sample(num, float(num))
+        self.assertEqual(list(self.history), [7, 8, 9])
+        self.history.begin(10, 10.0)
+        self.assertEqual(self.history.last(2), [9, 10])
+        self.assertEqual(self.history.avg(10), 8.5)
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
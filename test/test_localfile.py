@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/collectors/localfile.py.
+"""
+
+import imp
+import os
+import salt
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# Create mock salt.log module used by the localfile collector
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+import salt.ext.monitor.collectors.localfile as localfile
+
+class FakeTime(object):
+    '''
+    Stands in for the time module with a clock stuck in one second.
+    '''
+    time = staticmethod(time.time)
+    def strftime(self, format):
+        return '20260101T000000'
+
+class TestLocalFile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.opts = dict(localfile.__opts__)
+        self.opts['localfile.dir'] = self.directory
+        self.opts['localfile.flush_interval'] = 60
+        self.writers = []
+
+    def tearDown(self):
+        # stop the flusher threads, also of writers a failed test left open
+        for writer in self.writers:
+            writer.close()
+            writer._thread.join(5)
+        shutil.rmtree(self.directory)
+
+    def writer(self):
+        writer = localfile.RecordWriter(self.opts)
+        self.writers.append(writer)
+        return writer
+
+    def test_write_read(self):
+        writer = self.writer()
+        for num in range(10):
+            writer.put({'cmd': 'test.echo', 'result': num})
+        self.assertEqual(list(localfile.read_dir(self.directory)), [])
+        writer.close()
+        self.assertEqual([record['result']
+                          for record in localfile.read_dir(self.directory)],
+                         range(10))
+        self.assertEqual(writer.stats()['written'], 10)
+
+    def test_restart_same_second(self):
+        real_time, localfile.time = localfile.time, FakeTime()
+        try:
+            for run in range(2):
+                writer = self.writer()
+                writer.put({'result': run})
+                writer.close()
+        finally:
+            localfile.time = real_time
+        # the second writer started a file of its own, ordered after
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['20260101T000000-000000.rec',
+                          '20260101T000000-000001.rec'])
+        self.assertEqual([record['result']
+                          for record in localfile.read_dir(self.directory)],
+                         [0, 1])
+
+    def test_rotate(self):
+        self.opts['localfile.buffer_size'] = 1
+        self.opts['localfile.max_bytes'] = 100
+        self.opts['localfile.max_files'] = 3
+        writer = self.writer()
+        for num in range(100):
+            writer.put({'result': num})
+        writer.close()
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+        results = [record['result']
+                   for record in localfile.read_dir(self.directory)]
+        self.assertEqual(results, range(100 - len(results), 100))
+
+    def test_truncated(self):
+        writer = self.writer()
+        writer.put({'result': 1})
+        writer.put({'result': 2})
+        writer.close()
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, 'r+b') as records:
+            records.truncate(os.path.getsize(path) - 1)
+        self.assertEqual(list(localfile.read(path)), [{'result': 1}])
+
+    def test_fsync_policy(self):
+        self.opts['localfile.fsync'] = 'sometimes'
+        self.assertRaises(ValueError, localfile.RecordWriter, self.opts)
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
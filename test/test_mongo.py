@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/collectors/mongo.py.
+"""
+
+import imp
+import salt
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# Create mock salt.log module used by the mongo collector
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+# Create mock pymongo and pymongo.errors modules recording the inserts
+# in 'inserted'
+code = '''
+class ConnectionFailure(Exception):
+    pass
+class AutoReconnect(ConnectionFailure):
+    pass
+'''
+errors = imp.new_module('errors')
+exec code in errors.__dict__
+
+code = '''
+import threading
+inserted = []
+# inserts wait for this while it is clear
+gate = threading.Event()
+gate.set()
+# the number of inserts to fail, and the connections made
+failures = [0]
+connections = []
+class Connection(object):
+    def __init__(self, host, port):
+        connections.append((host, port))
+    def __getitem__(self, name):
+        return Database()
+class Database(object):
+    def authenticate(self, user, password):
+        pass
+    def __getitem__(self, name):
+        return Collection(name)
+class Collection(object):
+    def __init__(self, name):
+        self.name = name
+    def insert(self, records):
+        gate.wait()
+        if failures[0]:
+            failures[0] -= 1
+            raise errors.AutoReconnect('mongo is down')
+        if isinstance(records, dict):
+            records = [records]
+        for record in records:
+            if isinstance(record['result'], set):
+                raise InvalidDocument('cannot encode object: set([])')
+        inserted.append((self.name, list(records)))
+class InvalidDocument(ValueError):
+    pass
+'''
+pymongo = imp.new_module('pymongo')
+exec code in pymongo.__dict__
+pymongo.errors = errors
+sys.modules['pymongo'] = pymongo
+sys.modules['pymongo.errors'] = errors
+
+import salt.ext.monitor.collectors.mongo as mongo
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+class TestEscapeDot(unittest.TestCase):
+
+    def test_untouched(self):
+        value = {'a': {'b': [1, {'c': 'd.e'}]}, 5: None}
+        self.assertTrue(mongo._escape_dot(value) is value)
+
+    def test_copy_on_write(self):
+        clean = {'x': [1, 2]}
+        value = {'clean': clean, 'dirty': {'list': [{'a.b': 1}, {'c': 2}]}}
+        result = mongo._escape_dot(value)
+        self.assertEqual(result, {'clean': {'x': [1, 2]},
+                                  'dirty': {'list': [{'a-b': 1}, {'c': 2}]}})
+        # only the branch holding the dotted key was copied
+        self.assertFalse(result is value)
+        self.assertTrue(result['clean'] is clean)
+        self.assertFalse(result['dirty'] is value['dirty'])
+        self.assertTrue(result['dirty']['list'][1] is
+                        value['dirty']['list'][1])
+        # and the input is unchanged
+        self.assertEqual(value['dirty']['list'][0], {'a.b': 1})
+
+    def test_non_string_keys(self):
+        value = {1: {'v.1': 2}, (2, 3): 'x', None: 4}
+        self.assertEqual(mongo._escape_dot(value),
+                         {1: {'v-1': 2}, (2, 3): 'x', None: 4})
+        self.assertEqual(value[1], {'v.1': 2})
+
+class TestBulkWriter(unittest.TestCase):
+
+    def setUp(self):
+        del pymongo.inserted[:]
+        del pymongo.connections[:]
+        pymongo.failures[0] = 0
+        pymongo.gate.set()
+        self.opts = dict(mongo.__opts__)
+        self.opts['mongo.spool_dir'] = ''
+        self.writer = None
+
+    def tearDown(self):
+        pymongo.gate.set()
+        if self.writer is not None:
+            self.writer.close()
+
+    def test_batch_size(self):
+        self.opts['mongo.batch_size'] = 3
+        self.opts['mongo.flush_interval'] = 60
+        self.writer = mongo.BulkWriter(self.opts)
+        for num in range(6):
+            self.writer.put('host', {'result': num})
+        self.assertTrue(wait_for(lambda: len(pymongo.inserted) == 2))
+        self.assertEqual([[record['result'] for record in records]
+                          for name, records in pymongo.inserted],
+                         [[0, 1, 2], [3, 4, 5]])
+
+    def test_flush_interval(self):
+        self.opts['mongo.flush_interval'] = 0.1
+        self.writer = mongo.BulkWriter(self.opts)
+        self.writer.put('host1', {'result': 1})
+        self.writer.put('host2', {'result': 2})
+        self.assertTrue(wait_for(lambda: len(pymongo.inserted) == 2))
+        # one batch, one insert per host collection
+        self.assertEqual(sorted(name for name, records in pymongo.inserted),
+                         ['host1', 'host2'])
+        self.assertEqual(self.writer.stats()['batches'], 1)
+
+    def test_queue_full(self):
+        self.opts['mongo.batch_size'] = 1
+        self.opts['mongo.queue_size'] = 2
+        pymongo.gate.clear()
+        self.writer = mongo.BulkWriter(self.opts)
+        self.writer.put('host', {'result': 0})
+        # the writer thread holds the first sample while the insert waits
+        self.assertTrue(wait_for(lambda: self.writer.queue.empty()))
+        for num in range(1, 5):
+            self.writer.put('host', {'result': num})
+        stats = self.writer.stats()
+        self.assertEqual(stats['queued'], 3)
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['depth'], 2)
+        pymongo.gate.set()
+        self.writer.close()
+        self.assertEqual([records[0]['result']
+                          for name, records in pymongo.inserted], [0, 1, 2])
+        stats = self.writer.stats()
+        self.assertEqual(stats['written'], 3)
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['depth'], 0)
+        self.assertTrue(stats['written_per_sec'] > 0)
+        self.assertFalse('spool' in stats)
+
+    def test_escape_on_write(self):
+        self.opts['mongo.flush_interval'] = 0
+        self.writer = mongo.BulkWriter(self.opts)
+        self.writer.put('host', {'result': {'/var.log': 1}})
+        self.assertTrue(wait_for(lambda: pymongo.inserted))
+        self.assertEqual(pymongo.inserted[0][1][0]['result'], {'/var-log': 1})
+
+class TestFailover(unittest.TestCase):
+
+    def setUp(self):
+        del pymongo.inserted[:]
+        del pymongo.connections[:]
+        pymongo.gate.set()
+        self.directory = tempfile.mkdtemp()
+        self.opts = dict(mongo.__opts__)
+        self.opts.update({'mongo.spool_dir': self.directory,
+                          'mongo.batch_size': 1,
+                          'mongo.flush_interval': 0,
+                          'mongo.replay_interval': 0.05})
+
+    def tearDown(self):
+        pymongo.failures[0] = 0
+        shutil.rmtree(self.directory)
+
+    def test_spool_and_replay(self):
+        # the first write fails and so do the first two replays
+        pymongo.failures[0] = 3
+        writer = mongo.BulkWriter(self.opts)
+        for num in range(30):
+            writer.put('host', {'result': num})
+            time.sleep(0.01)
+        self.assertTrue(wait_for(lambda: len(pymongo.inserted) == 30))
+        writer.close()
+        # every sample once, in order, whether replayed or written directly
+        self.assertEqual([record['result']
+                          for name, records in pymongo.inserted
+                          for record in records], range(30))
+        stats = writer.stats()
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['written'], 30)
+        self.assertTrue(0 < stats['spool']['replayed'] < 30)
+        self.assertFalse(writer._failing.is_set())
+        # a new connection after each failure
+        self.assertEqual(len(pymongo.connections), 4)
+
+    def test_rejected(self):
+        # a sample mongo can't store is dropped, not spooled
+        self.opts['mongo.batch_size'] = 5
+        self.opts['mongo.flush_interval'] = 60
+        writer = mongo.BulkWriter(self.opts)
+        writer.put('host', {'result': set()})
+        for num in range(20):
+            writer.put('host', {'result': num})
+        writer.close()
+        self.assertEqual([record['result']
+                          for name, records in pymongo.inserted
+                          for record in records], range(20))
+        stats = writer.stats()
+        self.assertEqual((stats['written'], stats['rejected'],
+                          stats['errors']), (20, 1, 0))
+        self.assertEqual(stats['spool']['spooled'], 0)
+        self.assertFalse(writer._failing.is_set())
+
+    def test_spool_disabled(self):
+        self.opts['mongo.spool_dir'] = ''
+        pymongo.failures[0] = 1
+        writer = mongo.BulkWriter(self.opts)
+        writer.put('host', {'result': 0})
+        writer.put('host', {'result': 1})
+        writer.close()
+        self.assertEqual([records[0]['result']
+                          for name, records in pymongo.inserted], [1])
+        self.assertEqual(writer.stats()['errors'], 1)
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
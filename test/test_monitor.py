@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/monitor.py.
+"""
+
+import imp
+import salt
+import sys
+import unittest
+
+# Create mock salt.log module used by salt.ext.monitor
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+# Create mock salt.config, salt.loader and salt.minion modules; the
+# minion's salt functions are the ones in 'functions'
+code = '''
+def record(*args):
+    return list(args)
+functions = {'test.record': record}
+class SMinion(object):
+    def __init__(self, opts):
+        self.opts = opts
+        self.functions = functions
+'''
+salt.minion = imp.new_module('minion')
+exec code in salt.minion.__dict__
+sys.modules['salt.minion'] = salt.minion
+
+code = '''
+class Loader(object):
+    def __init__(self, module_dirs, opts):
+        pass
+    def filter_func(self, name):
+        return {}
+'''
+salt.loader = imp.new_module('loader')
+exec code in salt.loader.__dict__
+sys.modules['salt.loader'] = salt.loader
+
+salt.config = imp.new_module('config')
+sys.modules['salt.config'] = salt.config
+
+# The alert client and the asyncio engine only need zmq, salt.crypt and
+# salt.exceptions to import; keep the mocks other tests put in place
+for name in ('zmq', 'salt.crypt', 'salt.exceptions'):
+    if name not in sys.modules:
+        sys.modules[name] = imp.new_module(name)
+
+import salt.ext.monitor.monitor
+import salt.ext.monitor.process
+
+class MockDispatcher(object):
+    def __init__(self):
+        self.tasks = []
+        self.started = False
+    def add(self, task):
+        self.tasks.append(task)
+    def remove(self, task):
+        self.tasks.remove(task)
+    def start(self):
+        self.started = True
+
+class TestMonitor(unittest.TestCase):
+
+    def setUp(self):
+        salt.ext.monitor.process._terminate()
+        self.opts = {'monitor.process_workers': 2,
+                     'monitor': [{'run': 'test.record 1'},
+                                 {'run': 'test.record 2',
+                                  'executor': 'process'}]}
+
+    def tearDown(self):
+        salt.ext.monitor.process._terminate()
+        salt.ext.monitor.process.configure({})
+
+    def test_start_forks(self):
+        monitor = salt.ext.monitor.monitor.Monitor(self.opts)
+        # salt-monitor -d daemonizes here, the children must come after
+        self.assertEqual(salt.ext.monitor.process._running, 0)
+        monitor.dispatcher = MockDispatcher()
+        monitor.start()
+        self.assertTrue(monitor.dispatcher.started)
+        self.assertEqual(monitor.dispatcher.tasks, monitor.tasks)
+        self.assertEqual(salt.ext.monitor.process._running, 2)
+        self.assertEqual(len(salt.ext.monitor.process._idle), 2)
+
+    def _reloaded(self, opts):
+        '''
+        Start a monitor with two tasks and reload it with 'opts'; returns
+        the tasks before and after, and the dispatcher.
+        '''
+        monitor = salt.ext.monitor.monitor.Monitor(
+                    {'monitor': [{'run': 'test.record 1'},
+                                 {'run': 'test.record 2'}]})
+        monitor.dispatcher = MockDispatcher()
+        monitor.start()
+        before = list(monitor.tasks)
+        monitor.reload(opts)
+        return before, monitor.tasks, monitor.dispatcher
+
+    def test_reload(self):
+        before, after, dispatcher = self._reloaded(
+                    {'monitor': [{'run': 'test.record 1'},
+                                 {'run': 'test.record 3'}]})
+        # the unchanged task keeps running, the others are swapped
+        self.assertTrue(after[0] is before[0])
+        self.assertEqual(after[1].cmd, ['test.record', '3'])
+        self.assertEqual(dispatcher.tasks, [before[0], after[1]])
+
+    def test_reload_settings(self):
+        before, after, dispatcher = self._reloaded(
+                    {'monitor.workers': 8,
+                     'monitor': [{'run': 'test.record 1'},
+                                 {'run': 'test.record 2'}]})
+        # a changed monitor.* setting rebuilds and reschedules every task
+        self.assertEqual([task.cmd for task in after],
+                         [task.cmd for task in before])
+        self.assertFalse(set(after) & set(before))
+        self.assertEqual(dispatcher.tasks, after)
+
+    def test_bad_engine(self):
+        self.opts['monitor.engine'] = 'fibers'
+        self.assertRaises(ValueError, salt.ext.monitor.monitor.Monitor,
+                          self.opts)
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
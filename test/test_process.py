@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/process.py.
+"""
+
+import imp
+import logging
+import salt
+import StringIO
+import sys
+import threading
+import time
+import unittest
+
+# Create mock salt.log module used by salt.ext.monitor.process
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+import salt.ext.monitor.process
+
+def sleep(seconds):
+    time.sleep(float(seconds))
+    return seconds
+
+def log_record(*args):
+    logging.getLogger('test.process').warning('record %s', args)
+    return list(args)
+
+FUNCTIONS = {'test.sleep': sleep, 'test.log': log_record}
+
+class Task(object):
+    '''
+    The parts of a MonitorTask process.execute() uses.
+    '''
+    def __init__(self, key, name, *args):
+        self.key = key
+        self.pyexe = compile('def _command():\n'
+                             '    return _run({!r}, {!r})\n'
+                             'def _react(result):\n'
+                             '    return result\n'.format(name, list(args)),
+                             key, 'exec')
+        self.context = {'functions': FUNCTIONS}
+
+class TestProcess(unittest.TestCase):
+
+    def setUp(self):
+        salt.ext.monitor.process._terminate()
+
+    def tearDown(self):
+        salt.ext.monitor.process._terminate()
+        salt.ext.monitor.process.configure({})
+
+    def test_refork(self):
+        # replacement children are forked while other threads run and
+        # must not hang on a logging lock one of them held at the fork
+        salt.ext.monitor.process.configure({'monitor.process_workers': 1,
+                                            'monitor.process_maxtasks': 1})
+        stream = StringIO.StringIO()
+        handler = logging.StreamHandler(stream)
+        logging.getLogger('test.process').addHandler(handler)
+        locked = threading.Event()
+        release = threading.Event()
+        def hold():
+            handler.acquire()
+            locked.set()
+            release.wait()
+            handler.release()
+        holder = threading.Thread(target=hold)
+        holder.start()
+        task = Task('log', 'test.log', '1')
+        try:
+            locked.wait()
+            for run in range(2):
+                result, alerts, error, times = \
+                    salt.ext.monitor.process.execute(task, 5)
+                self.assertEqual(result, ['1'])
+        finally:
+            release.set()
+            holder.join()
+            logging.getLogger('test.process').removeHandler(handler)
+        # the children logged to their own copy of the stream
+        self.assertEqual(stream.getvalue(), '')
+
+    def test_timeout_isolated(self):
+        salt.ext.monitor.process.configure({'monitor.process_workers': 2})
+        slow = Task('slow', 'test.sleep', '5')
+        other = Task('other', 'test.sleep', '0.6')
+        results = {}
+        def run(task, timeout):
+            try:
+                results[task.key] = salt.ext.monitor.process.execute(
+                                        task, timeout)[0]
+            except Exception, ex:
+                results[task.key] = ex
+        threads = [threading.Thread(target=run, args=(slow, 0.3)),
+                   threading.Thread(target=run, args=(other, None))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # killing the slow run left the other one alone
+        self.assertTrue(isinstance(results['slow'],
+                                   salt.ext.monitor.process.Timeout))
+        self.assertEqual(results['other'], '0.6')
+        self.assertEqual(salt.ext.monitor.process.execute(other)[0], '0.6')
+
+    def test_kill_fails(self):
+        salt.ext.monitor.process.configure({'monitor.process_workers': 1})
+        kill = salt.ext.monitor.process._Worker.kill
+        def broken(worker):
+            kill(worker)
+            raise AssertionError('can only join a child process')
+        salt.ext.monitor.process._Worker.kill = broken
+        try:
+            self.assertRaises(salt.ext.monitor.process.Timeout,
+                              salt.ext.monitor.process.execute,
+                              Task('slow', 'test.sleep', '5'), 0.2)
+        finally:
+            salt.ext.monitor.process._Worker.kill = kill
+        # the child was dropped from the pool all the same
+        self.assertEqual(salt.ext.monitor.process._idle, [])
+        self.assertEqual(salt.ext.monitor.process._running, 0)
+        self.assertEqual(salt.ext.monitor.process.execute(
+                            Task('fast', 'test.sleep', '0'), 5)[0], '0')
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/rollup.py.
+"""
+
+import imp
+import salt
+import sys
+import unittest
+
+# Create mock salt.log module used by salt.ext.monitor.rollup
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+import salt.ext.monitor.rollup
+
+class TestRollup(unittest.TestCase):
+
+    def setUp(self):
+        self.collected = []
+        self.rollup = salt.ext.monitor.rollup.Rollup(
+                        lambda host, cmd, result: self.collected.append(result),
+                        3600)
+
+    def test_rollup(self):
+        for load in (0.5, 0.1, 0.3):
+            self.rollup('host', ['status.loadavg'],
+                        {'1-min': load, 'cpus': [1, 2], 'name': 'x',
+                         'up': True})
+        self.assertEqual(self.collected, [])
+        self.rollup._start = 0
+        self.rollup('host', ['status.loadavg'], {'1-min': 0.2})
+        record, = self.collected
+        self.assertEqual(record['samples'], 3)
+        self.assertEqual(record['values']['1-min'],
+                         {'min': 0.1, 'max': 0.5, 'sum': 0.5 + 0.1 + 0.3,
+                          'count': 3, 'last': 0.3})
+        self.assertEqual(record['values']['cpus']['1']['sum'], 6)
+        self.assertEqual(sorted(record['values']), ['1-min', 'cpus'])
+
+    def test_shape_change(self):
+        for results in ([{'a': 1}, {'a': {'min': 5}}],
+                        [{'a': {'min': 5}}, {'a': 1}]):
+            self.rollup._start = 0
+            for result in results:
+                self.rollup('host', ['test.echo'], result)
+            del self.collected[:]
+            self.rollup._start = 0
+            self.rollup('host', ['test.echo'], 0)
+            record, = self.collected
+            # the leaf below the other one is left out, in either order
+            self.assertEqual(record['values'],
+                             {'a': {'min': 1, 'max': 1, 'sum': 1, 'count': 1,
+                                    'last': 1}})
+
+    def test_scalar(self):
+        self.rollup('host', ['test.echo'], 5)
+        self.rollup._start = 0
+        self.rollup('host', ['test.echo'], 7)
+        self.assertEqual(self.collected[0]['values']['value']['last'], 5)
+
+    def test_raw(self):
+        self.rollup.raw = True
+        self.rollup('host', ['test.echo'], 5)
+        self.assertEqual(self.collected, [5])
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
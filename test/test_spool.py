@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/spool.py.
+"""
+
+import imp
+import os
+import salt
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Create mock salt.log module used by salt.ext.monitor.spool
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+import salt.ext.monitor.spool
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        spool = salt.ext.monitor.spool.Spool(self.directory, segment_size=100)
+        for num in range(10):
+            spool.append([('host', {'num': num})])
+        self.assertTrue(len(spool) > 1)
+        replayed = []
+        self.assertEqual(spool.replay(replayed.extend), 10)
+        self.assertEqual([record['num'] for host, record in replayed],
+                         range(10))
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_failed_replay(self):
+        spool = salt.ext.monitor.spool.Spool(self.directory)
+        spool.append([1, 2])
+        def fail(records):
+            raise IOError('backend down')
+        self.assertRaises(IOError, spool.replay, fail)
+        # kept, and picked up by a new spool after a restart
+        spool = salt.ext.monitor.spool.Spool(self.directory)
+        spool.append([3])
+        replayed = []
+        spool.replay(replayed.extend)
+        self.assertEqual(replayed, [1, 2, 3])
+
+    def test_truncated(self):
+        spool = salt.ext.monitor.spool.Spool(self.directory)
+        spool.append([1])
+        spool.append([2])
+        spool._close_segment()
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, 'r+b') as segment:
+            segment.truncate(os.path.getsize(path) - 1)
+        replayed = []
+        salt.ext.monitor.spool.Spool(self.directory).replay(replayed.extend)
+        self.assertEqual(replayed, [1])
+
+    def test_max_size(self):
+        spool = salt.ext.monitor.spool.Spool(self.directory, segment_size=1,
+                                             max_size=300)
+        for num in range(100):
+            spool.append(['x' * 50])
+        stats = spool.stats()
+        self.assertTrue(stats['bytes'] <= 300)
+        self.assertTrue(stats['expired'] > 0)
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
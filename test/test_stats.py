@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/stats.py.
+"""
+
+import doctest
+import unittest
+
+import salt.ext.monitor.stats
+
+OUTBOX = {'queued': 5, 'sent': 3, 'dropped': 1, 'failed': 0, 'retries': 2,
+          'reconnects': 1, 'depth': 1}
+
+class MockDispatcher(object):
+    wakeups = 7
+
+class MockMonitor(object):
+    dispatcher = MockDispatcher()
+    tasks = []
+    def alert_stats(self):
+        return {'tcp://salt:4507': OUTBOX}
+
+class TestStats(unittest.TestCase):
+
+    def test_doc(self):
+        doctest.testmod(salt.ext.monitor.stats)
+
+    def test_empty(self):
+        hist = salt.ext.monitor.stats.Histogram()
+        self.assertEqual(hist.percentile(50), None)
+        self.assertEqual(hist.summary()['count'], 0)
+
+    def test_percentiles(self):
+        hist = salt.ext.monitor.stats.Histogram()
+        for num in range(1, 101):
+            hist.add(num / 1000.0)
+        summary = hist.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['mean'], 0.0505)
+        self.assertTrue(0.05 <= summary['p50'] <= 0.1)
+        self.assertTrue(0.099 <= summary['p99'] <= 0.18)
+        self.assertEqual(summary['max'], 0.1)
+
+    def test_overflow(self):
+        hist = salt.ext.monitor.stats.Histogram()
+        hist.add(1000.0)
+        self.assertEqual(hist.percentile(99), 1000.0)
+
+    def test_format_report(self):
+        task = salt.ext.monitor.stats.TaskStats()
+        task.runs = 2
+        task.add('command', 0.001)
+        report = {'dispatcher': {'lag': salt.ext.monitor.stats.Histogram().summary()},
+                  'tasks': {'disk': task.summary()}}
+        lines = salt.ext.monitor.stats.format_report(report)
+        self.assertEqual(lines[0], 'dispatcher: wakeups=0 lag -')
+        self.assertTrue(lines[1].startswith(
+            'disk: runs=2 errors=0 timeouts=0 overruns=0 skipped=0 unchanged=0 command 1.0/1.0ms'))
+
+    def test_alert_stats(self):
+        # the outbox counters are only visible inside the monitor process
+        salt.ext.monitor.stats.register(MockMonitor())
+        try:
+            report = salt.ext.monitor.stats.report()
+        finally:
+            salt.ext.monitor.stats.register(None)
+        self.assertEqual(report['alerts'], {'tcp://salt:4507': OUTBOX})
+        lines = salt.ext.monitor.stats.format_report(report)
+        self.assertTrue(lines[0].startswith('dispatcher: wakeups=7 lag '))
+        self.assertEqual(lines[1:], [
+            'alerts tcp://salt:4507: queued=5 sent=3 dropped=1 failed=0 '
+            'retries=2 reconnects=1 depth=1'])
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
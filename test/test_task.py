@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for salt/ext/monitor/task.py.
+"""
+
+import imp
+import salt
+import sys
+import threading
+import time
+import unittest
+
+# Create mock salt.log module used by salt.ext.monitor
+code = '''
+def getLogger(*args, **kwargs):
+    return Logger()
+class Logger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+'''
+salt.log = imp.new_module('log')
+exec code in salt.log.__dict__
+sys.modules['salt.log'] = salt.log
+
+import salt.ext.monitor.task
+
+class TestCommandCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = salt.ext.monitor.task.CommandCache()
+
+    def test_coalesce_timeout(self):
+        cache = self.cache
+        release = threading.Event()
+        def hang():
+            release.wait()
+            return 'shared'
+        leader = threading.Thread(target=cache.get,
+                                  args=(('test.hang',), hang, 60))
+        leader.start()
+        try:
+            time.sleep(0.05)
+            # a follower gives up on the hung leader and runs its own
+            self.assertEqual(cache.get(('test.hang',), lambda: 'own', 0, 0.1),
+                             ('own', False))
+        finally:
+            release.set()
+            leader.join()
+        self.assertEqual(cache.get(('test.hang',), lambda: 'own', 60, 0.1),
+                         ('shared', True))
+
+def test_suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)